@@ -10,8 +10,11 @@ validation = Blueprint("validation", __name__)
 def read(id, resource_id):
 
     try:
+        # The report is loaded in pages by the page itself, see
+        # `resource_validation_report`
         validation = get_action(u"resource_validation_show")(
-            {u"user": c.user}, {u"resource_id": resource_id}
+            {u"user": c.user},
+            {u"resource_id": resource_id, u"include_report": False},
         )
 
         resource = get_action(u"resource_show")({u"user": c.user}, {u"id": resource_id})
@@ -0,0 +1,230 @@
+# encoding: utf-8
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import requests
+
+import ckantoolkit as t
+
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_CACHE_MAX_SIZE = 1024 * 1024 * 1024
+DEFAULT_CACHE_MAX_AGE = 7 * 24 * 60 * 60
+
+
+def get_cache_dir():
+    u'''
+    Returns the directory used to cache remote files, or None if the
+    download cache is disabled (`ckanext.validation.download_cache_dir` is
+    not set)
+    '''
+    return t.config.get(u'ckanext.validation.download_cache_dir') or None
+
+
+def get_cache_max_size():
+    return t.asint(t.config.get(
+        u'ckanext.validation.download_cache_max_size',
+        DEFAULT_CACHE_MAX_SIZE))
+
+
+def get_cache_max_age():
+    return t.asint(t.config.get(
+        u'ckanext.validation.download_cache_max_age',
+        DEFAULT_CACHE_MAX_AGE))
+
+
+def get_cached_source(url, http_session):
+    u'''
+    Returns the path to a local copy of the remote file at `url`
+
+    If the file was downloaded before, a conditional request is made using
+    the stored `ETag` and `Last-Modified` values, and the cached copy is
+    used if the server responds with a 304. Otherwise the file is downloaded
+    again and stored in the cache.
+
+    Returns None if the cache is disabled or the file could not be
+    downloaded, in which case the source should be streamed as usual.
+    '''
+    cache_dir = get_cache_dir()
+    if not cache_dir:
+        return None
+
+    key = _get_key(url)
+    data_path, meta_path = _get_paths(cache_dir, key)
+    meta = _read_meta(meta_path) if os.path.exists(data_path) else None
+
+    headers = {}
+    if meta:
+        if meta.get(u'etag'):
+            headers[u'If-None-Match'] = meta[u'etag']
+        if meta.get(u'last_modified'):
+            headers[u'If-Modified-Since'] = meta[u'last_modified']
+
+    try:
+        response = http_session.get(url, headers=headers, stream=True)
+        if response.status_code == 304 and meta:
+            response.close()
+            log.debug(u'Using cached copy of %s', url)
+            _touch(data_path)
+            return data_path
+
+        response.raise_for_status()
+        _store(cache_dir, key, url, response)
+    except (IOError, requests.RequestException) as e:
+        log.warning(u'Could not download %s into the cache: %s', url, e)
+        return None
+
+    prune(keep=key)
+
+    return data_path if os.path.exists(data_path) else None
+
+
+def get_cache_info():
+    u'''
+    Returns a list with the details of the files currently in the cache,
+    most recently used first
+    '''
+    cache_dir = get_cache_dir()
+    if not cache_dir or not os.path.isdir(cache_dir):
+        return []
+
+    entries = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith(u'.json'):
+            continue
+        key = name[:-len(u'.json')]
+        data_path, meta_path = _get_paths(cache_dir, key)
+        meta = _read_meta(meta_path)
+        try:
+            stat = os.stat(data_path)
+        except OSError:
+            continue
+        entries.append({
+            u'key': key,
+            u'url': meta.get(u'url'),
+            u'etag': meta.get(u'etag'),
+            u'last_modified': meta.get(u'last_modified'),
+            u'size': stat.st_size,
+            u'last_used': stat.st_mtime,
+        })
+
+    entries.sort(key=lambda entry: entry[u'last_used'], reverse=True)
+
+    return entries
+
+
+def prune(max_size=None, max_age=None, keep=None):
+    u'''
+    Removes the files not used in more than `max_age` seconds and then the
+    least recently used ones until the total size of the cache is below
+    `max_size` bytes. The configured limits are used by default.
+
+    Returns the number of files removed.
+    '''
+    if max_size is None:
+        max_size = get_cache_max_size()
+    if max_age is None:
+        max_age = get_cache_max_age()
+
+    now = time.time()
+    total = 0
+    removed = 0
+    # Most recently used first, so the oldest ones are removed
+    for entry in get_cache_info():
+        total += entry[u'size']
+        if entry[u'key'] == keep:
+            continue
+        if (max_age and now - entry[u'last_used'] > max_age) or (
+                max_size and total > max_size):
+            remove(entry[u'key'])
+            total -= entry[u'size']
+            removed += 1
+
+    return removed
+
+
+def purge():
+    u'''
+    Removes all files from the cache, returning the number of files removed
+    '''
+    entries = get_cache_info()
+    for entry in entries:
+        remove(entry[u'key'])
+
+    return len(entries)
+
+
+def remove(key):
+    for path in _get_paths(get_cache_dir(), key):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _get_key(url):
+    return hashlib.sha256(url.encode(u'utf8')).hexdigest()
+
+
+def _get_paths(cache_dir, key):
+    path = os.path.join(cache_dir, key)
+    return path + u'.data', path + u'.json'
+
+
+def _read_meta(meta_path):
+    try:
+        with open(meta_path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _touch(path):
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+
+def _store(cache_dir, key, url, response):
+    u'''
+    Writes the response body and its metadata to the cache. Files are written
+    to a temporary location first and then moved, so other processes never
+    see partial files.
+    '''
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    data_path, meta_path = _get_paths(cache_dir, key)
+    response.raw.decode_content = True
+    f = tempfile.NamedTemporaryFile(
+        dir=cache_dir, suffix=u'.tmp', delete=False)
+    try:
+        with f:
+            shutil.copyfileobj(response.raw, f)
+        os.replace(f.name, data_path)
+    except Exception:
+        os.remove(f.name)
+        raise
+    finally:
+        response.close()
+
+    meta = {
+        u'url': url,
+        u'etag': response.headers.get(u'ETag'),
+        u'last_modified': response.headers.get(u'Last-Modified'),
+    }
+    with tempfile.NamedTemporaryFile(
+            mode=u'w', dir=cache_dir, suffix=u'.tmp', delete=False) as f:
+        json.dump(meta, f)
+    os.replace(f.name, meta_path)
+
+    log.debug(u'Stored copy of %s in the cache', url)
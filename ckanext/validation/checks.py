@@ -0,0 +1,83 @@
+# encoding: utf-8
+
+import time
+
+import attrs
+from frictionless import Check
+
+
+# Custom Frictionless checks used internally by the validation jobs. They
+# don't generate any errors, and are added to the checks provided by users
+# in the validation options.
+
+
+TIME_LIMIT_WARNING = u'reached time limit: {} seconds'
+
+
+@attrs.define(kw_only=True)
+class time_limit(Check):
+    u'''
+    Stops reading the source once the validation has been running for more
+    than the provided number of seconds
+    '''
+
+    type = u'ckanext-validation-time-limit'
+
+    seconds: float = 0
+
+    def connect(self, resource):
+        super().connect(resource)
+        self.deadline = time.time() + self.seconds
+        self.reached = False
+
+    def validate_row(self, row):
+        if not self.reached and time.time() > self.deadline:
+            self.reached = True
+            # Closing the row stream makes the validation finish as if the
+            # end of the source had been reached
+            self.resource.row_stream.close()
+
+        yield from []
+
+
+@attrs.define(kw_only=True)
+class collect_keys(Check):
+    u'''
+    Collects the values of unique and primary key fields, so they can be
+    checked across chunks. It doesn't generate any errors.
+    '''
+
+    type = u'ckanext-validation-collect-keys'
+
+    def connect(self, resource):
+        super().connect(resource)
+        self.unique = {
+            field.name: {} for field in resource.schema.fields
+            if field.constraints.get(u'unique')}
+        self.primary_key = resource.schema.primary_key
+        self.primary = {}
+
+    def validate_row(self, row):
+        for field_name, values in self.unique.items():
+            cell = row[field_name]
+            if cell is not None:
+                values.setdefault(cell, row.row_number)
+        if self.primary_key:
+            cells = tuple(row[name] for name in self.primary_key)
+            if set(cells) != {None}:
+                self.primary.setdefault(cells, row.row_number)
+
+        yield from []
+
+
+def add_time_limit_warning(report, seconds):
+    u'''
+    Adds a warning to the (dict) report stating that the validation was
+    stopped after reaching the time limit
+    '''
+    for task in report.get(u'tasks', []):
+        task.setdefault(u'warnings', []).append(
+            TIME_LIMIT_WARNING.format(seconds))
+        task[u'stats'][u'warnings'] = len(task[u'warnings'])
+
+    return report
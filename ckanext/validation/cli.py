@@ -1,8 +1,14 @@
+import datetime
 import sys
 
 import click
 
-from ckanext.validation.model import create_tables, tables_exist
+import ckantoolkit as t
+
+from ckanext.validation.model import (
+    create_tables, tables_exist, tables_up_to_date, upgrade_tables)
+from ckanext.validation.logic import _search_datasets
+from ckanext.validation import cache, indexing
 
 
 @click.group()
@@ -20,3 +26,112 @@ def init_db():
 
     create_tables()
     print(u"Validation tables created")
+
+
+@validation.command()
+def upgrade_db():
+    """Updates the existing tables to the latest version."""
+    if not tables_exist():
+        print(u"Validation tables do not exist, run init-db first")
+        sys.exit(1)
+
+    if tables_up_to_date():
+        print(u"Validation tables are already up to date")
+        sys.exit(0)
+
+    upgrade_tables()
+    print(u"Validation tables upgraded")
+
+
+@validation.command()
+@click.option(u"-y", u"--yes", u"assume_yes", is_flag=True,
+              help=u"Automatic yes to prompts.")
+@click.option(u"-r", u"--resource", u"resource_ids", multiple=True,
+              help=u"Run data validation on a particular resource. "
+              u"It can be defined multiple times.")
+@click.option(u"-d", u"--dataset", u"dataset_ids", multiple=True,
+              help=u"Run data validation on all resources of a particular "
+              u"dataset. It can be defined multiple times.")
+@click.option(u"-s", u"--search", u"search_params",
+              help=u"Extra search parameters (as a JSON object) used to get "
+              u"the datasets to run validation on.")
+@click.option(u"--only-stale", is_flag=True,
+              help=u"Only validate resources not validated yet, whose last "
+              u"validation errored or that changed since then.")
+@click.option(u"--older-than", type=int,
+              help=u"Only validate resources not validated in the last "
+              u"number of days provided.")
+def run(assume_yes, resource_ids, dataset_ids, search_params, only_stale,
+        older_than):
+    """Starts asynchronous data validation on the site resources."""
+    if resource_ids:
+        for resource_id in resource_ids:
+            t.get_action(u"resource_validation_run")(
+                {u"ignore_auth": True},
+                {u"resource_id": resource_id, u"async": True})
+            print(u"Resource {} sent to the validation queue".format(
+                resource_id))
+        return
+
+    query = _search_datasets()
+    if query[u"count"] == 0:
+        print(u"No suitable datasets, exiting...")
+        sys.exit(1)
+
+    if not assume_yes and not click.confirm(
+            u"You are about to start validation for {0} datasets. "
+            u"Do you want to continue?".format(query[u"count"])):
+        print(u"Command aborted by user")
+        sys.exit(1)
+
+    result = t.get_action(u"resource_validation_run_batch")(
+        {u"ignore_auth": True, u"throttle_batch": True},
+        {u"dataset_ids": list(dataset_ids) or None,
+         u"query": search_params,
+         u"only_stale": only_stale,
+         u"older_than": older_than})
+    print(result[u"output"])
+
+
+@validation.command()
+def cache_info():
+    """Lists the remote files stored in the download cache."""
+    if not cache.get_cache_dir():
+        print(u"The download cache is not enabled")
+        sys.exit(1)
+
+    entries = cache.get_cache_info()
+    for entry in entries:
+        print(u"{size:>12} {last_used} {url}".format(
+            size=entry[u"size"],
+            last_used=datetime.datetime.utcfromtimestamp(
+                entry[u"last_used"]).isoformat(),
+            url=entry[u"url"]))
+    print(u"{} files, {} bytes".format(
+        len(entries), sum(entry[u"size"] for entry in entries)))
+
+
+@validation.command()
+@click.option(u"--all", u"purge_all", is_flag=True,
+              help=u"Remove all files, not only the expired ones.")
+def cache_purge(purge_all):
+    """Removes expired files (or all of them) from the download cache."""
+    if not cache.get_cache_dir():
+        print(u"The download cache is not enabled")
+        sys.exit(1)
+
+    if purge_all:
+        removed = cache.purge()
+    else:
+        removed = cache.prune()
+    print(u"{} files removed from the download cache".format(removed))
+
+
+@validation.command()
+@click.option(u"--max-age", type=int,
+              help=u"Only reindex the datasets waiting for longer than this "
+              u"number of seconds.")
+def flush_index(max_age):
+    """Reindexes the datasets with pending validation status changes."""
+    count = indexing.flush(max_age)
+    print(u"{} datasets reindexed".format(count))
@@ -3,12 +3,15 @@
 import sys
 import logging
 import csv
+import datetime
 
 from ckan.lib.cli import query_yes_no
 from ckantoolkit import CkanCommand, get_action, config
 
-from ckanext.validation import settings
-from ckanext.validation.model import create_tables, tables_exist
+from ckanext.validation import settings, cache, indexing
+from ckanext.validation.model import (
+    create_tables, tables_exist, tables_up_to_date, upgrade_tables,
+    get_validation_error_counts, get_validation_error_samples)
 from ckanext.validation.logic import _search_datasets
 
 
@@ -29,6 +32,20 @@ class Validation(CkanCommand):
         paster validation init-db
             Initialize database tables
 
+        paster validation upgrade-db
+            Update existing database tables to the latest version
+
+        paster validation cache-info
+            List the remote files stored in the download cache
+
+        paster validation cache-purge [--all]
+            Remove the expired files (or all of them with --all) from the
+            download cache
+
+        paster validation flush-index [--max-age=SECONDS]
+            Reindex the datasets with pending validation status changes (or
+            only the ones waiting for longer than the provided time)
+
         paster validation run [options]
 
             Start asynchronous data validation on the site resources. If no
@@ -36,7 +53,8 @@ class Validation(CkanCommand):
             the supported formats (`ckanext.validation.formats`). You can
             specify particular datasets to run the validation on their
             resources. You can also pass arbitrary search parameters to filter
-            the selected datasets.
+            the selected datasets. Use --only-stale or --older-than to skip
+            the resources that don't need to be validated again.
 
          paster validation report [options]
 
@@ -105,12 +123,40 @@ fields are `q`, `fq` and `fq_list`. Check the documentation for examples.
 Note that when using this you will have to specify the resource formats to
 target yourself. Not to be used with -r or -d.''')
 
+        self.parser.add_option('--only-stale', dest='only_stale',
+                               action='store_true',
+                               default=False,
+                               help='''Only run data validation on resources
+not validated yet, whose last validation errored or that have been modified
+since they were last validated. Not to be used with -r.''')
+
+        self.parser.add_option('--older-than', dest='older_than',
+                               action='store',
+                               type='int',
+                               default=None,
+                               help='''Only run data validation on resources
+not validated in the last number of days provided. Not to be used with
+-r.''')
+
         self.parser.add_option('-o', '--output', dest='output_file',
                                action='store',
                                default='validation_errors_report.csv',
                                help='''Location of the CSV validation
 report file on the relevant commands.''')
 
+        self.parser.add_option('--max-age', dest='max_age',
+                               action='store',
+                               type='int',
+                               default=None,
+                               help='''Only reindex the datasets waiting for
+longer than this number of seconds.''')
+
+        self.parser.add_option('--all', dest='purge_all',
+                               action='store_true',
+                               default=False,
+                               help='''Remove all files from the download
+cache, not only the expired ones.''')
+
 
     _page_size = 100
 
@@ -124,6 +170,14 @@ report file on the relevant commands.''')
         cmd = self.args[0]
         if cmd == 'init-db':
             self.init_db()
+        elif cmd == 'upgrade-db':
+            self.upgrade_db()
+        elif cmd == 'cache-info':
+            self.cache_info()
+        elif cmd == 'cache-purge':
+            self.cache_purge()
+        elif cmd == 'flush-index':
+            self.flush_index()
         elif cmd == 'run':
             self.run_validation()
         elif cmd == 'clear':
@@ -146,6 +200,50 @@ report file on the relevant commands.''')
 
         print(u'Validation tables created')
 
+    def upgrade_db(self):
+
+        if not tables_exist():
+            error(u'Validation tables do not exist, run init-db first')
+
+        if tables_up_to_date():
+            print(u'Validation tables are already up to date')
+            sys.exit(0)
+
+        upgrade_tables()
+
+        print(u'Validation tables upgraded')
+
+    def cache_info(self):
+
+        if not cache.get_cache_dir():
+            error(u'The download cache is not enabled')
+
+        entries = cache.get_cache_info()
+        for entry in entries:
+            print(u'{size:>12} {last_used} {url}'.format(
+                size=entry[u'size'],
+                last_used=datetime.datetime.utcfromtimestamp(
+                    entry[u'last_used']).isoformat(),
+                url=entry[u'url']))
+        print(u'{} files, {} bytes'.format(
+            len(entries), sum(entry[u'size'] for entry in entries)))
+
+    def cache_purge(self):
+
+        if not cache.get_cache_dir():
+            error(u'The download cache is not enabled')
+
+        if self.options.purge_all:
+            removed = cache.purge()
+        else:
+            removed = cache.prune()
+        print(u'{} files removed from the download cache'.format(removed))
+
+    def flush_index(self):
+
+        count = indexing.flush(self.options.max_age)
+        print(u'{} datasets reindexed'.format(count))
+
     def run_validation(self):
 
         if self.options.resource_id:
@@ -171,9 +269,11 @@ report file on the relevant commands.''')
                     error('Command aborted by user')
 
             result = get_action('resource_validation_run_batch')(
-                {'ignore_auth': True},
+                {'ignore_auth': True, 'throttle_batch': True},
                 {'dataset_ids': self.options.dataset_id,
-                 'query': self.options.search_params}
+                 'query': self.options.search_params,
+                 'only_stale': self.options.only_stale,
+                 'older_than': self.options.older_than}
             )
             print(result['output'])
 
@@ -211,44 +311,41 @@ report file on the relevant commands.''')
 
         return
 
-    def _process_row_full(self, dataset, resource, writer):
+    def _process_rows_full(self, rows, writer):
+        '''
+        Writes the first errors of each type of the provided (dataset,
+        resource) pairs, and returns the total number of errors of each type
 
+        The totals come from the validation summaries and the errors from
+        the error table, with one query each for all the resources.
+        '''
         limit_per_error_type = 10
 
-        error_counts = {}
+        resource_ids = [resource['id'] for dataset, resource in rows]
+        counts = get_validation_error_counts(resource_ids)
+        samples = get_validation_error_samples(
+            resource_ids, per_code=limit_per_error_type)
 
-        resource_url = '{}/dataset/{}/resource/{}'.format(
-            config['ckan.site_url'],
-            dataset['name'],
-            resource['id'])
-
-        # Get validation report
-        validation = get_action('resource_validation_show')(
-            {'ignore_auth': True}, {'resource_id': resource['id']})
-
-        if not validation.get('report'):
-            return
-
-        errors = validation['report']['tables'][0]['errors']
-
-        for error in errors:
-            if not error['code'] in error_counts:
-                error_counts[error['code']] = 1
-            else:
-                error_counts[error['code']] += 1
-
-            if error_counts[error['code']] > limit_per_error_type:
-                continue
-
-            writer.writerow({
-                'dataset': dataset['name'],
-                'resource_id': resource['id'],
-                'format': resource['format'],
-                'url': resource_url,
-                'status': resource['validation_status'],
-                'error_code': error['code'],
-                'error_message': error['message']
-            })
+        error_counts = {}
+        for dataset, resource in rows:
+            for code, count in counts.get(resource['id'], {}).items():
+                error_counts[code] = error_counts.get(code, 0) + count
+
+            resource_url = '{}/dataset/{}/resource/{}'.format(
+                config['ckan.site_url'],
+                dataset['name'],
+                resource['id'])
+
+            for error in samples.get(resource['id'], []):
+                writer.writerow({
+                    'dataset': dataset['name'],
+                    'resource_id': resource['id'],
+                    'format': resource['format'],
+                    'url': resource_url,
+                    'status': resource['validation_status'],
+                    'error_code': error.code,
+                    'error_message': error.message
+                })
 
         return error_counts
 
@@ -292,6 +389,7 @@ report file on the relevant commands.''')
                     error('No suitable datasets, exiting...')
 
                 if query['results']:
+                    failed_rows = []
                     for dataset in query['results']:
 
                         if not dataset.get('resources'):
@@ -311,14 +409,7 @@ report file on the relevant commands.''')
                             if resource.get('validation_status') in (
                                         'failure', 'error'):
                                 if full:
-                                    row_counts = self._process_row_full(dataset, resource, writer)
-                                    if not row_counts:
-                                        continue
-                                    for code, count in row_counts.iteritems():
-                                        if code not in error_counts:
-                                            error_counts[code] = count
-                                        else:
-                                            error_counts[code] += count
+                                    failed_rows.append((dataset, resource))
                                 else:
                                     self._process_row(dataset, resource, writer)
 
@@ -332,6 +423,11 @@ report file on the relevant commands.''')
                                 else:
                                     outputs['formats_success'][resource['format']] = 1
 
+                    if failed_rows:
+                        row_counts = self._process_rows_full(
+                            failed_rows, writer)
+                        for code, count in row_counts.items():
+                            error_counts[code] = error_counts.get(code, 0) + count
 
                     if len(query['results']) < self._page_size:
                         break
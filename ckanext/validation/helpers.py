@@ -18,10 +18,12 @@ def get_validation_badge(resource, in_listing=False):
         'success': _('Valid data'),
         'failure': _('Invalid data'),
         'error': _('Error during validation'),
+        'pending': _('Validation pending'),
         'unknown': _('Data validation unknown'),
     }
 
-    if resource['validation_status'] in ['success', 'failure', 'error']:
+    if resource['validation_status'] in [
+            'success', 'failure', 'error', 'pending']:
         status = resource['validation_status']
     else:
         status = 'unknown'
@@ -34,13 +36,18 @@ def get_validation_badge(resource, in_listing=False):
     badge_url = url_for_static(
         '/images/badges/data-{}-flat.svg'.format(status))
 
+    alt = messages[status]
+    if (status in ['success', 'failure'] and
+            asbool(resource.get('validation_sampled', False))):
+        alt = _('{status} (sampled)').format(status=alt)
+
     return '''
 <a href="{validation_url}" class="validation-badge">
     <img src="{badge_url}" alt="{alt}" title="{title}"/>
 </a>'''.format(
         validation_url=validation_url,
         badge_url=badge_url,
-        alt=messages[status],
+        alt=alt,
         title=resource.get('validation_timestamp', ''))
 
 
@@ -0,0 +1,171 @@
+# encoding: utf-8
+
+import logging
+import time
+
+from redis.exceptions import RedisError
+
+import ckantoolkit as t
+
+from ckanext.validation import queues
+
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_INDEX_DEBOUNCE = 30
+
+
+def get_index_debounce():
+    u'''
+    Returns the number of seconds that datasets with validation status
+    changes wait before being reindexed, so several changes are indexed at
+    once (`ckanext.validation.index_debounce`)
+    '''
+    return t.asint(t.config.get(
+        u'ckanext.validation.index_debounce', DEFAULT_INDEX_DEBOUNCE))
+
+
+def queue_for_reindex(package_id):
+    u'''
+    Adds a dataset to the buffer of datasets to reindex
+
+    If the dataset is already on the buffer the time of the first change is
+    kept, so a dataset with a continuous stream of changes is still
+    reindexed after the debounce time. If the buffer is not available the
+    dataset is reindexed straight away.
+    '''
+    try:
+        queues.get_redis_connection().zadd(
+            _get_buffer_key(), {package_id: time.time()}, nx=True)
+    except RedisError as e:
+        log.warning(u'Could not add dataset %s to the index buffer: %s',
+                    package_id, e)
+        reindex([package_id])
+
+
+def flush(max_age=None):
+    u'''
+    Reindexes the datasets in the buffer whose first change happened more
+    than `max_age` seconds ago, or all of them if `max_age` is not provided
+
+    Returns the number of datasets reindexed.
+    '''
+    cutoff = time.time() - max_age if max_age else u'+inf'
+
+    try:
+        redis = queues.get_redis_connection()
+        package_ids = [
+            package_id.decode(u'utf8') for package_id in
+            redis.zrangebyscore(_get_buffer_key(), u'-inf', cutoff)]
+        if not package_ids:
+            return 0
+
+        # Only the datasets actually removed are reindexed, in case another
+        # process is flushing the buffer at the same time
+        pipe = redis.pipeline()
+        for package_id in package_ids:
+            pipe.zrem(_get_buffer_key(), package_id)
+        package_ids = [
+            package_id for package_id, removed in
+            zip(package_ids, pipe.execute()) if removed]
+    except RedisError as e:
+        log.warning(u'Could not flush the index buffer: %s', e)
+        return 0
+
+    return reindex(package_ids)
+
+
+def flush_if_due():
+    u'''
+    Called by the workers after each validation job. All datasets in the
+    buffer are reindexed if there are no more validation jobs waiting,
+    otherwise only the ones waiting for longer than the debounce time, and a
+    flush job is enqueued for the rest.
+    '''
+    for job_class in queues.JOB_CLASSES:
+        if queues.get_queue_depth(job_class):
+            count = flush(get_index_debounce())
+            _schedule_flush()
+            return count
+
+    return flush()
+
+
+def flush_job():
+    u'''
+    Job enqueued by `flush_if_due` when some datasets are left in the buffer,
+    so they are reindexed even if no more validation jobs run afterwards
+    '''
+    try:
+        queues.get_redis_connection().delete(_get_flush_job_key())
+    except RedisError as e:
+        log.warning(u'Could not clear the index flush job key: %s', e)
+
+    return flush_if_due()
+
+
+def _schedule_flush():
+    u'''
+    Enqueues a flush job at the end of the batch queue if there are datasets
+    left in the buffer, unless there is one already waiting
+    '''
+    if not get_buffer_size() or queues.get_queue(queues.BATCH) is None:
+        return
+
+    try:
+        # The key expires in case the job is lost, an extra flush job is
+        # harmless
+        scheduled = queues.get_redis_connection().set(
+            _get_flush_job_key(), 1, nx=True, ex=max(get_index_debounce(), 1))
+    except RedisError as e:
+        log.warning(u'Could not schedule an index flush job: %s', e)
+        return
+    if not scheduled:
+        return
+
+    t.enqueue_job(
+        flush_job, [], queue=queues.get_queue_name(queues.BATCH))
+
+
+def get_buffer_size():
+    u'''
+    Returns the number of datasets waiting to be reindexed
+    '''
+    try:
+        return queues.get_redis_connection().zcard(_get_buffer_key())
+    except RedisError as e:
+        log.warning(u'Could not get the index buffer size: %s', e)
+        return None
+
+
+def reindex(package_ids):
+    u'''
+    Updates the search index for the provided datasets, committing the
+    changes to the index once at the end. Returns the number of datasets
+    reindexed.
+    '''
+    from ckan import model
+    from ckan.lib.search import rebuild, commit
+
+    # Deleted datasets would stop the whole rebuild
+    package_ids = [row[0] for row in model.Session.query(model.Package.id)
+                   .filter(model.Package.id.in_(package_ids))
+                   .filter(model.Package.state == u'active')]
+    if not package_ids:
+        return 0
+
+    rebuild(package_ids=package_ids, defer_commit=True)
+    commit()
+
+    log.debug(u'%s datasets reindexed after validation', len(package_ids))
+
+    return len(package_ids)
+
+
+def _get_buffer_key():
+    return queues.get_redis_key(u'reindex')
+
+
+def _get_flush_job_key():
+    return queues.get_redis_key(u'reindex', u'flush_job')
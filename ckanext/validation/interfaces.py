@@ -39,3 +39,35 @@ class IDataValidation(Interface):
 
         '''
         return True
+
+    def can_validate_many(self, context, resources):
+        '''
+        Batch version of `can_validate`, called with a list of resource
+        dicts when several resources may need validating at once (eg when a
+        dataset with many resources is created or updated).
+
+        It should return a dict with resource ids as keys and True or False
+        as values. `can_validate` is called for the resources not included
+        in the returned dict, so implementations can answer only for the
+        ones they can check in bulk. Resources that have not been created
+        yet have no id and are always checked with `can_validate`.
+
+        Decisions are stored in the context, so each resource is only
+        checked once per request.
+
+        Here is an example implementation that checks all resources with a
+        single query:
+
+
+        def can_validate_many(self, context, resources):
+
+            excluded = get_excluded_resource_ids(
+                [resource['id'] for resource in resources
+                 if resource.get('id')])
+
+            return dict(
+                (resource['id'], resource['id'] not in excluded)
+                for resource in resources if resource.get('id'))
+
+        '''
+        return {}
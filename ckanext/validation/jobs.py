@@ -2,57 +2,109 @@
 
 import logging
 import datetime
+import hashlib
 import json
+import os
 import re
+from concurrent.futures.process import BrokenProcessPool
 
 import requests
-from sqlalchemy.orm.exc import NoResultFound
+import sqlalchemy as sa
+from rq import get_current_job
 from frictionless import validate, system, Report, Schema, Dialect, Check
 
+from ckan import model
 from ckan.model import Session
+from ckan.lib.dictization.model_dictize import resource_dictize
 import ckan.lib.uploader as uploader
 
 import ckantoolkit as t
 
-from ckanext.validation.model import Validation
-from ckanext.validation.utils import get_update_mode_from_config
+from ckanext.validation.model import (
+    get_validation, upsert_validation, store_validation_errors)
+from ckanext.validation.utils import (
+    get_validation_limits,
+    remove_temp_file,
+    delete_local_uploaded_file,
+    get_resource_signature,
+)
+from ckanext.validation.checks import time_limit, add_time_limit_warning
+from ckanext.validation.cache import get_cached_source
+from ckanext.validation.sessions import get_http_session
+from ckanext.validation.queues import claim_pending_job
+from ckanext.validation.indexing import queue_for_reindex, flush_if_due
+from ckanext.validation.schemas import get_schema, get_schema_descriptor
+from ckanext.validation.sampling import (
+    get_sample_options,
+    sample_source,
+    map_sample_rows,
+    SAMPLE_RECORD_FORMATS,
+)
+from ckanext.validation.parallel import (
+    get_parallel_workers,
+    get_parallel_min_size,
+    download_source,
+    validate_in_chunks,
+    PARALLEL_FORMATS,
+)
 
 
 log = logging.getLogger(__name__)
 
-
-def run_validation_job(resource):
+LIMIT_WARNING_RE = re.compile(r'^reached (error|row|time) limit: (\d+)')
+LIMIT_KEYS = {'error': 'errors', 'row': 'rows', 'time': 'seconds'}
+
+# Merges the status fields into the resource extras, using the primary key
+RESOURCE_STATUS_UPDATE = sa.text('''
+    UPDATE resource
+    SET extras = (
+        COALESCE(NULLIF(extras, ''), '{}')::jsonb || CAST(:status AS jsonb)
+    )::text
+    WHERE id = :id
+    RETURNING package_id
+''')
+
+
+def run_validation_job(resource, revision=None, reject=None, queued=False):
+    u'''
+    Validates a resource and stores the result
+
+    `resource` is the id of the resource to validate, which is loaded when the
+    job starts so the latest version is validated. `revision` is the creation
+    time of the Validation object when the job was enqueued, used to detect
+    jobs superseded by a more recent request. Full resource dicts (as sent by
+    previous versions of the extension or when validating synchronously) are
+    still supported.
+
+    `reject` is set when big uploads are validated asynchronously in sync
+    mode. If the data is invalid, the uploaded file (if `local_upload`) and
+    the resource (if `new_resource`) are deleted, as synchronous validation
+    would have done.
+
+    `queued` is set by `enqueue_job` when the job is run by a worker. Only
+    then the pending job marker is claimed and the status is stored using
+    the reindex buffer, as synchronous validations can also run inside other
+    jobs (eg a harvester creating resources).
+    '''
+    resource_id = resource if isinstance(resource, str) else resource['id']
+
+    job = get_current_job() if queued else None
+    if job and not claim_pending_job(resource_id, job.id):
+        log.debug('Skipping validation job for resource %s, a more recent '
+                  'one was enqueued', resource_id)
+        return
+
+    if isinstance(resource, str):
+        resource = _get_resource_to_validate(resource_id, revision)
+        if not resource:
+            return
 
     log.debug('Validating resource %s', resource['id'])
 
-    try:
-        validation = Session.query(Validation).filter(
-            Validation.resource_id == resource['id']).one()
-    except NoResultFound:
-        validation = None
-
-    if not validation:
-        validation = Validation(resource_id=resource['id'])
-
-    validation.status = 'running'
-    Session.add(validation)
+    validation = upsert_validation(resource['id'], status='running')
     Session.commit()
 
-    options = t.config.get(
-        'ckanext.validation.default_validation_options')
-    if options:
-        options = json.loads(options)
-    else:
-        options = {}
-
-    resource_options = resource.get('validation_options')
-    if resource_options and isinstance(resource_options, str):
-        resource_options = json.loads(resource_options)
-    if resource_options:
-        options.update(resource_options)
-
-    dataset = t.get_action('package_show')(
-        {'ignore_auth': True}, {'id': resource['package_id']})
+    options = _get_validation_options(resource)
 
     source = None
     if resource.get('url_type') == 'upload':
@@ -64,30 +116,126 @@ def run_validation_job(resource):
             # implementation)
             pass_auth_header = t.asbool(
                 t.config.get('ckanext.validation.pass_auth_header', True))
-            if dataset['private'] and pass_auth_header:
-                s = requests.Session()
-                s.headers.update({
+            if pass_auth_header and _is_private(resource['package_id']):
+                options['http_session'] = get_http_session(headers={
                     'Authorization': t.config.get(
                         'ckanext.validation.pass_auth_header_value',
                         _get_site_user_api_key())
                 })
 
-                options['http_session'] = s
-
     if not source:
         source = resource['url']
 
+    # Schema URLs are set by editors, so they are never fetched with the
+    # credentials used for private uploads
     schema = resource.get('schema')
     if schema:
-        if isinstance(schema, str):
-            if schema.startswith('http'):
-                r = requests.get(schema)
-                schema = r.json()
-            schema = json.loads(schema)
+        schema = get_schema_descriptor(schema)
 
     _format = resource['format'].lower()
-    report = _validate_table(source, _format=_format, schema=schema, **options)
 
+    digest = None
+    if t.asbool(t.config.get(
+            'ckanext.validation.reuse_unchanged_reports', True)):
+        digest = _get_digest(source, _format, schema, options)
+
+    previous_report = _get_reusable_report(validation, digest)
+    if previous_report:
+        log.debug('Resource %s has not changed since the last validation, '
+                  'reusing the previous report', resource['id'])
+        report = previous_report
+    else:
+        report = _validate_table(
+            source, _format=_format, schema=schema, **options)
+
+    report = _save_report(validation, resource, report, digest)
+
+    if reject and validation.status == 'failure':
+        if _reject_resource(resource, reject):
+            return
+
+    _store_status_in_resource(
+        resource['id'], _get_resource_status(validation, resource, report),
+        buffered=bool(job))
+
+
+def validate_upload(resource, path):
+    '''
+    Validates the file at `path` with the options and schema of the provided
+    resource dict, and returns the report as a dict
+
+    Used in sync mode to validate uploads from the incoming file, before the
+    resource and the upload are saved.
+    '''
+    options = _get_validation_options(resource)
+
+    schema = resource.get('schema')
+    if schema:
+        schema = get_schema_descriptor(schema)
+
+    report = _validate_table(
+        path, _format=resource['format'].lower(), schema=schema, **options)
+
+    # Hide the temporary file, the report is returned to the user if invalid
+    if type(report) == Report:
+        report = report.to_dict()
+    for table in report.get('tasks', []):
+        if table['place'] == path:
+            table['place'] = resource.get('url') or ''
+
+    return report
+
+
+def store_validation_report(resource, report, source=None):
+    '''
+    Stores the report of a validation performed outside of a validation job
+    (see `validate_upload`) for the provided resource dict, as if it was
+    validated by a job
+
+    `resource` must be the saved resource, so the signature stored matches
+    the one computed when the dataset is updated. `source` is the path of the saved
+    file, used to compute the digest of the data.
+    '''
+    digest = None
+    if source and t.asbool(t.config.get(
+            'ckanext.validation.reuse_unchanged_reports', True)):
+        schema = resource.get('schema')
+        if schema:
+            schema = get_schema_descriptor(schema)
+        digest = _get_digest(
+            source, (resource.get('format') or '').lower(), schema,
+            _get_validation_options(resource))
+
+    validation = upsert_validation(resource['id'], status='running')
+
+    report = _save_report(validation, resource, report, digest)
+
+    _store_status_in_resource(
+        resource['id'], _get_resource_status(validation, resource, report))
+
+
+def _get_validation_options(resource):
+    options = t.config.get(
+        'ckanext.validation.default_validation_options')
+    if options:
+        options = json.loads(options)
+    else:
+        options = {}
+
+    resource_options = resource.get('validation_options')
+    if resource_options and isinstance(resource_options, str):
+        resource_options = json.loads(resource_options)
+    if resource_options:
+        options.update(resource_options)
+
+    return options
+
+
+def _save_report(validation, resource, report, digest=None):
+    '''
+    Updates the Validation object with the outcome of the provided report,
+    stores its errors and commits. Returns the report as a dict.
+    '''
     # Hide uploaded files
     if type(report) == Report:
         report = report.to_dict()
@@ -103,8 +251,14 @@ def run_validation_job(resource):
     if 'valid' in report:
         validation.status = 'success' if report['valid'] else 'failure'
         validation.report = json.dumps(report)
+        validation.digest = digest
+        # Only stored once the resource has been validated, so unchanged
+        # resources are not skipped if the validation did not finish
+        validation.signature = get_resource_signature(resource)
     else:
         validation.report = json.dumps(report)
+        validation.digest = None
+        validation.signature = None
         if 'errors' in report and report['errors']: 
             validation.status = 'error'
             validation.error = {
@@ -114,56 +268,365 @@ def run_validation_job(resource):
     validation.finished = datetime.datetime.utcnow()
 
     Session.add(validation)
+    store_validation_errors(
+        resource['id'], resource.get('package_id'), report)
     Session.commit()
 
-    # Store result status in resource
-    data_dict = {
-        'id': resource['id'],
+    return report
+
+
+def _get_resource_status(validation, resource, report):
+    status = {
         'validation_status': validation.status,
         'validation_timestamp': validation.finished.isoformat(),
     }
 
-    if get_update_mode_from_config() == 'sync':
-        data_dict['_skip_next_validation'] = True,
+    if report.get('sample') or resource.get('validation_sampled'):
+        status['validation_sampled'] = bool(report.get('sample'))
 
-    patch_context = {
-        'ignore_auth': True,
-        'user': t.get_action('get_site_user')({'ignore_auth': True})['name'],
-        '_validation_performed': True
+    return status
+
+
+def _get_digest(source, _format, schema, options):
+    '''
+    Returns a hash of the source contents, schema and validation options,
+    including the site wide limits and sampling settings, so reports are not
+    reused after they change
+
+    For local files the actual contents are hashed. For remote files the
+    ETag and Last-Modified headers are used, as returned by a HEAD request.
+    If the source can not be fingerprinted None is returned, so the source
+    is always validated.
+    '''
+    try:
+        if source.startswith('http'):
+            fingerprint = _get_remote_fingerprint(
+                source, options.get('http_session'))
+        else:
+            fingerprint = _get_file_hash(source)
+    except (IOError, requests.RequestException) as e:
+        log.debug('Could not get fingerprint for source %s: %s', source, e)
+        fingerprint = None
+
+    if not fingerprint:
+        return None
+
+    descriptor = {
+        'source': fingerprint,
+        'format': _format,
+        'schema': schema,
+        'options': {
+            key: value for key, value in options.items()
+            if key != 'http_session'},
+        'sample': get_sample_options(options.get('sample')),
+        'limits': get_validation_limits(_format),
     }
-    t.get_action('resource_patch')(patch_context, data_dict)
 
+    return hashlib.sha256(
+        json.dumps(descriptor, sort_keys=True, default=str).encode('utf8')
+    ).hexdigest()
+
+
+def _get_file_hash(path):
+
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            file_hash.update(chunk)
+
+    return file_hash.hexdigest()
+
+
+def _get_remote_fingerprint(url, http_session=None):
+
+    http_session = http_session or get_http_session()
+
+    response = http_session.head(url, allow_redirects=True)
+    response.raise_for_status()
+
+    etag = response.headers.get('ETag')
+    last_modified = response.headers.get('Last-Modified')
+    if not etag and not last_modified:
+        return None
+
+    return '{}|{}|{}|{}'.format(
+        response.url, etag, last_modified,
+        response.headers.get('Content-Length'))
+
+
+def _get_reusable_report(validation, digest):
+    '''
+    Returns the previous validation report if it was generated from the
+    same source contents, schema and options
+    '''
+    if not digest or validation.digest != digest or not validation.report:
+        return None
+
+    report = validation.report
+    if isinstance(report, str):
+        report = json.loads(report)
+
+    if 'valid' not in report:
+        return None
+
+    return report
+
+
+def _is_private(package_id):
+
+    package = model.Package.get(package_id)
+
+    return bool(package and package.private)
 
 
+def _store_status_in_resource(resource_id, status, buffered=False):
+    '''
+    Stores the validation status fields in the resource extras
+
+    The resource is updated directly instead of calling `resource_patch`,
+    which would validate and save the whole dataset again. When `buffered`,
+    the extras are updated with a single SQL statement and the dataset is
+    added to the reindex buffer, so datasets with many resources validated
+    in a row are only reindexed once. Otherwise (ie when validating
+    synchronously, as part of the request updating the resource) the
+    dataset is reindexed when the changes are committed.
+    '''
+    if buffered:
+        package_id = Session.execute(
+            RESOURCE_STATUS_UPDATE,
+            {'id': resource_id, 'status': json.dumps(status)}).scalar()
+        Session.commit()
+        if package_id:
+            queue_for_reindex(package_id)
+            flush_if_due()
+        return
+
+    resource = model.Resource.get(resource_id)
+    if not resource:
+        return
+
+    extras = dict(resource.extras or {})
+    extras.update(status)
+    resource.extras = extras
+
+    Session.commit()
+
+
+def _reject_resource(resource, reject):
+    '''
+    Deletes the uploaded file and the resource (if it was a new one) of a
+    resource that failed validation. Returns True if the resource was deleted.
+    '''
+    log.info('Resource %s failed validation, rejecting it', resource['id'])
+
+    if reject.get('local_upload'):
+        delete_local_uploaded_file(resource['id'])
+
+    if not reject.get('new_resource'):
+        return False
+
+    context = {'ignore_auth': True, 'user': None}
+    t.get_action('resource_validation_delete')(
+        dict(context), {'resource_id': resource['id']})
+    t.get_action('resource_delete')(dict(context), {'id': resource['id']})
+
+    return True
+
+
+def _get_resource_to_validate(resource_id, revision=None):
+    u'''
+    Returns the current version of the resource, or None if it was deleted or
+    a more recent validation was requested since the job was enqueued
+    '''
+    if revision:
+        validation = get_validation(resource_id)
+        if not validation or not validation.created or \
+                validation.created.isoformat() != revision:
+            log.debug('Skipping validation job for resource %s, a more '
+                      'recent validation was requested', resource_id)
+            return None
+
+    # The resource is dictized directly, as `resource_show` would dictize
+    # the whole dataset
+    resource = model.Resource.get(resource_id)
+    if not resource or resource.state != 'active' or \
+            not resource.package or resource.package.state != 'active':
+        log.debug('Skipping validation job for resource %s, it no longer '
+                  'exists', resource_id)
+        return None
+
+    return resource_dictize(resource, {'model': model, 'session': Session})
+
 
 def _validate_table(source, _format='csv', schema=None, **options):
 
     # This option is needed to allow Frictionless Framework to validate absolute paths
     frictionless_context = { 'trusted': True }
-    http_session = options.pop('http_session', None) or requests.Session()
-    use_proxy = 'ckan.download_proxy' in t.config
+    http_session = options.pop('http_session', None) or get_http_session()
+    frictionless_context['http_session'] = http_session
+    resource_schema = None
+    if schema:
+        # Some detector options (eg `schema_sync`) modify the schema in place
+        # so the shared cached instance can not be used
+        resource_schema = (
+            Schema.from_descriptor(schema) if 'detector' in options
+            else get_schema(schema))
+
+    # Validate a local copy of remote files if the download cache is enabled
+    if source.startswith('http'):
+        source = get_cached_source(source, http_session) or source
+
+    # Validate only a sample of the rows if requested
+    sample = get_sample_options(options.pop('sample', None))
+    workers = get_parallel_workers(options.pop('parallel', None))
+    sample_info = None
+    row_map = None
+    tmp_paths = []
+    if sample:
+        if (sample['mode'] != 'head'
+                and _format not in SAMPLE_RECORD_FORMATS):
+            log.warning(
+                'Sample mode "%s" not supported for format %s, using "head"',
+                sample['mode'], _format)
+            sample['mode'] = 'head'
+
+        if sample['mode'] == 'head':
+            options['limit_rows'] = sample['rows']
+            sample_info = {'mode': 'head', 'rows': sample['rows']}
+        else:
+            try:
+                sample_path, sample_info, row_map = sample_source(
+                    source, sample, _format=_format,
+                    http_session=http_session,
+                    dialect=options.get('dialect'))
+            except (IOError, requests.RequestException) as e:
+                return _get_source_error_report(source, e)
+            tmp_paths.append(sample_path)
+            source = sample_path
+
+    # Stop early once the error, row or time limits are reached. Limits set
+    # in the resource validation options take precedence
+    limits = get_validation_limits(_format)
+    limit_seconds = options.pop('limit_seconds', None) or limits.pop(
+        'limit_seconds', None)
+    for key, value in limits.items():
+        options.setdefault(key, value)
+
+    try:
+        # Split big files in chunks validated in parallel if requested
+        if (workers > 1 and not sample and _format in PARALLEL_FORMATS
+                and not options.get('limit_rows')):
+            try:
+                if source.startswith('http'):
+                    source = download_source(source, http_session, _format)
+                    tmp_paths.append(source)
+                if os.path.getsize(source) >= get_parallel_min_size():
+                    report = validate_in_chunks(
+                        source, workers, _format=_format, schema=schema,
+                        limit_seconds=limit_seconds, **options)
+                    return _add_limits_info(report, sample_info)
+            except (IOError, requests.RequestException,
+                    BrokenProcessPool) as e:
+                return _get_source_error_report(source, e)
+
+        # Load the Resource Dialect as described in https://framework.frictionlessdata.io/docs/framework/dialect.html
+        if 'dialect' in options:
+            dialect = Dialect.from_descriptor(options['dialect'])
+            options['dialect'] = dialect
+
+        # Load the list of checks and its parameters declaratively as in https://framework.frictionlessdata.io/docs/checks/table.html
+        if 'checks' in options:
+            checklist = [Check.from_descriptor(c) for c in options['checks']]
+            options['checks'] = checklist
+
+        if limit_seconds:
+            time_check = time_limit(seconds=limit_seconds)
+            options['checks'] = list(options.get('checks') or []) + [time_check]
+
+        with system.use_context(**frictionless_context):
+            report = validate(source, format=_format, schema=resource_schema, **options)
+            log.debug('Validating source: %s', source)
+    finally:
+        for path in tmp_paths:
+            remove_temp_file(path)
+
+    if limit_seconds and time_check.reached:
+        report = add_time_limit_warning(report.to_dict(), limit_seconds)
+
+    if sample_info:
+        report = _add_sample_info(report, sample_info)
+
+    # Errors of `reservoir` and `block` samples point to the original rows
+    if row_map:
+        if type(report) == Report:
+            report = report.to_dict()
+        report = map_sample_rows(report, row_map)
+
+    return _add_limits_info(report, sample_info)
+
+
+def _get_source_error_report(source, error):
+    '''
+    Returns an error report for sources that could not be read (eg a remote
+    file that could not be downloaded), which is stored with an `error`
+    status
+    '''
+    log.warning('Could not read source %s: %s', source, error)
+
+    return {'errors': ['Could not read the source: {}'.format(error)]}
+
+
+def _add_limits_info(report, sample_info=None):
+    '''
+    Record in the report which limits stopped the validation before the end
+    of the source, eg `{"rows": 1000}`
+
+    The row limit used to validate a `head` sample is not considered a
+    truncation, as it is already recorded as such.
+    '''
+    if type(report) == Report:
+        report = report.to_dict()
 
-    if use_proxy:
-        proxy = t.config.get('ckan.download_proxy')
-        log.debug('Download resource for validation via proxy: %s', proxy)
-        http_session.proxies.update({'http': proxy, 'https': proxy})
+    truncated = {}
+    for task in report.get('tasks') or []:
+        for warning in task.get('warnings', []):
+            match = LIMIT_WARNING_RE.match(warning)
+            if not match:
+                continue
+            reason = match.group(1)
+            if (reason == 'row' and sample_info
+                    and sample_info['mode'] == 'head'):
+                continue
+            truncated[LIMIT_KEYS[reason]] = int(match.group(2))
+
+    if truncated:
+        report['truncated'] = truncated
 
-    frictionless_context['http_session'] = http_session
-    resource_schema = Schema.from_descriptor(schema) if schema else None
+    return report
 
-    # Load the Resource Dialect as described in https://framework.frictionlessdata.io/docs/framework/dialect.html
-    if 'dialect' in options:
-        dialect = Dialect.from_descriptor(options['dialect'])
-        options['dialect'] = dialect
 
-    # Load the list of checks and its parameters declaratively as in https://framework.frictionlessdata.io/docs/checks/table.html
-    if 'checks' in options:
-        checklist = [Check.from_descriptor(c) for c in options['checks']]
-        options['checks'] = checklist
+def _add_sample_info(report, sample_info):
+    '''
+    Record in the report that only a sample of the rows was validated
+
+    If the whole source ended up being validated (eg it had less rows than
+    the sample size) the report is returned untouched.
+    '''
+    if type(report) == Report:
+        report = report.to_dict()
 
-    with system.use_context(**frictionless_context):
-        report = validate(source, format=_format, schema=resource_schema, **options)
-        log.debug('Validating source: %s', source)
+    if sample_info['mode'] == 'head':
+        tasks = report.get('tasks') or []
+        reached_limit = any(
+            warning.startswith('reached row limit')
+            for task in tasks for warning in task.get('warnings', []))
+        if not reached_limit:
+            return report
+        sample_info['rate'] = None
+    elif sample_info['rate'] >= 1:
+        return report
+
+    report['sample'] = sample_info
 
     return report
 
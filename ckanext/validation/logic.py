@@ -1,39 +1,190 @@
 # encoding: utf-8
 
+import collections
+import contextlib
 import datetime
 import logging
 import json
+import os
+import shutil
+import tempfile
+import threading
+import time
 
-from sqlalchemy.orm.exc import NoResultFound
+import sqlalchemy as sa
 
+from ckan.model import Session
 import ckan.plugins as plugins
 import ckan.lib.uploader as uploader
+from ckan.lib.dictization.model_dictize import resource_dictize
 
 import ckantoolkit as t
 
-from ckanext.validation.model import Validation
+from ckanext.validation.model import (
+    get_validation, upsert_validation, upsert_validations,
+    store_validation_errors, Validation, ValidationErrorRecord)
 from ckanext.validation.interfaces import IDataValidation
-from ckanext.validation.jobs import run_validation_job
-from ckanext.validation import settings
+from ckanext.validation.jobs import (
+    run_validation_job, validate_upload, store_validation_report)
+from ckanext.validation import settings, queues, indexing
 from ckanext.validation.utils import (
     get_create_mode_from_config,
     get_update_mode_from_config,
     delete_local_uploaded_file,
+    get_sync_limits,
+    count_lines,
+    get_update_markers,
+    get_resource_signature,
 )
 
 
 log = logging.getLogger(__name__)
 
+# Formats for which rows can be counted cheaply to decide if a resource can be
+# validated synchronously
+ROW_COUNT_FORMATS = [u'csv', u'tsv']
 
-def enqueue_job(*args, **kwargs):
+DEFAULT_REPORT_PAGE_SIZE = 100
+MAX_REPORT_PAGE_SIZE = 1000
+
+# Number of decoded reports kept in memory by each process, so paging through
+# a report does not decompress and parse it on every request
+DEFAULT_REPORT_CACHE_SIZE = 10
+
+_report_cache = collections.OrderedDict()
+_report_cache_lock = threading.Lock()
+
+
+# Keyword arguments of the validation jobs, so they know they are running
+# from the queue rather than synchronously (see `run_validation_job`)
+JOB_KWARGS = {u'queued': True}
+
+
+def enqueue_job(fn, args, job_class=queues.INTERACTIVE, job_id=None):
+    u'''
+    Enqueues a job on the queue configured for the provided class of
+    validation jobs (see `ckanext.validation.queues`), optionally with the
+    provided `job_id`
+    '''
+    queue = queues.get_queue_name(job_class)
+    rq_kwargs = queues.get_rq_kwargs(job_class)
+    if job_id:
+        rq_kwargs[u'job_id'] = job_id
     try:
-        return t.enqueue_job(*args, **kwargs)
+        return t.enqueue_job(
+            fn, args, kwargs=JOB_KWARGS, queue=queue, rq_kwargs=rq_kwargs)
     except AttributeError:
+        # ckanext-rq does not support keyword arguments, jobs run as if
+        # they were synchronous
         from ckanext.rq.jobs import enqueue as enqueue_job_legacy
-        return enqueue_job_legacy(*args, **kwargs)
+        return enqueue_job_legacy(fn, args, queue=queue)
+
+
+def enqueue_jobs(fn, args_list, job_class=queues.BATCH, job_ids=None):
+    u'''
+    Enqueues a job for each of the provided lists of arguments, optionally
+    with the provided `job_ids`
+
+    Jobs are sent to Redis in a single pipeline if the installed version of
+    RQ supports it (1.9 onwards), otherwise they are enqueued one by one.
+    Returns the list of jobs.
+    '''
+    queue = queues.get_queue(job_class)
+    job_ids = job_ids or [None] * len(args_list)
+
+    if queue is None or not hasattr(queue, u'enqueue_many'):
+        return [
+            enqueue_job(fn, args, job_class=job_class, job_id=job_id)
+            for args, job_id in zip(args_list, job_ids)]
+
+    timeout = t.asint(t.config.get(u'ckan.jobs.timeout', 180))
+    rq_kwargs = queues.get_rq_kwargs(job_class)
+    return queue.enqueue_many([
+        queue.prepare_data(
+            fn, args=args, kwargs=JOB_KWARGS, timeout=timeout,
+            job_id=job_id, **rq_kwargs)
+        for args, job_id in zip(args_list, job_ids)])
 
 
-# Auth
+def can_validate_resources(context, resources):
+    u'''
+    Returns a list with whether each of the provided resources can be
+    validated according to the IDataValidation plugins
+
+    Each plugin is asked once for all the resources with
+    `can_validate_many`, falling back to `can_validate` for the ones it did
+    not answer. Decisions are memoized in the context by resource id, so
+    resources are only checked once per request.
+    '''
+    memo = context.setdefault(u'_validation_decisions', {})
+
+    decisions = []
+    pending = []
+    for index, resource in enumerate(resources):
+        if resource.get(u'id') in memo:
+            decisions.append(memo[resource[u'id']])
+        else:
+            decisions.append(True)
+            pending.append(index)
+
+    if pending:
+        for plugin in plugins.PluginImplementations(IDataValidation):
+            answers = plugin.can_validate_many(
+                context, [resources[index] for index in pending]) or {}
+            for index in pending:
+                if not decisions[index]:
+                    continue
+                resource = resources[index]
+                decision = answers.get(resource.get(u'id'))
+                if decision is None:
+                    decision = plugin.can_validate(context, resource)
+                decisions[index] = bool(decision)
+
+        for index in pending:
+            resource = resources[index]
+            if resource.get(u'id'):
+                memo[resource[u'id']] = decisions[index]
+            if not decisions[index]:
+                log.debug(u'Skipping validation for resource %s',
+                          resource.get(u'id', resource.get(u'url')))
+
+    return decisions
+
+
+def enqueue_validations(resource_ids, job_class=queues.BATCH, session=None):
+    u'''
+    Starts validation jobs for the provided resources, resetting their
+    Validation objects in a single statement and sending the jobs to the
+    queue in a single pipeline
+
+    The resources are not checked, callers must make sure they can be
+    validated. Returns the list of jobs.
+    '''
+    session = session or Session
+
+    # The previous reports and digests are kept, see
+    # `resource_validation_run`
+    created = datetime.datetime.utcnow()
+    upsert_validations(
+        resource_ids,
+        session=session,
+        finished=None,
+        error=None,
+        created=created,
+        status=u'created',
+    )
+    session.commit()
+
+    # The pending markers are written before enqueuing the jobs, so workers
+    # picking them up straight away find them
+    job_ids = [queues.new_job_id() for resource_id in resource_ids]
+    queues.set_pending_jobs(dict(zip(resource_ids, job_ids)))
+
+    return enqueue_jobs(
+        run_validation_job,
+        [[resource_id, created.isoformat()] for resource_id in resource_ids],
+        job_class=job_class, job_ids=job_ids)
+
 
 def auth_resource_validation_run(context, data_dict):
     if t.check_access(
@@ -57,11 +208,26 @@ def auth_resource_validation_show(context, data_dict):
     return {u'success': False}
 
 
+@t.auth_allow_anonymous_access
+def auth_resource_validation_report(context, data_dict):
+    return auth_resource_validation_show(context, data_dict)
+
+
 def auth_resource_validation_run_batch(context, data_dict):
     '''u Sysadmins only'''
     return {u'success': False}
 
 
+def auth_resource_validation_error_search(context, data_dict):
+    u'''Sysadmins only'''
+    return {u'success': False}
+
+
+def auth_resource_validation_stats(context, data_dict):
+    u'''Sysadmins only'''
+    return {u'success': False}
+
+
 # Actions
 
 
@@ -91,6 +257,49 @@ def resource_validation_run(context, data_dict):
     # TODO: limit to sysadmins
     async_job = data_dict.get(u'async', True)
 
+    _check_resource_can_be_validated(resource)
+
+    # Check if there was an existing validation for the resource
+
+    Session = context['model'].Session
+
+    # Reset values if it exists. The previous report and its digest are kept
+    # so the job can reuse them if the resource has not changed
+    created = datetime.datetime.utcnow()
+    upsert_validation(
+        resource['id'],
+        session=Session,
+        finished=None,
+        error=None,
+        created=created,
+        status=u'created',
+    )
+    Session.commit()
+
+    if async_job:
+        # Only the id is sent, the job gets the current version of the
+        # resource when it starts. The creation time of the validation is
+        # used to detect jobs superseded by a more recent request.
+        args = [resource['id'], created.isoformat()]
+        if context.get(u'validation_reject'):
+            # Set when validating big uploads asynchronously in sync mode
+            args.append(context[u'validation_reject'])
+        # Replace any job still waiting for this resource. The marker is
+        # written first, so a worker picking up the job straight away finds
+        # it.
+        job_id = queues.new_job_id()
+        queues.set_pending_jobs({resource['id']: job_id})
+        enqueue_job(
+            run_validation_job, args,
+            job_class=context.get(
+                u'validation_job_class', queues.INTERACTIVE),
+            job_id=job_id)
+    else:
+        run_validation_job(resource)
+
+
+def _check_resource_can_be_validated(resource):
+
     # Ensure format is supported
     if not resource.get(u'format', u'').lower() in settings.SUPPORTED_FORMATS:
         raise t.ValidationError(
@@ -103,34 +312,6 @@ def resource_validation_run(context, data_dict):
         raise t.ValidationError(
             {u'url': u'Resource must have a valid URL or an uploaded file'})
 
-    # Check if there was an existing validation for the resource
-
-    Session = context['model'].Session
-
-    try:
-        validation = Session.query(Validation).filter(
-            Validation.resource_id == data_dict['resource_id']).one()
-    except NoResultFound:
-        validation = None
-
-    if validation:
-        # Reset values
-        validation.finished = None
-        validation.report = None
-        validation.error = None
-        validation.created = datetime.datetime.utcnow()
-        validation.status = u'created'
-    else:
-        validation = Validation(resource_id=resource['id'])
-
-    Session.add(validation)
-    Session.commit()
-
-    if async_job:
-        enqueue_job(run_validation_job, [resource])
-    else:
-        run_validation_job(resource)
-
 
 @t.side_effect_free
 def resource_validation_show(context, data_dict):
@@ -148,8 +329,19 @@ def resource_validation_show(context, data_dict):
     * `success`: Validation was performed, and no issues were found
     * `failure`: Validation was performed, and there were issues found
 
+    If only a sample of the rows was validated, `sample` will contain the
+    sampling mode, the number of rows validated and the sampling rate.
+    If the validation was stopped early because of the configured limits,
+    `truncated` will contain the limits reached, eg `{"seconds": 300}`.
+
+    A summary of the report is available in the `valid`, `error_count`,
+    `row_count` and `duration` keys. The full report can be big, so it can be
+    left out with `include_report=False`.
+
     :param resource_id: id of the resource to validate
     :type resource_id: string
+    :param include_report: whether to include the full report (default True)
+    :type include_report: bool
 
     :rtype: dict
 
@@ -162,17 +354,184 @@ def resource_validation_show(context, data_dict):
 
     Session = context['model'].Session
 
-    try:
-        validation = Session.query(Validation).filter(
-            Validation.resource_id == data_dict['resource_id']).one()
-    except NoResultFound:
-        validation = None
+    validation = get_validation(data_dict['resource_id'], session=Session)
+
+    if not validation:
+        raise t.ObjectNotFound(
+            'No validation report exists for this resource')
+
+    return _validation_dictize(
+        validation,
+        include_report=t.asbool(data_dict.get(u'include_report', True)))
+
+
+@t.side_effect_free
+def resource_validation_report(context, data_dict):
+    u'''
+    Returns the errors of the validation report of a resource in pages,
+    optionally filtered by table, error type or field, so big reports don't
+    need to be sent and rendered all at once.
+
+    The errors are returned in the order they appear in the report, with the
+    index of the table they belong to in the ``task`` key. ``count`` is the
+    total number of errors matching the filters.
+
+    Unless ``include_summary`` is false, a ``summary`` is returned as well,
+    with the fields returned by ``resource_validation_show`` (without the
+    report), the report ``stats``, ``warnings`` and general errors
+    (``report_errors``) and, for each table, its place, stats and the
+    number of errors of each type (``error_codes``) and the fields with
+    errors (``fields``), to build the filters.
+
+    :param resource_id: id of the resource
+    :type resource_id: string
+    :param task: only return errors of the table with this index (optional)
+    :type task: int
+    :param code: only return errors of this type, eg ``type-error``
+        (optional)
+    :type code: string
+    :param field: only return errors of the field with this name (optional)
+    :type field: string
+    :param offset: number of errors to skip (optional, defaults to 0)
+    :type offset: int
+    :param limit: number of errors to return (optional, defaults to 100,
+        maximum 1000)
+    :type limit: int
+    :param include_summary: whether to include the summary (optional,
+        defaults to True)
+    :type include_summary: bool
+
+    :rtype: dict
+    '''
+
+    t.check_access(u'resource_validation_report', context, data_dict)
+
+    if not data_dict.get(u'resource_id'):
+        raise t.ValidationError({u'resource_id': u'Missing value'})
+
+    params = {}
+    for key, default in ((u'offset', 0),
+                         (u'limit', DEFAULT_REPORT_PAGE_SIZE),
+                         (u'task', None)):
+        value = data_dict.get(key)
+        if value in (None, u''):
+            params[key] = default
+            continue
+        try:
+            params[key] = t.asint(value)
+        except ValueError:
+            raise t.ValidationError({key: u'Must be a number'})
+    limit = max(0, min(params[u'limit'], MAX_REPORT_PAGE_SIZE))
+    offset = max(0, params[u'offset'])
+
+    Session = context['model'].Session
+
+    validation = get_validation(data_dict['resource_id'], session=Session)
 
     if not validation:
         raise t.ObjectNotFound(
             'No validation report exists for this resource')
 
-    return _validation_dictize(validation)
+    report, tasks = _get_decoded_report(validation)
+
+    errors = [
+        error for error in _iter_report_errors(report, params[u'task'])
+        if (not data_dict.get(u'code') or
+            _get_error_code(error) == data_dict[u'code'])
+        and (not data_dict.get(u'field') or
+             error.get(u'fieldName') == data_dict[u'field'])]
+
+    out = {
+        u'count': len(errors),
+        u'offset': offset,
+        u'limit': limit,
+        u'errors': errors[offset:offset + limit],
+    }
+
+    if t.asbool(data_dict.get(u'include_summary', True)):
+        out[u'summary'] = _get_report_summary(validation, report, tasks)
+
+    return out
+
+
+def _get_decoded_report(validation):
+    u'''
+    Returns the report of the provided Validation object as a dict, along
+    with the summary of its tables, from the cache of decoded reports if
+    possible
+
+    Cached reports are keyed by the validation and the time it finished, so
+    they are not used after the resource is validated again.
+    '''
+    key = (validation.id, validation.finished)
+    with _report_cache_lock:
+        if key in _report_cache:
+            _report_cache.move_to_end(key)
+            return _report_cache[key]
+
+    report = validation.report or {}
+    if isinstance(report, str):
+        report = json.loads(report)
+    decoded = (report, _get_tasks_summary(report))
+
+    size = t.asint(t.config.get(
+        u'ckanext.validation.report_cache_size', DEFAULT_REPORT_CACHE_SIZE))
+    if size > 0 and validation.finished:
+        with _report_cache_lock:
+            _report_cache[key] = decoded
+            while len(_report_cache) > size:
+                _report_cache.popitem(last=False)
+
+    return decoded
+
+
+def _iter_report_errors(report, task=None):
+
+    for index, table in enumerate(report.get(u'tasks') or []):
+        if task is not None and index != task:
+            continue
+        for error in table.get(u'errors') or []:
+            yield dict(error, task=index)
+
+
+def _get_error_code(error):
+    # Reports generated by goodtables use `code` instead of `type`
+    return error.get(u'type') or error.get(u'code')
+
+
+def _get_tasks_summary(report):
+
+    tasks = []
+    for index, table in enumerate(report.get(u'tasks') or []):
+        errors = table.get(u'errors') or []
+        tasks.append({
+            u'index': index,
+            u'name': table.get(u'name'),
+            u'place': table.get(u'place'),
+            u'valid': table.get(u'valid'),
+            u'stats': table.get(u'stats'),
+            u'warnings': table.get(u'warnings') or [],
+            u'error_codes': dict(collections.Counter(
+                _get_error_code(error) for error in errors)),
+            u'fields': sorted(set(
+                error[u'fieldName'] for error in errors
+                if error.get(u'fieldName'))),
+        })
+
+    return tasks
+
+
+def _get_report_summary(validation, report, tasks):
+
+    summary = _validation_dictize(validation, include_report=False)
+    summary.update({
+        u'stats': report.get(u'stats'),
+        u'warnings': report.get(u'warnings') or [],
+        u'report_errors': report.get(u'errors') or [],
+        u'tasks': [dict(task) for task in tasks],
+    })
+
+    return summary
 
 
 def resource_validation_delete(context, data_dict):
@@ -194,17 +553,15 @@ def resource_validation_delete(context, data_dict):
 
     Session = context['model'].Session
 
-    try:
-        validation = Session.query(Validation).filter(
-            Validation.resource_id == data_dict['resource_id']).one()
-    except NoResultFound:
-        validation = None
+    validation = get_validation(data_dict['resource_id'], session=Session)
 
     if not validation:
         raise t.ObjectNotFound(
             'No validation report exists for this resource')
 
     Session.delete(validation)
+    store_validation_errors(
+        data_dict['resource_id'], None, None, session=Session)
     Session.commit()
 
 
@@ -248,6 +605,20 @@ def resource_validation_run_batch(context, data_dict):
         the resource formats to target your Not to be used with
         ``dataset_ids``.
     :type query: dict
+    :param only_stale: Only validate the resources that have not been
+        validated yet, whose last validation errored or that have been
+        modified since they were last validated (optional, defaults to
+        False)
+    :type only_stale: bool
+    :param older_than: Only validate the resources that have not been
+        validated in the last ``older_than`` days. If used with
+        ``only_stale``, resources matching either condition are validated
+        (optional)
+    :type older_than: int
+
+    When called from the command line (with ``throttle_batch`` in the
+    context), datasets are enqueued while the batch queue is not full, see
+    ``ckanext.validation.batch_max_queued``.
 
     :rtype: string
 
@@ -257,9 +628,9 @@ def resource_validation_run_batch(context, data_dict):
 
     t.check_access(u'resource_validation_run_batch', context, data_dict)
 
-    page = 1
     page_size = 100
     count_resources = 0
+    timer = time.time()
 
     dataset_ids = data_dict.get('dataset_ids')
     if isinstance(dataset_ids, str):
@@ -276,62 +647,278 @@ def resource_validation_run_batch(context, data_dict):
             msg = 'Error parsing search parameters'.format(search_params)
             return {'output': msg}
 
+    only_stale = t.asbool(data_dict.get('only_stale', False))
+    older_than = data_dict.get('older_than')
+    if older_than not in (None, ''):
+        try:
+            older_than = t.asint(older_than)
+        except ValueError:
+            raise t.ValidationError(
+                {u'older_than': u'Must be a number of days'})
+    else:
+        older_than = None
+
+    model = context['model']
+    Session = model.Session
+
+    # Datasets are paged by id, which is faster than using offsets
+    last_id = None
     while True:
 
         query = _search_datasets(
-            page, page_size=page_size,
+            page_size=page_size,
             dataset_ids=dataset_ids,
-            search_params=search_params)
+            search_params=search_params,
+            after_id=last_id)
 
-        if page == 1 and query['count'] == 0:
+        if last_id is None and query['count'] == 0:
             msg = 'No suitable datasets for validation'
             return {'output': msg}
 
-        if query['results']:
-            for dataset in query['results']:
+        if not query['results']:
+            break
 
-                if not dataset.get('resources'):
+        resources = []
+        for dataset in query['results']:
+
+            for resource in dataset.get('resources') or []:
+
+                if (not resource.get(u'format', u'').lower()
+                        in settings.SUPPORTED_FORMATS):
                     continue
 
-                for resource in dataset['resources']:
+                try:
+                    _check_resource_can_be_validated(resource)
+                except t.ValidationError as e:
+                    log.warning(
+                        u'Could not run validation for resource %s ' +
+                        u'from dataset %s: %s',
+                            resource['id'], dataset['name'], e)
+                    continue
 
-                    if (not resource.get(u'format', u'').lower()
-                            in settings.SUPPORTED_FORMATS):
-                        continue
+                resources.append(resource)
 
-                    try:
-                        t.get_action(u'resource_validation_run')(
-                            {u'ignore_auth': True},
-                            {u'resource_id': resource['id'],
-                             u'async': True})
+        if resources and (only_stale or older_than is not None):
+            resource_ids = _get_stale_resource_ids(
+                model, resources, only_stale=only_stale,
+                older_than=older_than)
+            resources = [
+                resource for resource in resources
+                if resource['id'] in resource_ids]
 
-                        count_resources += 1
+        if resources:
+            # Wait for the workers to catch up if there are too many jobs
+            # already queued. Only done for command line runs, API requests
+            # should not block a web worker.
+            if context.get(u'throttle_batch'):
+                queues.wait_for_batch_queue()
 
-                    except t.ValidationError as e:
-                        log.warning(
-                            u'Could not run validation for resource %s ' +
-                            u'from dataset %s: %s',
-                                resource['id'], dataset['name'], e)
+            enqueue_validations(
+                [resource['id'] for resource in resources], session=Session)
 
-            if len(query['results']) < page_size:
-                break
+            count_resources += len(resources)
 
-            page += 1
-        else:
+        if len(query['results']) < page_size:
             break
 
-    msg = 'Done. {} resources sent to the validation queue'.format(
-        count_resources)
+        last_id = query['results'][-1]['id']
+
+    seconds = time.time() - timer
+    msg = ('Done. {} resources sent to the validation queue '
+           '({:.1f} resources/s)').format(
+        count_resources, count_resources / seconds if seconds else 0)
     log.info(msg)
     return {'output': msg}
 
 
+@t.side_effect_free
+def resource_validation_error_search(context, data_dict):
+    u'''
+    Search the errors found on the last validation of the site resources
+
+    Only the first errors of each type are stored for each resource (100 by
+    default, see `ckanext.validation.errors_per_code`). Results are sorted
+    by resource and row number.
+
+    Only sysadmins are allowed to run this action.
+
+    Example::
+
+       curl "http://localhost:5001/api/action/resource_validation_error_search?code=type-error&field=date" \
+            -H Authorization:API_KEY
+
+    :param code: type of the error, eg ``type-error``
+    :type code: string
+    :param field: name of the field (column) where the error was found
+    :type field: string
+    :param organization: id or name of the organization the datasets
+        belong to
+    :type organization: string
+    :param package_id: id of a particular dataset
+    :type package_id: string
+    :param resource_id: id of a particular resource
+    :type resource_id: string
+    :param limit: maximum number of errors to return (default 100, maximum
+        1000)
+    :type limit: int
+    :param offset: number of errors to skip, for paging (default 0)
+    :type offset: int
+
+    :rtype: dict with a ``count`` of the total errors found and the list
+        of ``results``
+
+    '''
+
+    t.check_access(u'resource_validation_error_search', context, data_dict)
+
+    model = context['model']
+    Session = model.Session
+
+    try:
+        limit = min(t.asint(data_dict.get(u'limit', 100)), 1000)
+        offset = t.asint(data_dict.get(u'offset', 0))
+    except ValueError:
+        raise t.ValidationError(
+            {u'limit': u'limit and offset must be integers'})
+
+    query = Session.query(
+        ValidationErrorRecord, model.Package.name, model.Package.owner_org
+    ).join(
+        model.Package, model.Package.id == ValidationErrorRecord.package_id)
+
+    if data_dict.get(u'code'):
+        query = query.filter(ValidationErrorRecord.code == data_dict[u'code'])
+    if data_dict.get(u'field'):
+        query = query.filter(
+            ValidationErrorRecord.field_name == data_dict[u'field'])
+    if data_dict.get(u'organization'):
+        organization = model.Group.get(data_dict[u'organization'])
+        if not organization:
+            raise t.ObjectNotFound(u'Organization not found')
+        query = query.filter(model.Package.owner_org == organization.id)
+    if data_dict.get(u'package_id'):
+        query = query.filter(
+            ValidationErrorRecord.package_id == data_dict[u'package_id'])
+    if data_dict.get(u'resource_id'):
+        query = query.filter(
+            ValidationErrorRecord.resource_id == data_dict[u'resource_id'])
+
+    count = query.count()
+
+    results = []
+    for error, package_name, owner_org in query.order_by(
+            ValidationErrorRecord.resource_id,
+            ValidationErrorRecord.row_number,
+            ValidationErrorRecord.id).offset(offset).limit(limit):
+        results.append({
+            u'resource_id': error.resource_id,
+            u'package_id': error.package_id,
+            u'package_name': package_name,
+            u'owner_org': owner_org,
+            u'code': error.code,
+            u'field_name': error.field_name,
+            u'row_number': error.row_number,
+            u'cell': error.cell,
+            u'message': error.message,
+        })
+
+    return {u'count': count, u'results': results}
+
+
+@t.side_effect_free
+def resource_validation_stats(context, data_dict):
+    u'''
+    Returns statistics about the validation jobs
+
+    For each class of validation jobs (``interactive`` for the ones started
+    from the API or the UI, ``upload`` for the ones started when creating or
+    updating a resource and ``batch`` for the ones started by
+    ``resource_validation_run_batch``) it returns the name and priority of
+    the queue used and the number of jobs currently waiting on it. Note that
+    classes sharing the same queue will report the same number of jobs.
+
+    It also returns the number of ``suppressed_jobs``, ie jobs that were
+    cancelled or dropped because a more recent one was enqueued for the same
+    resource, the number of datasets with validation status changes
+    waiting to be reindexed (``pending_reindex``) and the number of
+    decisions kept in memory by the web process answering the request
+    between the update hooks of the plugin (``update_markers``).
+
+    Only sysadmins are allowed to run this action.
+
+    :rtype: dict
+    '''
+
+    t.check_access(u'resource_validation_stats', context, data_dict)
+
+    return {
+        u'queues': queues.get_queues_info(),
+        u'suppressed_jobs': queues.get_suppressed_count(),
+        u'pending_reindex': indexing.get_buffer_size(),
+        u'update_markers': len(get_update_markers()),
+    }
+
+
+def _get_stale_resource_ids(model, resources, only_stale=False,
+                            older_than=None):
+    u'''
+    Returns the ids of the provided resource dicts that need to be validated
+    again, comparing them with their last validation in a single query
+
+    Resources never validated (or whose validation never finished) are always
+    returned. With `only_stale`, the ones whose last validation errored or
+    that changed since it was run are returned as well, and with
+    `older_than` the ones not validated in that number of days.
+
+    Changes are detected comparing the signature of the resource (see
+    `get_resource_signature`) with the one stored with the validation. For
+    validations stored before signatures were, the resource
+    `metadata_modified` and `last_modified` timestamps are compared instead.
+    '''
+    conditions = [Validation.id == None, Validation.finished == None]
+
+    if only_stale:
+        conditions.extend([
+            Validation.status == u'error',
+            sa.and_(Validation.signature == None, sa.or_(
+                Validation.finished < model.Resource.metadata_modified,
+                Validation.finished < sa.func.coalesce(
+                    model.Resource.last_modified, model.Resource.created),
+            )),
+        ])
+
+    if older_than is not None:
+        conditions.append(
+            Validation.finished < datetime.datetime.utcnow() -
+            datetime.timedelta(days=older_than))
+
+    query = model.Session.query(
+        model.Resource.id, sa.or_(*conditions), Validation.signature
+    ).outerjoin(
+        Validation, Validation.resource_id == model.Resource.id
+    ).filter(model.Resource.id.in_(
+        [resource[u'id'] for resource in resources]))
+
+    resources = dict((resource[u'id'], resource) for resource in resources)
+
+    stale = set()
+    for resource_id, matches, signature in query:
+        if matches or (only_stale and signature and signature !=
+                       get_resource_signature(resources[resource_id])):
+            stale.add(resource_id)
+
+    return stale
+
+
 def _search_datasets(
-        page=1, page_size=100, dataset_ids=None, search_params=None):
+        page=1, page_size=100, dataset_ids=None, search_params=None,
+        after_id=None):
     '''
     Perform a query with `package_search` and return the result
 
-    Results can be paginated using the `page` parameter
+    Results are sorted by id and can be paginated using the `page`
+    parameter, or more efficiently by passing the id of the last dataset
+    of the previous page as `after_id`.
     '''
 
     search_data_dict = {
@@ -341,8 +928,13 @@ def _search_datasets(
         'include_private': True,
         'rows': page_size,
         'start': page_size * (page - 1),
+        'sort': 'id asc',
     }
 
+    if after_id:
+        search_data_dict['start'] = 0
+        search_data_dict['fq_list'].append('id:{{"{}" TO *]'.format(after_id))
+
     if dataset_ids:
 
         search_data_dict['q'] = ' OR '.join(
@@ -404,14 +996,22 @@ def _add_default_formats(search_data_dict):
     search_data_dict['fq_list'].append(' OR '.join(filter_formats_query))
 
 
-def _validation_dictize(validation):
+def _validation_dictize(validation, include_report=True):
     out = {
         'id': validation.id,
         'resource_id': validation.resource_id,
         'status': validation.status,
-        'report': validation.report,
         'error': validation.error,
+        'valid': validation.valid,
+        'error_count': validation.error_count,
+        'row_count': validation.row_count,
+        'duration': validation.duration,
+        'sample': validation.sample,
+        'truncated': validation.truncated,
     }
+    if include_report:
+        # Only load the report when needed, as it can be big
+        out['report'] = validation.report
     out['created'] = (
         validation.created.isoformat() if validation.created else None)
     out['finished'] = (
@@ -467,6 +1067,18 @@ def resource_create(up_func, context, data_dict):
 
     pkg_dict['resources'].append(data_dict)
 
+    # Custom code starts
+
+    run_validation = _can_validate(context, data_dict)
+
+    # Local uploads are validated before anything is saved, so invalid ones
+    # are rejected without writing the resource or the file
+    report = None
+    if run_validation:
+        report = _validate_upload_before_saving(data_dict, upload)
+
+    # Custom code ends
+
     try:
         context['defer_commit'] = True
         context['use_cache'] = False
@@ -486,20 +1098,22 @@ def resource_create(up_func, context, data_dict):
 
     # Custom code starts
 
-    run_validation = True
-
-    for plugin in plugins.PluginImplementations(IDataValidation):
-        if not plugin.can_validate(context, data_dict):
-            log.debug('Skipping validation for resource {}'.format(resource_id))
-            run_validation = False
-
-    if run_validation:
+    if report is not None:
+        store_validation_report(
+            _get_saved_resource(model, resource_id), report,
+            source=upload.get_path(resource_id))
+    elif run_validation:
         is_local_upload = (
             hasattr(upload, 'filename') and
             upload.filename is not None and
             isinstance(upload, uploader.ResourceUpload))
-        _run_sync_validation(
-            resource_id, local_upload=is_local_upload, new_resource=True)
+        path = upload.get_path(resource_id) if is_local_upload else None
+        if _exceeds_sync_limits(data_dict, upload, path):
+            _run_pending_validation(
+                context, resource_id, local_upload=is_local_upload, new_resource=True)
+        else:
+            _run_sync_validation(
+                resource_id, local_upload=is_local_upload, new_resource=True)
 
     # Custom code ends
 
@@ -591,6 +1205,16 @@ def resource_update(up_func, context, data_dict):
 
     pkg_dict['resources'][n] = data_dict
 
+    # Custom code starts
+
+    run_validation = _can_validate(context, data_dict)
+
+    report = None
+    if run_validation:
+        report = _validate_upload_before_saving(data_dict, upload)
+
+    # Custom code ends
+
     try:
         context['defer_commit'] = True
         context['use_cache'] = False
@@ -606,22 +1230,21 @@ def resource_update(up_func, context, data_dict):
 
     # Custom code starts
 
-    run_validation = True
-    for plugin in plugins.PluginImplementations(IDataValidation):
-        if not plugin.can_validate(context, data_dict):
-            log.debug('Skipping validation for resource {}'.format(id))
-            run_validation = False
-
-    if run_validation:
-        run_validation = not data_dict.pop('_skip_next_validation', None)
-
-    if run_validation:
+    if report is not None:
+        store_validation_report(
+            _get_saved_resource(model, id), report, source=upload.get_path(id))
+    elif run_validation:
         is_local_upload = (
             hasattr(upload, 'filename') and
             upload.filename is not None and
             isinstance(upload, uploader.ResourceUpload))
-        _run_sync_validation(
-            id, local_upload=is_local_upload, new_resource=False)
+        path = upload.get_path(id) if is_local_upload else None
+        if _exceeds_sync_limits(data_dict, upload, path):
+            _run_pending_validation(
+                context, id, local_upload=is_local_upload, new_resource=False)
+        else:
+            _run_sync_validation(
+                id, local_upload=is_local_upload, new_resource=False)
 
     # Custom code ends
 
@@ -642,6 +1265,145 @@ def resource_update(up_func, context, data_dict):
     return resource
 
 
+def _can_validate(context, data_dict):
+
+    return can_validate_resources(context, [data_dict])[0]
+
+
+def _is_local_upload(upload):
+
+    return (
+        isinstance(upload, uploader.ResourceUpload) and
+        getattr(upload, 'filename', None) is not None and
+        getattr(upload, 'upload_file', None) is not None)
+
+
+def _validate_upload_before_saving(data_dict, upload):
+    u'''
+    Validates a local upload from the incoming file, before the resource and
+    the file are saved
+
+    Returns the report if the data is valid, so it can be stored once the
+    resource is saved, and raises a ValidationError with the report if it is
+    not. Returns None if the upload can not be validated this way (ie it is
+    not a local upload, its format is not supported or it exceeds the limits
+    for synchronous validation), in which case the resource is validated
+    after saving it as usual.
+    '''
+    if not _is_local_upload(upload):
+        return None
+
+    if (data_dict.get('format') or '').lower() not in \
+            settings.SUPPORTED_FORMATS:
+        return None
+
+    with _get_upload_file_path(upload) as path:
+        if _exceeds_sync_limits(data_dict, upload, path):
+            return None
+        report = validate_upload(data_dict, path)
+
+    if not report.get('valid'):
+        raise t.ValidationError({u'validation': [report]})
+
+    return report
+
+
+def _get_saved_resource(model, resource_id):
+    u'''
+    Returns the dict of a resource saved in the current transaction, as
+    stored in the database
+    '''
+    return resource_dictize(
+        model.Resource.get(resource_id),
+        {u'model': model, u'session': model.Session})
+
+
+@contextlib.contextmanager
+def _get_upload_file_path(upload):
+    u'''
+    Returns the path of a file with the contents of the incoming upload
+
+    Uploads already spooled to a named file on disk are used directly,
+    otherwise they are copied to a temporary file, which is removed
+    afterwards. The upload stream is rewound so it can be saved as usual.
+    '''
+    stream = upload.upload_file
+    name = getattr(stream, 'name', None)
+
+    try:
+        if isinstance(name, str) and os.path.isfile(name):
+            yield name
+        else:
+            suffix = os.path.splitext(upload.filename)[1]
+            with tempfile.NamedTemporaryFile(
+                    suffix=suffix, delete=False) as f:
+                stream.seek(0)
+                shutil.copyfileobj(stream, f)
+            try:
+                yield f.name
+            finally:
+                os.remove(f.name)
+    finally:
+        stream.seek(0)
+
+
+def _exceeds_sync_limits(data_dict, upload, path=None):
+    u'''
+    Returns True if the resource is bigger than the limits for synchronous
+    validation (`ckanext.validation.sync_max_size` and
+    `ckanext.validation.sync_max_rows`)
+
+    Rows are only counted for local uploads of text formats, read from
+    `path`, and counting stops once the limit is exceeded.
+    '''
+    max_size, max_rows = get_sync_limits()
+
+    size = data_dict.get('size') or getattr(upload, 'filesize', None)
+    try:
+        if max_size and size and int(size) > max_size:
+            return True
+    except (TypeError, ValueError):
+        pass
+
+    if (max_rows and path
+            and (data_dict.get('format') or '').lower() in ROW_COUNT_FORMATS):
+        if os.path.exists(path) and count_lines(path, max_rows) > max_rows:
+            return True
+
+    return False
+
+
+def _run_pending_validation(context, resource_id, local_upload=False,
+                            new_resource=True):
+    u'''
+    Marks the resource as pending validation and validates it asynchronously
+
+    If the data is invalid the job will reject the resource the same way
+    synchronous validation does, ie deleting the uploaded file and, for new
+    resources, the resource itself.
+    '''
+    resource = context['model'].Resource.get(resource_id)
+    if resource:
+        extras = dict(resource.extras or {})
+        extras['validation_status'] = 'pending'
+        extras.pop('validation_timestamp', None)
+        resource.extras = extras
+
+    try:
+        t.get_action(u'resource_validation_run')(
+            {u'ignore_auth': True,
+             u'validation_job_class': queues.UPLOAD,
+             u'validation_reject': {
+                 u'local_upload': local_upload,
+                 u'new_resource': new_resource}},
+            {u'resource_id': resource_id,
+             u'async': True})
+    except t.ValidationError as e:
+        log.info(
+            u'Could not run validation for resource %s: %s',
+                resource_id, e)
+
+
 def _run_sync_validation(resource_id, local_upload=False, new_resource=True):
 
     try:
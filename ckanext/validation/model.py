@@ -1,14 +1,27 @@
 # encoding: utf-8
 
+import collections
 import datetime
+import gzip
+import json
 import uuid
 import logging
 
-from sqlalchemy import Column, Unicode, DateTime
+from sqlalchemy import (
+    Column, Unicode, DateTime, Boolean, Integer, Float, LargeBinary,
+    ForeignKey, UnicodeText, inspect, text, func)
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.dialects.postgresql import JSON
+from sqlalchemy.orm import relationship, aliased
+from sqlalchemy.dialects.postgresql import JSON, insert
 
-from ckan.model.meta import metadata
+from ckan.model.meta import metadata, Session
+
+import ckantoolkit as t
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 log = logging.getLogger(__name__)
 
@@ -20,23 +33,484 @@ def make_uuid():
 Base = declarative_base(metadata=metadata)
 
 
+class ValidationReport(Base):
+    u'''
+    The full validation report, stored compressed in a separate table so
+    it is only loaded when needed
+    '''
+    __tablename__ = u'validation_report'
+
+    validation_id = Column(
+        Unicode, ForeignKey(u'validation.id', ondelete=u'CASCADE'),
+        primary_key=True)
+    compression = Column(Unicode)
+    data = Column(LargeBinary)
+
+
 class Validation(Base):
     __tablename__ = u'validation'
 
     id = Column(Unicode, primary_key=True, default=make_uuid)
-    resource_id = Column(Unicode)
+    resource_id = Column(Unicode, index=True, unique=True)
     status = Column(Unicode, default=u'created')
     created = Column(DateTime, default=datetime.datetime.utcnow)
     finished = Column(DateTime)
-    report = Column(JSON)
     error = Column(JSON)
+    # Hash of the source contents, schema and options used to generate
+    # the report
+    digest = Column(Unicode)
+    # Hash of the resource fields that affect the validation, to detect
+    # changed resources when a dataset is updated
+    signature = Column(Unicode)
+
+    # Summary of the report
+    valid = Column(Boolean)
+    error_count = Column(Integer)
+    row_count = Column(Integer)
+    duration = Column(Float)
+    sample = Column(JSON)
+    truncated = Column(JSON)
+    # Number of errors of each type
+    error_codes = Column(JSON)
+
+    report_data = relationship(
+        ValidationReport, uselist=False, lazy=u'select',
+        cascade=u'all, delete-orphan', passive_deletes=True)
+
+    @property
+    def report(self):
+        u'''
+        The validation report, as it was set (ie either a dict or a JSON
+        string). It is loaded from the database on first access.
+        '''
+        if self.report_data is None:
+            return None
+
+        return json.loads(_decompress(
+            self.report_data.data, self.report_data.compression))
+
+    @report.setter
+    def report(self, report):
+        for key, value in get_report_summary(report).items():
+            setattr(self, key, value)
+
+        if report is None:
+            self.report_data = None
+            return
+
+        compression = get_report_compression()
+        data = _compress(json.dumps(report), compression)
+        if self.report_data is None:
+            self.report_data = ValidationReport(
+                compression=compression, data=data)
+        else:
+            self.report_data.compression = compression
+            self.report_data.data = data
+
+
+class ValidationErrorRecord(Base):
+    u'''
+    Errors found on the last validation of each resource, so they can be
+    queried across the site without parsing the reports
+    '''
+    __tablename__ = u'validation_error'
+
+    id = Column(Integer, primary_key=True)
+    resource_id = Column(Unicode, nullable=False, index=True)
+    package_id = Column(Unicode, index=True)
+    code = Column(Unicode, index=True)
+    field_name = Column(Unicode, index=True)
+    row_number = Column(Integer)
+    cell = Column(UnicodeText)
+    message = Column(UnicodeText)
+
+
+# Tables created alongside the main validation table
+EXTRA_TABLES = [ValidationReport, ValidationErrorRecord]
+
+DEFAULT_ERRORS_PER_CODE = 100
+
+
+def get_report_summary(report):
+    u'''
+    Returns the values of the summary columns for a report (dict or JSON
+    string)
+    '''
+    if isinstance(report, str):
+        report = json.loads(report)
+    report = report or {}
+    stats = report.get(u'stats') or {}
+
+    row_count = None
+    error_codes = None
+    tasks = report.get(u'tasks')
+    if tasks:
+        row_count = sum(
+            (task.get(u'stats') or {}).get(u'rows') or 0 for task in tasks)
+        error_codes = dict(collections.Counter(
+            error.get(u'type') for task in tasks
+            for error in task.get(u'errors') or []))
+
+    return {
+        u'valid': report.get(u'valid'),
+        u'error_count': stats.get(u'errors'),
+        u'row_count': row_count,
+        u'duration': stats.get(u'seconds'),
+        u'sample': report.get(u'sample'),
+        u'truncated': report.get(u'truncated'),
+        u'error_codes': error_codes,
+    }
+
+
+def get_report_compression():
+    u'''
+    Returns the compression used to store new reports, `gzip` (the default)
+    or `zstd` (requires the `zstandard` package)
+    '''
+    compression = t.config.get(
+        u'ckanext.validation.report_compression', u'gzip')
+    if compression == u'zstd' and not zstandard:
+        log.warning(u'The zstandard package is not installed, '
+                    u'using gzip to compress the validation reports')
+        compression = u'gzip'
+
+    return compression
+
+
+def _compress(text, compression):
+    data = text.encode(u'utf8')
+    if compression == u'zstd':
+        return zstandard.ZstdCompressor().compress(data)
+
+    return gzip.compress(data)
+
+
+def _decompress(data, compression):
+    if compression == u'zstd':
+        data = zstandard.ZstdDecompressor().decompress(data)
+    else:
+        data = gzip.decompress(data)
+
+    return data.decode(u'utf8')
 
 
 def create_tables():
     Validation.__table__.create()
+    for table in EXTRA_TABLES:
+        table.__table__.create()
 
     log.info(u'Validation database tables created')
 
 
 def tables_exist():
     return Validation.__table__.exists()
+
+
+def _get_existing_columns():
+    return [
+        column['name'] for column in
+        inspect(metadata.bind).get_columns(Validation.__tablename__)]
+
+
+def _get_missing_columns():
+    existing = _get_existing_columns()
+
+    return [column for column in Validation.__table__.columns
+            if column.name not in existing]
+
+
+def _get_missing_indexes():
+    existing = [
+        index['name'] for index in
+        inspect(metadata.bind).get_indexes(Validation.__tablename__)]
+
+    return [index for index in Validation.__table__.indexes
+            if index.name not in existing]
+
+
+def _has_legacy_report_column():
+    # Reports used to be stored in a JSON column of the validation table
+    return u'report' in _get_existing_columns()
+
+
+def tables_up_to_date():
+    return (
+        all(table.__table__.exists() for table in EXTRA_TABLES)
+        and not _get_missing_columns()
+        and not _get_missing_indexes()
+        and not _has_legacy_report_column())
+
+
+def upgrade_tables():
+    u'''
+    Brings the tables of an existing install up to date with the model,
+    adding any missing tables, columns and indexes
+    '''
+    for column in _get_missing_columns():
+        metadata.bind.execute(
+            u'ALTER TABLE {table} ADD COLUMN {name} {type}'.format(
+                table=Validation.__tablename__,
+                name=column.name,
+                type=column.type.compile(dialect=metadata.bind.dialect)))
+
+        log.info(u'Added column %s to the validation table', column.name)
+
+    missing_indexes = _get_missing_indexes()
+    if missing_indexes:
+        _remove_duplicates()
+
+    for index in missing_indexes:
+        index.create(bind=metadata.bind)
+
+        log.info(u'Created index %s on the validation table', index.name)
+
+    for table in EXTRA_TABLES:
+        if not table.__table__.exists():
+            table.__table__.create()
+
+            log.info(u'Created the %s table', table.__tablename__)
+
+    if _has_legacy_report_column():
+        _migrate_legacy_reports()
+
+
+def _migrate_legacy_reports(page_size=500):
+    u'''
+    Moves the reports from the old `report` column of the validation table
+    to the validation_report table, filling the summary columns
+    '''
+    compression = get_report_compression()
+    migrated = 0
+    last_id = u''
+    while True:
+        rows = metadata.bind.execute(
+            text(u'''SELECT id, report FROM {table}
+            WHERE report IS NOT NULL AND id > :last_id
+            ORDER BY id LIMIT :limit'''.format(
+                table=Validation.__tablename__)),
+            last_id=last_id, limit=page_size).fetchall()
+        if not rows:
+            break
+
+        with metadata.bind.begin() as connection:
+            for validation_id, report in rows:
+                connection.execute(
+                    Validation.__table__.update().where(
+                        Validation.__table__.c.id == validation_id
+                    ).values(**get_report_summary(report)))
+                connection.execute(
+                    insert(ValidationReport.__table__).values(
+                        validation_id=validation_id,
+                        compression=compression,
+                        data=_compress(json.dumps(report), compression),
+                    ).on_conflict_do_nothing())
+
+        migrated += len(rows)
+        last_id = rows[-1][0]
+
+    metadata.bind.execute(u'ALTER TABLE {table} DROP COLUMN report'.format(
+        table=Validation.__tablename__))
+
+    log.info(u'Moved %s reports to the validation_report table', migrated)
+
+
+def _remove_duplicates():
+    u'''
+    Older versions could create more than one row for the same resource.
+    Only the most recent one is kept, so the unique index can be created.
+    '''
+    result = metadata.bind.execute(u'''
+        DELETE FROM {table} older USING {table} newer
+        WHERE older.resource_id = newer.resource_id
+        AND (older.created < newer.created
+             OR (older.created = newer.created AND older.id < newer.id)
+             OR (older.created IS NULL AND newer.created IS NOT NULL))
+    '''.format(table=Validation.__tablename__))
+
+    if result.rowcount:
+        log.info(u'Removed %s duplicated rows from the validation table',
+                 result.rowcount)
+
+
+def get_validation(resource_id, session=None):
+    u'''
+    Returns the Validation object for a resource, or None if it does not exist
+    '''
+    session = session or Session
+
+    return session.query(Validation).filter(
+        Validation.resource_id == resource_id).first()
+
+
+def get_validation_signatures(resource_ids, session=None):
+    u'''
+    Returns a dict with the signature of the resource when it was last
+    validated for each of the provided resources that have one
+
+    Validations that are waiting, running or errored are ignored, so the
+    resources are validated again even if they have not changed.
+    '''
+    session = session or Session
+
+    if not resource_ids:
+        return {}
+
+    return dict(
+        session.query(Validation.resource_id, Validation.signature)
+        .filter(Validation.resource_id.in_(resource_ids))
+        .filter(Validation.signature != None)
+        .filter(Validation.status.notin_([u'created', u'running', u'error'])))
+
+
+def upsert_validations(resource_ids, session=None, **values):
+    u'''
+    Bulk version of `upsert_validation`, creating or updating the Validation
+    objects of all the provided resources in a single statement. Changes are
+    not committed.
+    '''
+    session = session or Session
+
+    # A statement can not affect the same row twice
+    resource_ids = list(collections.OrderedDict.fromkeys(resource_ids))
+    if not resource_ids:
+        return
+
+    statement = insert(Validation.__table__).values([
+        dict(values, id=make_uuid(), resource_id=resource_id)
+        for resource_id in resource_ids])
+    statement = statement.on_conflict_do_update(
+        index_elements=[Validation.__table__.c.resource_id], set_=values)
+    session.execute(statement)
+
+
+def upsert_validation(resource_id, session=None, **values):
+    u'''
+    Creates the Validation object for a resource, or updates the existing one
+    with the provided values, in a single statement
+
+    This prevents concurrent requests from creating more than one row for the
+    same resource. Changes are not committed.
+
+    Returns the Validation object.
+    '''
+    session = session or Session
+
+    statement = insert(Validation.__table__).values(
+        resource_id=resource_id, **values)
+    statement = statement.on_conflict_do_update(
+        index_elements=[Validation.__table__.c.resource_id], set_=values)
+    session.execute(statement)
+
+    return session.query(Validation).filter(
+        Validation.resource_id == resource_id).populate_existing().one()
+
+
+def store_validation_errors(resource_id, package_id, report, session=None):
+    u'''
+    Replaces the stored errors of a resource with the ones in the report
+    (dict or JSON string). Only the first `ckanext.validation.errors_per_code`
+    errors of each type are stored. Changes are not committed.
+    '''
+    session = session or Session
+
+    session.query(ValidationErrorRecord).filter(
+        ValidationErrorRecord.resource_id == resource_id).delete(
+            synchronize_session=False)
+
+    if isinstance(report, str):
+        report = json.loads(report)
+    if not report:
+        return 0
+
+    limit = t.asint(t.config.get(
+        u'ckanext.validation.errors_per_code', DEFAULT_ERRORS_PER_CODE))
+
+    counts = {}
+    records = []
+    for task in report.get(u'tasks') or []:
+        for error in task.get(u'errors') or []:
+            code = error.get(u'type')
+            counts[code] = counts.get(code, 0) + 1
+            if counts[code] > limit:
+                continue
+            cell = error.get(u'cell')
+            records.append({
+                u'resource_id': resource_id,
+                u'package_id': package_id,
+                u'code': code,
+                u'field_name': error.get(u'fieldName'),
+                u'row_number': error.get(u'rowNumber'),
+                u'cell': str(cell) if cell is not None else None,
+                u'message': error.get(u'message'),
+            })
+
+    if records:
+        session.execute(ValidationErrorRecord.__table__.insert(), records)
+
+    return len(records)
+
+
+def get_validation_error_counts(resource_ids, session=None):
+    u'''
+    Returns a dict with the number of errors of each type found on the last
+    validation of each of the provided resources
+
+    The counts are taken from the report summary. For validations stored
+    before it included them, the stored errors are counted instead, which
+    only include the first `ckanext.validation.errors_per_code` of each
+    type.
+    '''
+    session = session or Session
+
+    if not resource_ids:
+        return {}
+
+    counts = {}
+    missing = []
+    for resource_id, error_codes in session.query(
+            Validation.resource_id, Validation.error_codes).filter(
+            Validation.resource_id.in_(resource_ids)):
+        if error_codes is None:
+            missing.append(resource_id)
+        else:
+            counts[resource_id] = error_codes
+
+    if missing:
+        for resource_id, code, count in session.query(
+                ValidationErrorRecord.resource_id,
+                ValidationErrorRecord.code,
+                func.count(ValidationErrorRecord.id)).filter(
+                ValidationErrorRecord.resource_id.in_(missing)).group_by(
+                ValidationErrorRecord.resource_id,
+                ValidationErrorRecord.code):
+            counts.setdefault(resource_id, {})[code] = count
+
+    return counts
+
+
+def get_validation_error_samples(resource_ids, per_code=10, session=None):
+    u'''
+    Returns a dict with the first `per_code` stored errors of each type for
+    each of the provided resources, sorted by row, using a single query
+    '''
+    session = session or Session
+
+    if not resource_ids:
+        return {}
+
+    position = func.row_number().over(
+        partition_by=(ValidationErrorRecord.resource_id,
+                      ValidationErrorRecord.code),
+        order_by=(ValidationErrorRecord.row_number,
+                  ValidationErrorRecord.id)).label(u'position')
+    ranked = session.query(ValidationErrorRecord, position).filter(
+        ValidationErrorRecord.resource_id.in_(resource_ids)).subquery()
+    records = aliased(ValidationErrorRecord, ranked)
+
+    samples = {}
+    for record in session.query(records).filter(
+            ranked.c.position <= per_code).order_by(
+            ranked.c.resource_id, ranked.c.row_number, ranked.c.id):
+        samples.setdefault(record.resource_id, []).append(record)
+
+    return samples
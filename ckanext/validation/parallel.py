@@ -0,0 +1,326 @@
+# encoding: utf-8
+
+import logging
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from frictionless import validate, system, errors, Schema, Dialect, Check
+from frictionless import settings as frictionless_settings
+
+import ckantoolkit as t
+
+from ckanext.validation.sampling import _iter_records, _get_dialect_details
+from ckanext.validation.checks import (
+    collect_keys, time_limit, add_time_limit_warning)
+
+
+log = logging.getLogger(__name__)
+
+
+# Formats that can be split in chunks of rows
+PARALLEL_FORMATS = [u'csv', u'tsv']
+
+DEFAULT_PARALLEL_MIN_SIZE = 50 * 1024 * 1024
+
+
+def get_parallel_workers(resource_parallel=None):
+    u'''
+    Returns the number of worker processes to use to validate a resource
+
+    The site wide default (`ckanext.validation.parallel_workers`) can be
+    overridden with the `parallel` key of the resource validation options,
+    either with `false` or with an object like `{"workers": 4}`.
+    A value lower than 2 means the resource is validated in the current
+    process.
+    '''
+    workers = t.asint(t.config.get(u'ckanext.validation.parallel_workers', 0))
+
+    if resource_parallel is False:
+        workers = 0
+    elif isinstance(resource_parallel, dict):
+        workers = t.asint(resource_parallel.get(u'workers', workers))
+
+    return workers
+
+
+def get_parallel_min_size():
+    return t.asint(t.config.get(
+        u'ckanext.validation.parallel_min_size', DEFAULT_PARALLEL_MIN_SIZE))
+
+
+def download_source(url, http_session, _format=u'csv'):
+    u'''
+    Downloads a remote file into a temporary file, returning its path.
+    The caller is responsible for removing it.
+    '''
+    response = http_session.get(url, stream=True)
+    try:
+        response.raise_for_status()
+        response.raw.decode_content = True
+
+        f = tempfile.NamedTemporaryFile(suffix=u'.' + _format, delete=False)
+        try:
+            with f:
+                shutil.copyfileobj(response.raw, f)
+        except Exception:
+            os.remove(f.name)
+            raise
+    finally:
+        response.close()
+
+    return f.name
+
+
+def validate_in_chunks(path, workers, _format=u'csv', schema=None,
+                       limit_seconds=None, **options):
+    u'''
+    Validates a local CSV file splitting it in chunks of rows that are
+    validated in parallel in separate processes
+
+    The reports for each chunk are merged into a single one, with row numbers
+    relative to the whole file. Unique and primary key constraints are checked
+    across chunks on the merge phase.
+
+    `schema` and the `dialect` and `checks` options must be provided as
+    descriptors (dicts), as they need to be sent to the worker processes.
+    If `limit_seconds` is provided, each worker will stop validating its
+    chunk after that time.
+
+    Returns the report as a dict.
+    '''
+    timer = time.time()
+
+    header_rows, quote_char = _get_dialect_details(options.get(u'dialect'))
+    header, chunks = _get_chunks(path, workers, header_rows, quote_char)
+
+    log.debug(u'Validating %s in %s chunks', path, len(chunks))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(
+                _validate_chunk, path, header, start, end, _format, schema,
+                limit_seconds, options)
+            for start, end, row_offset in chunks]
+        results = [future.result() for future in futures]
+
+    limit_errors = options.get(
+        u'limit_errors', frictionless_settings.DEFAULT_LIMIT_ERRORS)
+
+    return _merge_reports(
+        results, [row_offset for start, end, row_offset in chunks],
+        schema=schema,
+        limit_errors=limit_errors,
+        size=os.path.getsize(path),
+        seconds=round(time.time() - timer, 3))
+
+
+def _get_chunks(path, count, header_rows=1, quote_char=b'"'):
+    u'''
+    Splits a file in (at most) `count` chunks of similar size, making sure
+    they start and end on record boundaries
+
+    Returns the raw header records and a list of tuples with the start and
+    end byte offsets of each chunk and the number of data records before it.
+    '''
+    target = os.path.getsize(path) / float(count)
+
+    with open(path, u'rb') as f:
+        records = _iter_records(f, quote_char)
+
+        header = b''
+        for i in range(header_rows):
+            header += next(records, b'')
+
+        offset = start = len(header)
+        row_count = start_row = 0
+        chunks = []
+        for record in records:
+            offset += len(record)
+            row_count += 1
+            if offset - start >= target and len(chunks) < count - 1:
+                chunks.append((start, offset, start_row))
+                start = offset
+                start_row = row_count
+
+        if offset > start or not chunks:
+            chunks.append((start, offset, start_row))
+
+    return header, chunks
+
+
+def _validate_chunk(path, header, start, end, _format, schema,
+                    limit_seconds, options):
+
+    with tempfile.NamedTemporaryFile(
+            suffix=u'.' + _format, delete=False) as chunk_file:
+        chunk_file.write(header)
+        with open(path, u'rb') as f:
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                data = f.read(min(remaining, 1024 * 1024))
+                if not data:
+                    break
+                chunk_file.write(data)
+                remaining -= len(data)
+
+    options = dict(options)
+    if options.get(u'dialect'):
+        options[u'dialect'] = Dialect.from_descriptor(options[u'dialect'])
+    collector = collect_keys()
+    options[u'checks'] = [
+        Check.from_descriptor(c) for c in options.get(u'checks', [])
+    ] + [collector]
+    if limit_seconds:
+        time_check = time_limit(seconds=limit_seconds)
+        options[u'checks'].append(time_check)
+
+    try:
+        with system.use_context(trusted=True):
+            report = validate(
+                chunk_file.name, format=_format,
+                schema=Schema.from_descriptor(schema) if schema else None,
+                **options)
+    finally:
+        os.remove(chunk_file.name)
+
+    report = report.to_dict()
+    if limit_seconds and time_check.reached:
+        add_time_limit_warning(report, limit_seconds)
+
+    return (
+        report,
+        getattr(collector, u'unique', {}),
+        getattr(collector, u'primary', {}),
+    )
+
+
+def _merge_reports(results, row_offsets, schema=None, limit_errors=None,
+                   size=None, seconds=None):
+
+    # Errors not related to the data (eg the file could not be read)
+    for report, unique, primary in results:
+        if report.get(u'errors') or not report.get(u'tasks'):
+            return report
+
+    first_task = results[0][0][u'tasks'][0]
+    task_errors = []
+    task_warnings = []
+    rows = 0
+
+    for index, (report, unique, primary) in enumerate(results):
+        task = report[u'tasks'][0]
+        rows += task[u'stats'].get(u'rows') or 0
+        for warning in task.get(u'warnings', []):
+            if warning not in task_warnings:
+                task_warnings.append(warning)
+        for error in task.get(u'errors', []):
+            if u'rowNumber' in error:
+                error[u'rowNumber'] += row_offsets[index]
+                error[u'message'] = _get_error_message(error)
+            elif index > 0:
+                # Header errors are the same on all chunks
+                continue
+            task_errors.append(error)
+
+    task_errors.extend(_get_cross_chunk_errors(results, row_offsets, schema))
+    task_errors.sort(key=lambda error: error.get(u'rowNumber') or 0)
+
+    if limit_errors and len(task_errors) > limit_errors:
+        task_errors = task_errors[:limit_errors]
+        warning = u'reached error limit: {}'.format(limit_errors)
+        if warning not in task_warnings:
+            task_warnings.append(warning)
+
+    stats = dict(first_task[u'stats'])
+    stats.pop(u'md5', None)
+    stats.pop(u'sha256', None)
+    stats.update({
+        u'bytes': size,
+        u'rows': rows,
+        u'errors': len(task_errors),
+        u'warnings': len(task_warnings),
+        u'seconds': seconds,
+    })
+
+    task = dict(first_task)
+    task.update({
+        u'valid': not task_errors,
+        u'stats': stats,
+        u'errors': task_errors,
+        u'warnings': task_warnings,
+    })
+
+    return {
+        u'valid': not task_errors,
+        u'stats': {
+            u'tasks': 1,
+            u'errors': len(task_errors),
+            u'warnings': len(task_warnings),
+            u'seconds': seconds,
+        },
+        u'warnings': [],
+        u'errors': [],
+        u'tasks': [task],
+    }
+
+
+def _get_error_message(error):
+    u'''
+    Regenerates the error message after updating the row number, using the
+    template of the relevant error class
+    '''
+    for error_class in vars(errors).values():
+        if getattr(error_class, u'type', None) == error[u'type']:
+            try:
+                return error_class.template.format(**error)
+            except (KeyError, IndexError):
+                break
+
+    return error[u'message']
+
+
+def _get_cross_chunk_errors(results, row_offsets, schema=None):
+
+    field_numbers = {}
+    if schema:
+        field_numbers = {
+            field[u'name']: index + 1
+            for index, field in enumerate(schema.get(u'fields', []))}
+
+    cross_errors = []
+    seen_unique = {}
+    seen_primary = {}
+    for index, (report, unique, primary) in enumerate(results):
+        for field_name, values in unique.items():
+            seen = seen_unique.setdefault(field_name, {})
+            for cell, row_number in values.items():
+                row_number += row_offsets[index]
+                match = seen.get(cell)
+                if match:
+                    cross_errors.append(errors.UniqueError(
+                        note=u'the same as in the row at position %s' % match,
+                        cells=[],
+                        row_number=row_number,
+                        cell=str(cell),
+                        field_name=field_name,
+                        field_number=field_numbers.get(field_name, 0),
+                    ).to_descriptor())
+                else:
+                    seen[cell] = row_number
+        for cells, row_number in primary.items():
+            row_number += row_offsets[index]
+            match = seen_primary.get(cells)
+            if match:
+                cross_errors.append(errors.PrimaryKeyError(
+                    note=u'the same as in the row at position %s' % match,
+                    cells=[],
+                    row_number=row_number,
+                ).to_descriptor())
+            else:
+                seen_primary[cells] = row_number
+
+    return cross_errors
@@ -3,18 +3,29 @@
 import logging
 import cgi
 import json
+import threading
+import uuid
 
+import flask
 from werkzeug.datastructures import FileStorage as FlaskFileStorage
+from ckan import model
 import ckan.plugins as p
 import ckantoolkit as t
 
-from ckanext.validation import settings
-from ckanext.validation.model import tables_exist
+from ckanext.validation import settings, queues
+from ckanext.validation.model import (
+    tables_exist, tables_up_to_date, get_validation_signatures)
 from ckanext.validation.logic import (
     resource_validation_run, resource_validation_show,
     resource_validation_delete, resource_validation_run_batch,
+    resource_validation_error_search, resource_validation_stats,
+    resource_validation_report,
     auth_resource_validation_run, auth_resource_validation_show,
     auth_resource_validation_delete, auth_resource_validation_run_batch,
+    auth_resource_validation_error_search, auth_resource_validation_stats,
+    auth_resource_validation_report,
+    enqueue_validations,
+    can_validate_resources,
     resource_create as custom_resource_create,
     resource_update as custom_resource_update,
 )
@@ -33,8 +44,9 @@ from ckanext.validation.validators import (
 from ckanext.validation.utils import (
     get_create_mode_from_config,
     get_update_mode_from_config,
+    get_update_markers,
+    get_resource_signature,
 )
-from ckanext.validation.interfaces import IDataValidation
 from ckanext.validation import blueprints, cli
 
 
@@ -71,6 +83,12 @@ class ValidationPlugin(p.SingletonPlugin):
 The validation extension requires a database setup. Please run the following
 to create the database tables:
     paster --plugin=ckanext-validation validation init-db
+''')
+        elif not tables_up_to_date():
+            log.critical(u'''
+The validation extension database tables are outdated. Please run the
+following to upgrade them:
+    paster --plugin=ckanext-validation validation upgrade-db
 ''')
         else:
             log.debug(u'Validation tables exist')
@@ -87,6 +105,10 @@ to create the database tables:
             u'resource_validation_show': resource_validation_show,
             u'resource_validation_delete': resource_validation_delete,
             u'resource_validation_run_batch': resource_validation_run_batch,
+            u'resource_validation_error_search':
+                resource_validation_error_search,
+            u'resource_validation_stats': resource_validation_stats,
+            u'resource_validation_report': resource_validation_report,
             u'resource_create': custom_resource_create,
             u'resource_update': custom_resource_update,
         }
@@ -101,6 +123,10 @@ to create the database tables:
             u'resource_validation_show': auth_resource_validation_show,
             u'resource_validation_delete': auth_resource_validation_delete,
             u'resource_validation_run_batch': auth_resource_validation_run_batch,
+            u'resource_validation_error_search':
+                auth_resource_validation_error_search,
+            u'resource_validation_stats': auth_resource_validation_stats,
+            u'resource_validation_report': auth_resource_validation_report,
         }
 
     # ITemplateHelpers
@@ -117,8 +143,42 @@ to create the database tables:
 
     # IResourceController
 
-    resources_to_validate = {}
-    packages_to_skip = {}
+    def _add_marker(self, context, marker):
+        u'''
+        Records a decision made in `before_update` for the following
+        `after_update` calls, eg `(u'package', <id>)` for datasets whose
+        resources don't need validating
+
+        Markers are stored in the action context, which is shared by the
+        hooks called during the same action. Only if the context can not
+        hold them they are stored in a bounded process wide set with
+        expiring keys, along with a key unique to the current request.
+        '''
+        if isinstance(context, dict):
+            context.setdefault(u'_validation_markers', set()).add(marker)
+        else:
+            get_update_markers().add((_get_request_key(), marker))
+
+    def _has_marker(self, context, marker, remove=False):
+        u'''
+        Returns True if the marker was recorded, removing it if `remove`
+        is set
+
+        The process wide set is only checked if no markers were recorded in
+        the provided context, and only for markers of the current request.
+        '''
+        markers = (context.get(u'_validation_markers')
+                   if isinstance(context, dict) else None)
+        if markers is not None:
+            found = marker in markers
+            if found and remove:
+                markers.discard(marker)
+            return found
+
+        key = (_get_request_key(), marker)
+        if remove:
+            return get_update_markers().discard(key)
+        return key in get_update_markers()
 
     def _process_schema_fields(self, data_dict):
         u'''
@@ -168,8 +228,8 @@ to create the database tables:
             return
 
         if is_dataset:
-            for resource in data_dict.get(u'resources', []):
-                self._handle_validation_for_resource(context, resource)
+            self._handle_validation_for_resources(
+                context, data_dict.get(u'resources', []))
         else:
             # This is a resource. Resources don't need to be handled here
             # as there is always a previous `package_update` call that will
@@ -184,42 +244,59 @@ to create the database tables:
             or data_dict.get(u'type') == u'dataset')
 
     def _handle_validation_for_resource(self, context, resource):
-        needs_validation = False
-        if ((
-            # File uploaded
-            resource.get(u'url_type') == u'upload' or
-            # URL defined
-            resource.get(u'url')
-            ) and (
-            # Make sure format is supported
-            resource.get(u'format', u'').lower() in
-                settings.SUPPORTED_FORMATS
-                )):
-            needs_validation = True
-
-        if needs_validation:
-
-            for plugin in p.PluginImplementations(IDataValidation):
-                if not plugin.can_validate(context, resource):
-                    log.debug('Skipping validation for resource %s', resource['id'])
-                    return
 
+        if (_can_be_validated(resource) and
+                can_validate_resources(context, [resource])[0]):
             _run_async_validation(resource[u'id'])
 
+    def _handle_validation_for_resources(self, context, resources,
+                                         only_changed=False):
+        u'''
+        Bulk version of `_handle_validation_for_resource`, used when a
+        dataset is created or updated
+
+        With `only_changed`, resources whose signature (see
+        `get_resource_signature`) matches the one stored when they were
+        last validated are skipped, as they have not changed. Plugins are
+        asked about all the remaining resources at once, and all the
+        validations needed are started with a single database transaction
+        and queue pipeline.
+        '''
+        resources = [
+            resource for resource in resources
+            if _can_be_validated(resource)]
+
+        if only_changed and resources:
+            signatures = get_validation_signatures(
+                [resource[u'id'] for resource in resources])
+            resources = [
+                resource for resource in resources
+                if signatures.get(resource[u'id']) !=
+                get_resource_signature(resource)]
+
+        resource_ids = [
+            resource[u'id'] for resource, can_validate in
+            zip(resources, can_validate_resources(context, resources))
+            if can_validate]
+
+        if resource_ids:
+            enqueue_validations(resource_ids, job_class=queues.UPLOAD)
+
     def before_update(self, context, current_resource, updated_resource):
 
         updated_resource = self._process_schema_fields(updated_resource)
 
-        # the call originates from a resource API, so don't validate the entire package
-        package_id = updated_resource.get('package_id')
-        if not package_id:
-            existing_resource = t.get_action('resource_show')(
-                context={'ignore_auth': True}, data_dict={'id': updated_resource['id']})
-            if existing_resource:
-                package_id = existing_resource['package_id']
-        self.packages_to_skip[package_id] = True
+        async_update = get_update_mode_from_config() == u'async'
+
+        # The call originates from a resource API, so don't validate the
+        # entire package. The markers are only checked by `after_update` in
+        # async mode.
+        if async_update or get_create_mode_from_config() == u'async':
+            package_id = self._get_package_id(
+                context, current_resource, updated_resource)
+            self._add_marker(context, (u'package', package_id))
 
-        if not get_update_mode_from_config() == u'async':
+        if not async_update:
             return updated_resource
 
         needs_validation = False
@@ -242,10 +319,31 @@ to create the database tables:
             needs_validation = True
 
         if needs_validation:
-            self.resources_to_validate[updated_resource[u'id']] = True
+            self._add_marker(context, (u'resource', updated_resource[u'id']))
 
         return updated_resource
 
+    def _get_package_id(self, context, current_resource, updated_resource):
+        u'''
+        Returns the id of the dataset the updated resource belongs to
+
+        It is taken from the resource dicts passed to the hook or the dataset
+        in the context if possible, otherwise it is queried from the
+        database.
+        '''
+        package_id = (
+            updated_resource.get(u'package_id') or
+            current_resource.get(u'package_id'))
+        if package_id:
+            return package_id
+
+        package = context.get(u'package')
+        if package is not None and getattr(package, u'id', None):
+            return package.id
+
+        return model.Session.query(model.Resource.package_id) \
+            .filter(model.Resource.id == updated_resource[u'id']).scalar()
+
     def after_update(self, context, data_dict):
 
         is_dataset = self._data_dict_is_dataset(data_dict)
@@ -256,16 +354,10 @@ to create the database tables:
                 and not get_create_mode_from_config() == u'async'):
             return
 
-        if context.get('_validation_performed'):
-            # Ugly, but needed to avoid circular loops caused by the
-            # validation job calling resource_patch (which calls
-            # package_update)
-            del context['_validation_performed']
-            return
-
         if is_dataset:
             package_id = data_dict.get('id')
-            if self.packages_to_skip.pop(package_id, None) or context.get('save', False):
+            if (self._has_marker(context, (u'package', package_id), remove=True)
+                    or context.get('save', False)):
                 # Either we're updating an individual resource,
                 # or we're updating the package metadata via the web form;
                 # in both cases, we don't need to validate every resource.
@@ -279,27 +371,24 @@ to create the database tables:
                     self._handle_validation_for_resource(context, new_resource)
                     return
 
-            for resource in data_dict.get(u'resources', []):
-                if resource[u'id'] in self.resources_to_validate:
-                    # This is part of a resource_update call, it will be
-                    # handled on the next `after_update` call
-                    continue
-                else:
-                    # This is an actual package_update call, validate the
-                    # resources if necessary
-                    self._handle_validation_for_resource(context, resource)
+            # This is an actual package_update call, validate the resources
+            # that changed. The ones that are part of a resource_update call
+            # will be handled on the next `after_update` call
+            self._handle_validation_for_resources(
+                context,
+                [resource for resource in data_dict.get(u'resources', [])
+                 if not self._has_marker(
+                     context, (u'resource', resource[u'id']))],
+                only_changed=True)
 
         else:
             # This is a resource
             resource_id = data_dict[u'id']
 
-            if resource_id in self.resources_to_validate:
-                for plugin in p.PluginImplementations(IDataValidation):
-                    if not plugin.can_validate(context, data_dict):
-                        log.debug('Skipping validation for resource %s', data_dict['id'])
-                        return
-
-                del self.resources_to_validate[resource_id]
+            if self._has_marker(
+                    context, (u'resource', resource_id), remove=True):
+                if not can_validate_resources(context, [data_dict])[0]:
+                    return
 
                 _run_async_validation(resource_id)
 
@@ -307,12 +396,18 @@ to create the database tables:
 
     def before_index(self, index_dict):
 
-        res_status = []
-        dataset_dict = json.loads(index_dict['validated_data_dict'])
-        for resource in dataset_dict.get('resources', []):
-            if resource.get('validation_status'):
-                res_status.append(resource['validation_status'])
-
+        # Use the list of statuses added by CKAN when the field is listed in
+        # `ckan.extra_resource_fields`, to avoid parsing the whole dataset
+        res_status = index_dict.get('res_extras_validation_status')
+        if res_status is None:
+            data = index_dict.get('validated_data_dict') or ''
+            if '"validation_status"' not in data:
+                return index_dict
+            res_status = [
+                resource.get('validation_status')
+                for resource in json.loads(data).get('resources', [])]
+
+        res_status = [status for status in res_status if status]
         if res_status:
             index_dict['vocab_validation_status'] = res_status
 
@@ -327,11 +422,26 @@ to create the database tables:
         }
 
 
+def _can_be_validated(resource):
+
+    return bool((
+        # File uploaded
+        resource.get(u'url_type') == u'upload' or
+        # URL defined
+        resource.get(u'url')
+        ) and (
+        # Make sure format is supported
+        resource.get(u'format', u'').lower() in
+            settings.SUPPORTED_FORMATS
+            ))
+
+
 def _run_async_validation(resource_id):
 
     try:
         t.get_action(u'resource_validation_run')(
-            {u'ignore_auth': True},
+            {u'ignore_auth': True,
+             u'validation_job_class': queues.UPLOAD},
             {u'resource_id': resource_id,
              u'async': True})
     except t.ValidationError as e:
@@ -339,6 +449,19 @@ def _run_async_validation(resource_id):
             u'Could not run validation for resource %s: %s',
                 resource_id, e)
 
+
+def _get_request_key():
+    u'''
+    Returns a key unique to the current request, or to the current thread
+    outside of a request (eg in jobs or commands)
+    '''
+    if flask.has_app_context():
+        if u'_validation_request_key' not in flask.g:
+            flask.g._validation_request_key = str(uuid.uuid4())
+        return flask.g._validation_request_key
+
+    return u'thread-{}'.format(threading.get_ident())
+
 def _get_underlying_file(wrapper):
     if isinstance(wrapper, FlaskFileStorage):
         return wrapper.stream
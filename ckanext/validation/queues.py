@@ -0,0 +1,280 @@
+# encoding: utf-8
+
+import logging
+import time
+import uuid
+
+from redis.exceptions import RedisError
+
+import ckantoolkit as t
+
+
+log = logging.getLogger(__name__)
+
+
+# Classes of validation jobs, depending on what triggered them
+INTERACTIVE = u'interactive'
+UPLOAD = u'upload'
+BATCH = u'batch'
+
+JOB_CLASSES = [INTERACTIVE, UPLOAD, BATCH]
+
+HIGH_PRIORITY = u'high'
+NORMAL_PRIORITY = u'normal'
+
+DEFAULT_QUEUE_NAME = u'default'
+DEFAULT_PRIORITIES = {
+    INTERACTIVE: HIGH_PRIORITY,
+    UPLOAD: NORMAL_PRIORITY,
+    BATCH: NORMAL_PRIORITY,
+}
+
+DEFAULT_BATCH_MAX_QUEUED = 1000
+DEFAULT_BATCH_THROTTLE_INTERVAL = 5
+DEFAULT_BATCH_MAX_WAIT = 600
+
+# Pending job markers expire in case the job is lost (eg Redis is flushed)
+PENDING_TTL = 24 * 60 * 60
+
+# Deletes the pending marker if it belongs to the provided job. Returns 1 if
+# it did, 0 if there was no marker and -1 if it belongs to another job.
+CLAIM_PENDING_SCRIPT = u'''
+local current = redis.call('get', KEYS[1])
+if not current then
+    return 0
+end
+if current == ARGV[1] then
+    redis.call('del', KEYS[1])
+    return 1
+end
+return -1
+'''
+
+
+def get_queue_name(job_class):
+    u'''
+    Returns the name of the queue used for validation jobs of the provided
+    class (`ckanext.validation.queue_name.<class>`)
+    '''
+    return t.config.get(
+        u'ckanext.validation.queue_name.{}'.format(job_class),
+        DEFAULT_QUEUE_NAME)
+
+
+def get_queue_priority(job_class):
+    u'''
+    Returns the priority of the validation jobs of the provided class
+    (`ckanext.validation.queue_priority.<class>`). High priority jobs are
+    added to the front of their queue.
+    '''
+    priority = t.config.get(
+        u'ckanext.validation.queue_priority.{}'.format(job_class),
+        DEFAULT_PRIORITIES.get(job_class, NORMAL_PRIORITY))
+    if priority not in (HIGH_PRIORITY, NORMAL_PRIORITY):
+        log.warning(u'Unknown validation queue priority: %s', priority)
+        priority = NORMAL_PRIORITY
+
+    return priority
+
+
+def get_rq_kwargs(job_class):
+    u'''
+    Returns the extra arguments to pass to RQ when enqueuing a job of the
+    provided class
+    '''
+    return {u'at_front': get_queue_priority(job_class) == HIGH_PRIORITY}
+
+
+def get_queue(job_class):
+    u'''
+    Returns the RQ queue used for validation jobs of the provided class, or
+    None if it is not available (ie CKAN < 2.7)
+    '''
+    try:
+        from ckan.lib.jobs import get_queue
+    except ImportError:
+        return None
+
+    return get_queue(get_queue_name(job_class))
+
+
+def get_queue_depth(job_class):
+    u'''
+    Returns the number of jobs waiting on the queue used for validation jobs
+    of the provided class, or None if it can not be determined
+    '''
+    queue = get_queue(job_class)
+    if queue is None:
+        return None
+
+    return queue.count
+
+
+def get_queues_info():
+    u'''
+    Returns a dict with the queue name, priority and number of jobs waiting
+    for each class of validation jobs
+    '''
+    return dict(
+        (job_class, {
+            u'name': get_queue_name(job_class),
+            u'priority': get_queue_priority(job_class),
+            u'count': get_queue_depth(job_class),
+        })
+        for job_class in JOB_CLASSES)
+
+
+def wait_for_batch_queue():
+    u'''
+    Blocks until the number of jobs waiting on the batch queue is below
+    `ckanext.validation.batch_max_queued`, so batch runs don't fill the
+    queues faster than the workers can process them. Returns the number of
+    seconds waited.
+
+    It gives up after `ckanext.validation.batch_max_wait` seconds, in case
+    the queue is not being processed (eg the workers are down).
+    '''
+    max_queued = t.asint(t.config.get(
+        u'ckanext.validation.batch_max_queued', DEFAULT_BATCH_MAX_QUEUED))
+    if not max_queued:
+        return 0
+
+    interval = float(t.config.get(
+        u'ckanext.validation.batch_throttle_interval',
+        DEFAULT_BATCH_THROTTLE_INTERVAL))
+    max_wait = float(t.config.get(
+        u'ckanext.validation.batch_max_wait', DEFAULT_BATCH_MAX_WAIT))
+
+    waited = 0
+    while True:
+        depth = get_queue_depth(BATCH)
+        if depth is None or depth < max_queued:
+            return waited
+        if waited >= max_wait:
+            log.warning(
+                u'%s jobs still waiting on the batch validation queue after '
+                u'%s seconds, enqueuing more jobs anyway', depth, waited)
+            return waited
+        log.debug(
+            u'%s jobs waiting on the batch validation queue, waiting %s '
+            u'seconds', depth, interval)
+        time.sleep(interval)
+        waited += interval
+
+
+def new_job_id():
+    u'''
+    Returns a new id for a validation job, generated before enqueuing it so
+    it can be recorded as pending first (see `set_pending_jobs`)
+    '''
+    return str(uuid.uuid4())
+
+
+def set_pending_jobs(jobs):
+    u'''
+    Records the provided jobs (a dict with resource ids as keys and job ids
+    as values) as the pending validation job of each resource. It must be
+    called before the jobs are enqueued, otherwise a worker could start them
+    before they are recorded and drop them.
+
+    Jobs previously pending for the same resources that have not started yet
+    are cancelled, so there is only one job waiting for each resource, with
+    the latest data. Returns the number of jobs cancelled.
+    '''
+    if not jobs:
+        return 0
+
+    try:
+        redis = get_redis_connection()
+
+        pipe = redis.pipeline()
+        for resource_id, job_id in jobs.items():
+            key = _get_pending_key(resource_id)
+            pipe.getset(key, job_id)
+            pipe.expire(key, PENDING_TTL)
+        previous_ids = pipe.execute()[::2]
+
+        cancelled = 0
+        for previous_id, job_id in zip(previous_ids, jobs.values()):
+            if previous_id and previous_id.decode(u'utf8') != job_id:
+                if _cancel_queued_job(redis, previous_id.decode(u'utf8')):
+                    cancelled += 1
+        if cancelled:
+            redis.incrby(_get_suppressed_key(), cancelled)
+    except RedisError as e:
+        log.warning(u'Could not store the pending validation jobs: %s', e)
+        return 0
+
+    if cancelled:
+        log.debug(u'%s duplicated validation jobs cancelled', cancelled)
+
+    return cancelled
+
+
+def claim_pending_job(resource_id, job_id):
+    u'''
+    Called when a validation job starts, returns False if a more recent job
+    was enqueued for the same resource, in which case this one should be
+    dropped
+
+    Otherwise the pending marker is removed, so new requests for the resource
+    enqueue a new job.
+    '''
+    try:
+        redis = get_redis_connection()
+        result = redis.eval(
+            CLAIM_PENDING_SCRIPT, 1, _get_pending_key(resource_id), job_id)
+        if result == -1:
+            redis.incr(_get_suppressed_key())
+            return False
+    except RedisError as e:
+        log.warning(u'Could not check the pending validation jobs: %s', e)
+
+    return True
+
+
+def get_suppressed_count():
+    u'''
+    Returns the number of duplicated validation jobs that were cancelled or
+    dropped
+    '''
+    try:
+        return int(get_redis_connection().get(_get_suppressed_key()) or 0)
+    except RedisError as e:
+        log.warning(u'Could not get the suppressed jobs count: %s', e)
+        return None
+
+
+def get_redis_connection():
+    from ckan.lib.redis import connect_to_redis
+    return connect_to_redis()
+
+
+def get_redis_key(*parts):
+    return u':'.join(
+        (u'ckanext-validation', t.config.get(u'ckan.site_id', u'')) + parts)
+
+
+def _get_pending_key(resource_id):
+    return get_redis_key(u'pending', resource_id)
+
+
+def _get_suppressed_key():
+    return get_redis_key(u'suppressed')
+
+
+def _cancel_queued_job(redis, job_id):
+    from rq.exceptions import NoSuchJobError
+    from rq.job import Job
+
+    try:
+        job = Job.fetch(job_id, connection=redis)
+    except NoSuchJobError:
+        return False
+
+    # Jobs that already started are left alone
+    if job.get_status() != u'queued':
+        return False
+
+    job.cancel()
+    return True
@@ -0,0 +1,247 @@
+# encoding: utf-8
+
+import contextlib
+import io
+import itertools
+import json
+import logging
+import os
+import random
+import tempfile
+
+from urllib.parse import urlparse
+
+import ckantoolkit as t
+
+
+log = logging.getLogger(__name__)
+
+
+SAMPLE_MODES = [u'full', u'head', u'reservoir', u'block']
+
+# Formats that can be sampled at the record level. Other formats (eg Excel)
+# can only be sampled using the `head` mode
+SAMPLE_RECORD_FORMATS = [u'csv', u'tsv']
+
+DEFAULT_SAMPLE_ROWS = 10000
+DEFAULT_SAMPLE_EVERY = 10
+DEFAULT_SAMPLE_BLOCK_SIZE = 1000
+
+
+def get_sample_options(resource_sample=None):
+    u'''
+    Returns the sampling options to use for a validation job
+
+    The site wide defaults (`ckanext.validation.sample_*` config options)
+    are updated with the ones provided in the `sample` key of the resource
+    validation options. Returns None if validation should be performed on
+    the full source.
+    '''
+    sample = {
+        u'mode': t.config.get(u'ckanext.validation.sample_mode', u'full'),
+        u'rows': t.asint(t.config.get(
+            u'ckanext.validation.sample_rows', DEFAULT_SAMPLE_ROWS)),
+        u'every': t.asint(t.config.get(
+            u'ckanext.validation.sample_every', DEFAULT_SAMPLE_EVERY)),
+        u'block_size': t.asint(t.config.get(
+            u'ckanext.validation.sample_block_size',
+            DEFAULT_SAMPLE_BLOCK_SIZE)),
+    }
+
+    if isinstance(resource_sample, str):
+        resource_sample = {u'mode': resource_sample}
+    if resource_sample:
+        sample.update(resource_sample)
+
+    if sample[u'mode'] not in SAMPLE_MODES:
+        log.warning(u'Unknown sample mode "%s", validating the full source',
+                    sample[u'mode'])
+        return None
+
+    if sample[u'mode'] == u'full':
+        return None
+
+    return sample
+
+
+def sample_source(source, sample, _format=u'csv', http_session=None,
+                  dialect=None):
+    u'''
+    Writes a sample of the rows of a CSV source into a temporary file
+
+    The source can be a local path or a remote URL, which will be streamed
+    with the provided `http_session`. Header rows are always kept. Rows are
+    written to the file as they are read, only the `reservoir` mode keeps
+    the sampled rows in memory.
+
+    Returns a tuple with the path to the temporary file (which the caller
+    is responsible for removing), a dict with details about the sample and a
+    function that maps the row numbers of the sample to the ones of the
+    original source (see `map_sample_rows`).
+    '''
+    header_rows, quote_char = _get_dialect_details(dialect)
+
+    counts = {u'total': 0}
+
+    def _enumerate(records):
+        for index, record in enumerate(records):
+            counts[u'total'] = index + 1
+            yield index, record
+
+    f = tempfile.NamedTemporaryFile(suffix=u'.' + _format, delete=False)
+    try:
+        with f, _open_source(source, http_session) as stream:
+            records = _iter_records(stream, quote_char)
+
+            for record in itertools.islice(records, header_rows):
+                f.write(record)
+
+            if sample[u'mode'] == u'reservoir':
+                rows = _reservoir_sample(_enumerate(records), sample[u'rows'])
+            else:
+                rows = _block_sample(
+                    _enumerate(records), sample[u'every'],
+                    sample[u'block_size'])
+
+            # Positions of the sampled rows in the source, in block mode
+            # they can be computed instead
+            positions = []
+            sampled = 0
+            for index, record in rows:
+                f.write(record)
+                sampled += 1
+                if sample[u'mode'] == u'reservoir':
+                    positions.append(index)
+    except Exception:
+        os.remove(f.name)
+        raise
+
+    total = counts[u'total']
+    info = {
+        u'mode': sample[u'mode'],
+        u'rows': sampled,
+        u'total_rows': total,
+        u'rate': round(float(sampled) / total, 4) if total else 1.0,
+    }
+    log.debug(u'Sampled %s out of %s rows from %s', sampled, total, source)
+
+    def row_map(row_number):
+        position = row_number - header_rows - 1
+        if position < 0:
+            return row_number
+        if sample[u'mode'] == u'reservoir':
+            if position >= len(positions):
+                return row_number
+            position = positions[position]
+        else:
+            block, offset = divmod(position, sample[u'block_size'])
+            position = block * sample[u'every'] * sample[u'block_size'] + \
+                offset
+        return header_rows + 1 + position
+
+    return f.name, info, row_map
+
+
+def map_sample_rows(report, row_map):
+    u'''
+    Replaces the row numbers of the errors in a report of a sample with the
+    ones of the original source, using the function returned by
+    `sample_source`
+    '''
+    for task in report.get(u'tasks') or []:
+        for error in task.get(u'errors') or []:
+            row_number = error.get(u'rowNumber')
+            if not isinstance(row_number, int):
+                continue
+            original = row_map(row_number)
+            error[u'rowNumber'] = original
+            if error.get(u'message'):
+                error[u'message'] = error[u'message'].replace(
+                    u'Row at position "{}"'.format(row_number),
+                    u'Row at position "{}"'.format(original), 1)
+
+    return report
+
+
+def _get_dialect_details(dialect):
+
+    if isinstance(dialect, str):
+        dialect = json.loads(dialect)
+    dialect = dialect or {}
+
+    if dialect.get(u'header') is False:
+        header_rows = 0
+    else:
+        header_rows = max(dialect.get(u'headerRows') or [1])
+
+    quote_char = (dialect.get(u'csv') or {}).get(u'quoteChar', u'"')
+
+    return header_rows, quote_char.encode(u'utf8')
+
+
+@contextlib.contextmanager
+def _open_source(source, http_session=None):
+
+    if urlparse(source).scheme in (u'http', u'https'):
+        response = http_session.get(source, stream=True)
+        response.raise_for_status()
+        response.raw.decode_content = True
+        try:
+            yield io.BufferedReader(response.raw)
+        finally:
+            response.close()
+    else:
+        with open(source, u'rb') as f:
+            yield f
+
+
+def _iter_records(stream, quote_char=b'"'):
+    u'''
+    Yields the raw bytes of each CSV record in the stream
+
+    Lines are joined while there is an unbalanced number of quote characters,
+    so quoted values spanning multiple lines are kept in the same record.
+    Escaped quotes ("") don't affect the balance.
+    '''
+    record = b''
+    for line in stream:
+        record += line
+        if record.count(quote_char) % 2 == 0:
+            yield record
+            record = b''
+    if record:
+        yield record
+
+
+def _reservoir_sample(records, size):
+    u'''
+    Returns a random sample of `size` items of the provided (index, record)
+    pairs, in their original order
+    '''
+    # Use a fixed seed so the same rows are sampled on each run of an
+    # unchanged file
+    rng = random.Random(0)
+    reservoir = []
+    for index, record in records:
+        if index < size:
+            reservoir.append((index, record))
+        else:
+            position = rng.randint(0, index)
+            if position < size:
+                reservoir[position] = (index, record)
+
+    # Keep the rows in their original order
+    reservoir.sort(key=lambda item: item[0])
+
+    return reservoir
+
+
+def _block_sample(records, every, block_size):
+    u'''
+    Yields the (index, record) pairs of one block of `block_size` records out
+    of every `every` blocks
+    '''
+    for index, record in records:
+        if (index // block_size) % every == 0:
+            yield index, record
+
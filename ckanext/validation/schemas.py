@@ -0,0 +1,168 @@
+# encoding: utf-8
+
+import collections
+import hashlib
+import json
+import logging
+import threading
+import time
+
+import requests
+from frictionless import Schema
+
+import ckantoolkit as t
+
+from ckanext.validation.sessions import get_http_session
+
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_SCHEMA_CACHE_SIZE = 100
+DEFAULT_SCHEMA_CACHE_TTL = 300
+
+
+class SchemaCache(object):
+    u'''
+    Thread safe LRU cache with a time to live for the entries
+
+    Expired entries are not removed, so they can be revalidated with a
+    conditional request.
+    '''
+
+    def __init__(self, size=DEFAULT_SCHEMA_CACHE_SIZE,
+                 ttl=DEFAULT_SCHEMA_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        u'''
+        Returns a tuple with the entry stored for `key` (or None) and whether
+        it is still fresh
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None, False
+            self._entries.move_to_end(key)
+            return entry, time.time() < entry[u'expires']
+
+    def set(self, key, **entry):
+        entry[u'expires'] = time.time() + self.ttl
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+        return entry
+
+    def refresh(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry[u'expires'] = time.time() + self.ttl
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_cache = None
+
+
+def get_schema_cache():
+    u'''
+    Returns the schema cache shared by all jobs in the worker process
+    '''
+    global _cache
+
+    if _cache is None:
+        _cache = SchemaCache(
+            size=t.asint(t.config.get(
+                u'ckanext.validation.schema_cache_size',
+                DEFAULT_SCHEMA_CACHE_SIZE)),
+            ttl=t.asint(t.config.get(
+                u'ckanext.validation.schema_cache_ttl',
+                DEFAULT_SCHEMA_CACHE_TTL)),
+        )
+
+    return _cache
+
+
+def get_schema_descriptor(schema, http_session=None):
+    u'''
+    Returns the schema descriptor (a dict) for the `schema` field of a
+    resource, which can be a URL, a JSON string or a dict
+
+    Remote schemas are cached for `ckanext.validation.schema_cache_ttl`
+    seconds, after which a conditional request is made to check if they
+    changed.
+    '''
+    if isinstance(schema, dict):
+        return schema
+
+    if not schema.startswith(u'http'):
+        return json.loads(schema)
+
+    cache = get_schema_cache()
+    entry, fresh = cache.get(schema)
+    if fresh:
+        return entry[u'descriptor']
+
+    headers = {}
+    if entry:
+        if entry.get(u'etag'):
+            headers[u'If-None-Match'] = entry[u'etag']
+        if entry.get(u'last_modified'):
+            headers[u'If-Modified-Since'] = entry[u'last_modified']
+
+    http_session = http_session or get_http_session()
+    try:
+        response = http_session.get(schema, headers=headers)
+        if response.status_code == 304 and entry:
+            cache.refresh(schema)
+            return entry[u'descriptor']
+        response.raise_for_status()
+        descriptor = response.json()
+    except (requests.RequestException, ValueError) as e:
+        if entry:
+            log.warning(u'Could not refresh schema %s, using the cached '
+                        u'version: %s', schema, e)
+            return entry[u'descriptor']
+        raise
+
+    cache.set(
+        schema,
+        descriptor=descriptor,
+        etag=response.headers.get(u'ETag'),
+        last_modified=response.headers.get(u'Last-Modified'),
+    )
+
+    return descriptor
+
+
+def get_schema(descriptor):
+    u'''
+    Returns a Frictionless Schema object for the provided descriptor
+
+    Parsed schemas are cached by a hash of the descriptor, so resources
+    sharing the same schema don't need to parse it again. The returned
+    object is shared, so it must not be modified.
+    '''
+    cache = get_schema_cache()
+    key = hashlib.sha256(
+        json.dumps(descriptor, sort_keys=True).encode(u'utf8')).hexdigest()
+
+    entry, _ = cache.get(key)
+    if entry:
+        # The key depends on the contents, so the entry is always valid
+        return entry[u'schema']
+
+    return cache.set(
+        key, schema=Schema.from_descriptor(descriptor))[u'schema']
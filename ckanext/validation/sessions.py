@@ -0,0 +1,150 @@
+# encoding: utf-8
+
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import ckantoolkit as t
+
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_POOL_CONNECTIONS = 10
+DEFAULT_POOL_MAXSIZE = 10
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 0.5
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 60
+
+RETRY_STATUSES = [500, 502, 503, 504]
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_http_session(headers=None):
+    u'''
+    Returns the session used for all the requests made by the validation jobs
+
+    All sessions returned share a single pool of connections for the whole
+    process, so connections to the same host are kept alive and reused. The
+    provided `headers` (eg `Authorization`), the proxy configured in
+    `ckan.download_proxy` and the default timeouts are added to each request.
+    '''
+    proxies = None
+    proxy = t.config.get(u'ckan.download_proxy')
+    if proxy:
+        log.debug(u'Download resource for validation via proxy: %s', proxy)
+        proxies = {u'http': proxy, u'https': proxy}
+
+    return ValidationSession(
+        _get_shared_session(), headers=headers, proxies=proxies,
+        timeout=get_http_timeout())
+
+
+def get_http_timeout():
+    u'''
+    Returns a tuple with the connect and read timeouts in seconds
+    '''
+    return (
+        float(t.config.get(
+            u'ckanext.validation.http_connect_timeout',
+            DEFAULT_CONNECT_TIMEOUT)),
+        float(t.config.get(
+            u'ckanext.validation.http_read_timeout', DEFAULT_READ_TIMEOUT)),
+    )
+
+
+def reset_http_session():
+    u'''
+    Closes the shared session, so a new one is created on the next request
+    (eg after changing the configuration)
+    '''
+    global _session
+
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+
+
+def _get_shared_session():
+    global _session
+
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _create_session()
+
+    return _session
+
+
+def _create_session():
+
+    retries = Retry(
+        total=t.asint(t.config.get(
+            u'ckanext.validation.http_retries', DEFAULT_RETRIES)),
+        backoff_factor=float(t.config.get(
+            u'ckanext.validation.http_backoff_factor',
+            DEFAULT_BACKOFF_FACTOR)),
+        status_forcelist=RETRY_STATUSES,
+        # Return the last response instead of raising, so callers can handle
+        # the error status as usual
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=t.asint(t.config.get(
+            u'ckanext.validation.http_pool_connections',
+            DEFAULT_POOL_CONNECTIONS)),
+        pool_maxsize=t.asint(t.config.get(
+            u'ckanext.validation.http_pool_maxsize', DEFAULT_POOL_MAXSIZE)),
+        max_retries=retries,
+    )
+
+    session = requests.Session()
+    session.mount(u'http://', adapter)
+    session.mount(u'https://', adapter)
+
+    return session
+
+
+class ValidationSession(object):
+    u'''
+    Wrapper around the shared session that adds headers, proxies and timeouts
+    to each request, without modifying the shared session itself
+
+    It implements the subset of the `requests.Session` interface used by the
+    extension and Frictionless Framework.
+    '''
+
+    def __init__(self, session, headers=None, proxies=None, timeout=None):
+        self.session = session
+        self.headers = dict(headers or {})
+        self.proxies = proxies
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        headers = dict(self.headers)
+        headers.update(kwargs.pop(u'headers', None) or {})
+        kwargs[u'headers'] = headers
+        if self.proxies:
+            kwargs.setdefault(u'proxies', self.proxies)
+        if kwargs.get(u'timeout') is None:
+            kwargs[u'timeout'] = self.timeout
+
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault(u'allow_redirects', True)
+        return self.request(u'GET', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        kwargs.setdefault(u'allow_redirects', False)
+        return self.request(u'HEAD', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request(u'POST', url, **kwargs)
@@ -1,4 +1,5 @@
 import pytest
+from unittest import mock
 
 from ckan.lib import uploader
 from ckanext.validation.model import create_tables, tables_exist
@@ -16,3 +17,12 @@ def validation_setup():
 def mock_uploads(ckan_config, monkeypatch, tmp_path):
     monkeypatch.setitem(ckan_config, "ckan.storage_path", str(tmp_path))
     monkeypatch.setattr(uploader, "_storage_path", str(tmp_path))
+
+
+@pytest.fixture(autouse=True)
+def mock_remote_fingerprint():
+    # Avoid the HEAD requests made to check if remote sources changed
+    with mock.patch(
+        "ckanext.validation.jobs._get_remote_fingerprint", return_value=None
+    ) as mock_fingerprint:
+        yield mock_fingerprint
@@ -0,0 +1,127 @@
+import io
+import os
+import time
+from unittest import mock
+
+import pytest
+
+from ckanext.validation import cache
+
+
+def _mock_response(status_code=200, body=b"a,b\n1,2\n", headers=None):
+    response = mock.Mock(
+        status_code=status_code,
+        headers=headers or {},
+        raw=io.BytesIO(body),
+    )
+    if status_code >= 400:
+        response.raise_for_status.side_effect = cache.requests.HTTPError()
+    return response
+
+
+@pytest.fixture
+def cache_dir(tmp_path, ckan_config, monkeypatch):
+    path = str(tmp_path / "cache")
+    monkeypatch.setitem(
+        ckan_config, "ckanext.validation.download_cache_dir", path)
+    return path
+
+
+class TestDownloadCache(object):
+    def test_cache_disabled(self):
+
+        session = mock.Mock()
+
+        assert cache.get_cached_source("http://example.com/file.csv", session) is None
+        assert not session.get.called
+
+    def test_cache_stores_file(self, cache_dir):
+
+        session = mock.Mock()
+        session.get.return_value = _mock_response(headers={"ETag": '"abc"'})
+
+        path = cache.get_cached_source("http://example.com/file.csv", session)
+
+        assert path.startswith(cache_dir)
+        with open(path, "rb") as f:
+            assert f.read() == b"a,b\n1,2\n"
+
+        entries = cache.get_cache_info()
+        assert len(entries) == 1
+        assert entries[0]["url"] == "http://example.com/file.csv"
+        assert entries[0]["etag"] == '"abc"'
+        assert entries[0]["size"] == 8
+
+    def test_cache_conditional_request_not_modified(self, cache_dir):
+
+        session = mock.Mock()
+        session.get.return_value = _mock_response(
+            headers={"ETag": '"abc"', "Last-Modified": "Mon, 01 Jan 2024 00:00:00 GMT"})
+        path = cache.get_cached_source("http://example.com/file.csv", session)
+
+        session.get.return_value = _mock_response(status_code=304, body=b"")
+        cached_path = cache.get_cached_source("http://example.com/file.csv", session)
+
+        assert cached_path == path
+        assert session.get.call_args[1]["headers"] == {
+            "If-None-Match": '"abc"',
+            "If-Modified-Since": "Mon, 01 Jan 2024 00:00:00 GMT",
+        }
+        with open(path, "rb") as f:
+            assert f.read() == b"a,b\n1,2\n"
+
+    def test_cache_conditional_request_modified(self, cache_dir):
+
+        session = mock.Mock()
+        session.get.return_value = _mock_response(headers={"ETag": '"abc"'})
+        cache.get_cached_source("http://example.com/file.csv", session)
+
+        session.get.return_value = _mock_response(
+            body=b"a,b\n3,4\n", headers={"ETag": '"def"'})
+        path = cache.get_cached_source("http://example.com/file.csv", session)
+
+        with open(path, "rb") as f:
+            assert f.read() == b"a,b\n3,4\n"
+        assert cache.get_cache_info()[0]["etag"] == '"def"'
+
+    def test_cache_download_error(self, cache_dir):
+
+        session = mock.Mock()
+        session.get.return_value = _mock_response(status_code=500)
+
+        assert cache.get_cached_source("http://example.com/file.csv", session) is None
+        assert cache.get_cache_info() == []
+
+    def test_cache_prune_by_size(self, cache_dir):
+
+        session = mock.Mock()
+        for i in range(3):
+            session.get.return_value = _mock_response()
+            path = cache.get_cached_source(
+                "http://example.com/file{}.csv".format(i), session)
+            os.utime(path, (time.time() - 100 + i, time.time() - 100 + i))
+
+        removed = cache.prune(max_size=20)
+
+        assert removed == 1
+        assert [e["url"] for e in cache.get_cache_info()] == [
+            "http://example.com/file2.csv", "http://example.com/file1.csv"]
+
+    def test_cache_prune_by_age(self, cache_dir):
+
+        session = mock.Mock()
+        session.get.return_value = _mock_response()
+        path = cache.get_cached_source("http://example.com/file.csv", session)
+        os.utime(path, (time.time() - 3600, time.time() - 3600))
+
+        assert cache.prune(max_age=60) == 1
+        assert cache.get_cache_info() == []
+
+    def test_cache_purge(self, cache_dir):
+
+        session = mock.Mock()
+        session.get.return_value = _mock_response()
+        cache.get_cached_source("http://example.com/file.csv", session)
+
+        assert cache.purge() == 1
+        assert os.listdir(cache_dir) == []
@@ -0,0 +1,75 @@
+import itertools
+from unittest import mock
+
+from frictionless import validate, system, Schema
+
+from ckanext.validation.checks import (
+    time_limit,
+    collect_keys,
+    add_time_limit_warning,
+)
+
+
+def _write_csv(path, rows=100):
+    with open(path, "w") as f:
+        f.write("id,name\n")
+        for i in range(1, rows + 1):
+            f.write("{},name {}\n".format(i, i))
+
+
+class TestChecks(object):
+    @mock.patch("ckanext.validation.checks.time")
+    def test_time_limit_stops_validation(self, mock_time, tmp_path):
+
+        mock_time.time.side_effect = itertools.count(step=10)
+        path = str(tmp_path / "data.csv")
+        _write_csv(path)
+
+        check = time_limit(seconds=25)
+        with system.use_context(trusted=True):
+            report = validate(path, checks=[check])
+
+        assert check.reached is True
+        assert report.valid is True
+        assert report.tasks[0].stats.rows < 100
+
+    def test_time_limit_not_reached(self, tmp_path):
+
+        path = str(tmp_path / "data.csv")
+        _write_csv(path)
+
+        check = time_limit(seconds=300)
+        with system.use_context(trusted=True):
+            report = validate(path, checks=[check])
+
+        assert check.reached is False
+        assert report.tasks[0].stats.rows == 100
+
+    def test_add_time_limit_warning(self):
+
+        report = {"tasks": [{"stats": {"warnings": 0}, "warnings": []}]}
+
+        add_time_limit_warning(report, 30)
+
+        assert report["tasks"][0]["warnings"] == ["reached time limit: 30 seconds"]
+        assert report["tasks"][0]["stats"]["warnings"] == 1
+
+    def test_collect_keys(self, tmp_path):
+
+        path = str(tmp_path / "data.csv")
+        _write_csv(path, rows=3)
+
+        schema = {
+            "fields": [
+                {"name": "id", "type": "integer", "constraints": {"unique": True}},
+                {"name": "name", "type": "string"},
+            ],
+            "primaryKey": ["name"],
+        }
+
+        check = collect_keys()
+        with system.use_context(trusted=True):
+            validate(path, schema=Schema.from_descriptor(schema), checks=[check])
+
+        assert check.unique == {"id": {1: 2, 2: 3, 3: 4}}
+        assert len(check.primary) == 3
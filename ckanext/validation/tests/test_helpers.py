@@ -98,6 +98,32 @@ class TestBadges(object):
         assert 'alt="Error during validation"' in out
         assert 'title="{}"'.format(resource["validation_timestamp"]) in out
 
+    def test_get_validation_badge_sampled(self):
+
+        resource = factories.Resource(
+            format="CSV",
+            validation_status="success",
+            validation_sampled=True,
+            validation_timestamp=datetime.datetime.utcnow().isoformat(),
+        )
+
+        out = get_validation_badge(resource)
+
+        assert 'src="/images/badges/data-success-flat.svg"' in out
+        assert 'alt="Valid data (sampled)"' in out
+
+    def test_get_validation_badge_pending(self):
+
+        resource = factories.Resource(
+            format="CSV",
+            validation_status="pending",
+        )
+
+        out = get_validation_badge(resource)
+
+        assert 'src="/images/badges/data-pending-flat.svg"' in out
+        assert 'alt="Validation pending"' in out
+
     def test_get_validation_badge_other(self):
 
         resource = factories.Resource(
@@ -0,0 +1,156 @@
+from unittest import mock
+
+import pytest
+
+from ckanext.validation import indexing
+
+
+@pytest.fixture
+def mock_redis():
+    redis = mock.MagicMock()
+    with mock.patch(
+        "ckanext.validation.queues.get_redis_connection", return_value=redis
+    ):
+        yield redis
+
+
+@pytest.mark.usefixtures("mock_redis")
+class TestIndexBuffer(object):
+    @mock.patch("ckanext.validation.indexing.time.time", return_value=1000)
+    def test_queue_for_reindex_keeps_first_change(self, mock_time, mock_redis):
+
+        indexing.queue_for_reindex("pkg-1")
+
+        mock_redis.zadd.assert_called_with(
+            indexing._get_buffer_key(), {"pkg-1": 1000}, nx=True)
+
+    @mock.patch("ckanext.validation.indexing.reindex")
+    def test_queue_for_reindex_without_buffer(self, mock_reindex, mock_redis):
+
+        mock_redis.zadd.side_effect = indexing.RedisError()
+
+        indexing.queue_for_reindex("pkg-1")
+
+        mock_reindex.assert_called_with(["pkg-1"])
+
+    @mock.patch("ckanext.validation.indexing.time.time", return_value=1000)
+    @mock.patch("ckanext.validation.indexing.reindex", return_value=1)
+    def test_flush_by_age(self, mock_reindex, mock_time, mock_redis):
+
+        mock_redis.zrangebyscore.return_value = [b"pkg-1", b"pkg-2"]
+        # Another process flushed pkg-2 in the meantime
+        mock_redis.pipeline.return_value.execute.return_value = [1, 0]
+
+        assert indexing.flush(30) == 1
+
+        mock_redis.zrangebyscore.assert_called_with(
+            indexing._get_buffer_key(), "-inf", 970)
+        mock_reindex.assert_called_with(["pkg-1"])
+
+    @mock.patch("ckanext.validation.indexing.reindex")
+    def test_flush_empty(self, mock_reindex, mock_redis):
+
+        mock_redis.zrangebyscore.return_value = []
+
+        assert indexing.flush() == 0
+        assert not mock_reindex.called
+
+    @mock.patch("ckanext.validation.indexing.flush")
+    @mock.patch("ckanext.validation.queues.get_queue_depth")
+    def test_flush_if_due(self, mock_depth, mock_flush):
+
+        mock_depth.return_value = 0
+        indexing.flush_if_due()
+        mock_flush.assert_called_with()
+
+        mock_depth.return_value = 5
+        indexing.flush_if_due()
+        mock_flush.assert_called_with(indexing.DEFAULT_INDEX_DEBOUNCE)
+
+    @mock.patch("ckanext.validation.indexing.time.time", return_value=1000)
+    @mock.patch("ckanext.validation.indexing.t.enqueue_job")
+    @mock.patch("ckanext.validation.indexing.reindex", return_value=2)
+    @mock.patch("ckanext.validation.queues.get_queue_depth", return_value=0)
+    def test_flush_if_due_last_job(
+            self, mock_depth, mock_reindex, mock_enqueue, mock_time,
+            mock_redis):
+
+        # Both changes are more recent than the debounce time
+        mock_redis.zrangebyscore.return_value = [b"pkg-1", b"pkg-2"]
+        mock_redis.pipeline.return_value.execute.return_value = [1, 1]
+
+        assert indexing.flush_if_due() == 2
+
+        mock_redis.zrangebyscore.assert_called_with(
+            indexing._get_buffer_key(), "-inf", "+inf")
+        mock_reindex.assert_called_with(["pkg-1", "pkg-2"])
+        assert not mock_enqueue.called
+
+    @mock.patch("ckanext.validation.indexing.t.enqueue_job")
+    @mock.patch("ckanext.validation.indexing.flush", return_value=0)
+    @mock.patch("ckanext.validation.queues.get_queue")
+    @mock.patch("ckanext.validation.queues.get_queue_depth", return_value=5)
+    def test_flush_if_due_schedules_flush_job(
+            self, mock_depth, mock_queue, mock_flush, mock_enqueue,
+            mock_redis):
+
+        mock_redis.zcard.return_value = 2
+        mock_redis.set.side_effect = [True, False]
+
+        indexing.flush_if_due()
+        indexing.flush_if_due()
+
+        mock_redis.set.assert_called_with(
+            indexing._get_flush_job_key(), 1, nx=True,
+            ex=indexing.DEFAULT_INDEX_DEBOUNCE)
+        # Only one flush job is enqueued while it is waiting
+        assert mock_enqueue.call_count == 1
+        assert mock_enqueue.call_args[0][0] == indexing.flush_job
+
+    @mock.patch("ckanext.validation.indexing.t.enqueue_job")
+    @mock.patch("ckanext.validation.indexing.flush", return_value=0)
+    @mock.patch("ckanext.validation.queues.get_queue")
+    @mock.patch("ckanext.validation.queues.get_queue_depth", return_value=5)
+    def test_flush_if_due_empty_buffer_no_flush_job(
+            self, mock_depth, mock_queue, mock_flush, mock_enqueue,
+            mock_redis):
+
+        mock_redis.zcard.return_value = 0
+
+        indexing.flush_if_due()
+
+        assert not mock_redis.set.called
+        assert not mock_enqueue.called
+
+    @mock.patch("ckanext.validation.indexing.flush_if_due", return_value=1)
+    def test_flush_job(self, mock_flush_if_due, mock_redis):
+
+        assert indexing.flush_job() == 1
+
+        mock_redis.delete.assert_called_with(indexing._get_flush_job_key())
+        assert mock_flush_if_due.called
+
+
+@pytest.mark.usefixtures("clean_db", "with_plugins")
+class TestReindex(object):
+    @mock.patch("ckan.lib.search.commit")
+    @mock.patch("ckan.lib.search.rebuild")
+    def test_reindex_commits_once(self, mock_rebuild, mock_commit):
+        from ckan.tests import factories
+        from ckan.tests.helpers import call_action
+
+        dataset1 = factories.Dataset()
+        dataset2 = factories.Dataset()
+        dataset3 = factories.Dataset()
+        call_action("package_delete", id=dataset3["id"])
+        mock_rebuild.reset_mock()
+        mock_commit.reset_mock()
+
+        count = indexing.reindex(
+            [dataset1["id"], dataset2["id"], dataset3["id"], "missing"])
+
+        assert count == 2
+        assert sorted(mock_rebuild.call_args[1]["package_ids"]) == sorted(
+            [dataset1["id"], dataset2["id"]])
+        assert mock_rebuild.call_args[1]["defer_commit"] is True
+        assert mock_commit.call_count == 1
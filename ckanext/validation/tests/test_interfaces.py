@@ -104,9 +104,9 @@ class TestInterfaceSync():
             format='CSV',
             package_id=dataset['id']
         )
-        # One for the resource_update, one for the resource_patch one
-        # to store the result, which does not trigger another job
-        assert _get_plugin_calls() == 2
+        # The result is stored without updating the resource again, so
+        # plugins are only called once
+        assert _get_plugin_calls() == 1
 
         assert mock_validation.called
 
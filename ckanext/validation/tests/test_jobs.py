@@ -1,8 +1,11 @@
 import pytest
 from unittest import mock
+import datetime
 import json
 import io
 
+import requests
+
 import ckantoolkit
 
 from ckan.lib.uploader import ResourceUpload
@@ -11,6 +14,7 @@ from ckan.tests import factories
 
 from ckanext.validation.model import create_tables, tables_exist, Validation
 from ckanext.validation.jobs import run_validation_job, uploader, Session
+from ckanext.validation.utils import get_resource_signature
 from ckanext.validation.tests.helpers import (
     VALID_REPORT,
     INVALID_REPORT,
@@ -83,6 +87,40 @@ class TestValidationJob(object):
         assert mock_validate.call_args[1]["format"] == "csv"
         assert mock_validate.call_args[1]["schema"].to_dict() == schema
 
+    @mock.patch("ckanext.validation.jobs.validate", return_value=VALID_REPORT)
+    @mock.patch("ckanext.validation.schemas.get_http_session")
+    @mock.patch.object(Session, "commit")
+    @mock.patch.object(ckantoolkit, "get_action")
+    def test_job_run_schema_url(
+        self, mock_get_action, mock_commit, mock_get_http_session, mock_validate
+    ):
+
+        org = factories.Organization()
+        dataset = factories.Dataset(private=True, owner_org=org["id"])
+
+        schema = {
+            "fields": [
+                {"name": "id", "type": "integer"},
+                {"name": "description", "type": "string"},
+            ]
+        }
+        mock_get_http_session.return_value.get.return_value = mock.Mock(
+            status_code=200, headers={}, json=mock.Mock(return_value=schema))
+
+        resource = {
+            "id": "test",
+            "url": "http://example.com/file.csv",
+            "format": "csv",
+            "schema": "http://example.com/schema_for_job.json",
+            "package_id": dataset["id"],
+        }
+
+        run_validation_job(resource)
+        run_validation_job(resource)
+
+        assert mock_validate.call_args[1]["schema"].to_dict() == schema
+        assert mock_get_http_session.return_value.get.call_count == 1
+
     @mock.patch("ckanext.validation.jobs.validate", return_value=VALID_REPORT)
     @mock.patch.object(
         uploader, "get_resource_uploader", return_value=mock_get_resource_uploader({})
@@ -126,6 +164,159 @@ class TestValidationJob(object):
         assert validation.status == "success"
         assert json.loads(validation.report) == VALID_REPORT
         assert validation.finished
+        assert validation.signature == get_resource_signature(resource)
+
+    @mock.patch("ckanext.validation.jobs.validate", side_effect=RuntimeError)
+    def test_job_run_interrupted_does_not_store_signature(self, mock_validate):
+
+        resource = factories.Resource(url="http://example.com/file.csv", format="csv")
+
+        with pytest.raises(RuntimeError):
+            run_validation_job(resource)
+
+        validation = (
+            Session.query(Validation)
+            .filter(Validation.resource_id == resource["id"])
+            .one()
+        )
+
+        assert validation.status == "running"
+        assert validation.signature is None
+
+    @mock.patch("ckanext.validation.jobs.validate", return_value=VALID_REPORT)
+    def test_job_run_loads_resource_by_id(self, mock_validate):
+
+        resource = factories.Resource(url="http://example.com/file.csv", format="csv")
+        call_action(
+            "resource_patch", id=resource["id"], url="http://example.com/new.csv")
+
+        run_validation_job(resource["id"])
+
+        assert mock_validate.call_args[0][0] == "http://example.com/new.csv"
+        validation = (
+            Session.query(Validation)
+            .filter(Validation.resource_id == resource["id"])
+            .one()
+        )
+        assert validation.status == "success"
+
+    @mock.patch("ckanext.validation.jobs.validate", return_value=VALID_REPORT)
+    def test_job_run_deleted_resource_is_skipped(self, mock_validate):
+
+        resource = factories.Resource(url="http://example.com/file.csv", format="csv")
+        call_action("resource_delete", id=resource["id"])
+
+        run_validation_job(resource["id"])
+
+        assert not mock_validate.called
+
+    @mock.patch("ckanext.validation.jobs.validate", return_value=VALID_REPORT)
+    def test_job_run_superseded_revision_is_skipped(self, mock_validate):
+
+        resource = factories.Resource(url="http://example.com/file.csv", format="csv")
+        created = datetime.datetime.utcnow()
+        Session.add(Validation(
+            resource_id=resource["id"], status="created", created=created))
+        Session.commit()
+
+        run_validation_job(
+            resource["id"],
+            (created - datetime.timedelta(seconds=5)).isoformat())
+        assert not mock_validate.called
+
+        run_validation_job(resource["id"], created.isoformat())
+        assert mock_validate.called
+
+    @mock.patch("ckanext.validation.jobs.delete_local_uploaded_file")
+    @mock.patch("ckanext.validation.jobs.validate", return_value=INVALID_REPORT)
+    def test_job_run_rejects_invalid_new_resource(
+        self, mock_validate, mock_delete_file
+    ):
+
+        resource = factories.Resource(url="http://example.com/file.csv", format="csv")
+
+        run_validation_job(
+            resource["id"], None, {"local_upload": True, "new_resource": True})
+
+        mock_delete_file.assert_called_with(resource["id"])
+        with pytest.raises(ckantoolkit.ObjectNotFound):
+            call_action("resource_show", id=resource["id"])
+        assert (
+            Session.query(Validation)
+            .filter(Validation.resource_id == resource["id"])
+            .count() == 0
+        )
+
+    @mock.patch("ckanext.validation.jobs.delete_local_uploaded_file")
+    @mock.patch("ckanext.validation.jobs.validate", return_value=INVALID_REPORT)
+    def test_job_run_rejects_invalid_updated_resource(
+        self, mock_validate, mock_delete_file
+    ):
+
+        resource = factories.Resource(url="http://example.com/file.csv", format="csv")
+
+        run_validation_job(
+            resource["id"], None, {"local_upload": True, "new_resource": False})
+
+        mock_delete_file.assert_called_with(resource["id"])
+        resource = call_action("resource_show", id=resource["id"])
+        assert resource["validation_status"] == "failure"
+
+    @mock.patch("ckanext.validation.jobs.delete_local_uploaded_file")
+    @mock.patch("ckanext.validation.jobs.validate", return_value=VALID_REPORT)
+    def test_job_run_does_not_reject_valid_resource(
+        self, mock_validate, mock_delete_file
+    ):
+
+        resource = factories.Resource(url="http://example.com/file.csv", format="csv")
+
+        run_validation_job(
+            resource["id"], None, {"local_upload": True, "new_resource": True})
+
+        assert not mock_delete_file.called
+        resource = call_action("resource_show", id=resource["id"])
+        assert resource["validation_status"] == "success"
+
+    @mock.patch("ckanext.validation.jobs.claim_pending_job", return_value=False)
+    @mock.patch("ckanext.validation.jobs.get_current_job")
+    @mock.patch("ckanext.validation.jobs.validate", return_value=VALID_REPORT)
+    def test_job_run_superseded_job_is_dropped(
+        self, mock_validate, mock_get_current_job, mock_claim
+    ):
+
+        resource = factories.Resource(url="http://example.com/file.csv", format="csv")
+        mock_get_current_job.return_value = mock.Mock(id="some-job-id")
+
+        run_validation_job(resource, queued=True)
+
+        mock_claim.assert_called_with(resource["id"], "some-job-id")
+        assert not mock_validate.called
+        assert (
+            Session.query(Validation)
+            .filter(Validation.resource_id == resource["id"])
+            .count() == 0
+        )
+
+    @mock.patch("ckanext.validation.jobs.queue_for_reindex")
+    @mock.patch("ckanext.validation.jobs.claim_pending_job")
+    @mock.patch("ckanext.validation.jobs.get_current_job")
+    @mock.patch("ckanext.validation.jobs.validate", return_value=VALID_REPORT)
+    def test_job_run_sync_inside_another_job(
+        self, mock_validate, mock_get_current_job, mock_claim,
+        mock_queue_for_reindex
+    ):
+
+        resource = factories.Resource(url="http://example.com/file.csv", format="csv")
+        mock_get_current_job.return_value = mock.Mock(id="harvest-job-id")
+
+        run_validation_job(resource)
+
+        assert not mock_claim.called
+        assert not mock_queue_for_reindex.called
+        assert mock_validate.called
+
+        resource = call_action("resource_show", id=resource["id"])
+        assert resource["validation_status"] == "success"
 
     @mock.patch("ckanext.validation.jobs.validate", return_value=INVALID_REPORT)
     def test_job_run_invalid_stores_validation_object(self, mock_validate):
@@ -148,6 +339,10 @@ class TestValidationJob(object):
     def test_job_run_error_stores_validation_object(self, mock_validate):
 
         resource = factories.Resource(url="http://example.com/file.csv", format="csv")
+        Session.add(Validation(
+            resource_id=resource["id"], status="success",
+            signature=get_resource_signature(resource)))
+        Session.commit()
 
         run_validation_job(resource)
 
@@ -160,6 +355,7 @@ class TestValidationJob(object):
         assert validation.status == "error"
         assert validation.error == {"message": ['Errors validating the data']}
         assert validation.finished
+        assert validation.signature is None
 
     @mock.patch(
         "ckanext.validation.jobs.validate", return_value=VALID_REPORT_LOCAL_FILE
@@ -202,6 +398,328 @@ class TestValidationJob(object):
             updated_resource["validation_timestamp"] == validation.finished.isoformat()
         )
 
+    @mock.patch("ckanext.validation.jobs.validate", return_value=VALID_REPORT)
+    def test_job_run_does_not_update_dataset(self, mock_validate):
+
+        dataset = factories.Dataset(
+            resources=[{"url": "http://example.com/file.csv", "format": "csv"}])
+        resource_id = dataset["resources"][0]["id"]
+
+        with mock.patch.object(
+            ckantoolkit, "get_action", wraps=ckantoolkit.get_action
+        ) as mock_get_action:
+            run_validation_job(resource_id)
+
+        assert mock_get_action.call_count == 0
+
+        updated_dataset = call_action("package_show", id=dataset["id"])
+        assert updated_dataset["metadata_modified"] == dataset["metadata_modified"]
+        assert updated_dataset["resources"][0]["validation_status"] == "success"
+
+    @mock.patch("ckanext.validation.jobs.flush_if_due")
+    @mock.patch("ckanext.validation.jobs.queue_for_reindex")
+    @mock.patch("ckanext.validation.jobs.claim_pending_job", return_value=True)
+    @mock.patch("ckanext.validation.jobs.get_current_job")
+    @mock.patch("ckanext.validation.jobs.validate", return_value=VALID_REPORT)
+    def test_job_run_in_worker_buffers_reindex(
+        self, mock_validate, mock_get_current_job, mock_claim,
+        mock_queue_for_reindex, mock_flush_if_due
+    ):
+
+        dataset = factories.Dataset(
+            resources=[{
+                "url": "http://example.com/file.csv",
+                "format": "csv",
+                "some_extra": "some-value",
+            }])
+        resource_id = dataset["resources"][0]["id"]
+        mock_get_current_job.return_value = mock.Mock(id="some-job-id")
+
+        run_validation_job(resource_id, queued=True)
+
+        mock_queue_for_reindex.assert_called_with(dataset["id"])
+        assert mock_flush_if_due.called
+
+        resource = call_action("resource_show", id=resource_id)
+        assert resource["validation_status"] == "success"
+        assert resource["validation_timestamp"]
+        assert resource["some_extra"] == "some-value"
+
+    @mock.patch("ckanext.validation.jobs.validate", return_value=VALID_REPORT)
+    @mock.patch.object(
+        uploader, "get_resource_uploader", return_value=mock.Mock()
+    )
+    @mock.patch("ckanext.validation.jobs.get_http_session")
+    def test_job_run_private_cloud_upload_passes_auth_header(
+        self, mock_get_http_session, mock_uploader, mock_validate
+    ):
+
+        org = factories.Organization()
+        dataset = factories.Dataset(private=True, owner_org=org["id"])
+        resource = {
+            "id": "test",
+            "url": "http://example.com/file.csv",
+            "url_type": "upload",
+            "format": "csv",
+            "package_id": dataset["id"],
+        }
+
+        with mock.patch(
+            "ckanext.validation.jobs._get_site_user_api_key",
+            return_value="some-key",
+        ):
+            run_validation_job(resource)
+
+        mock_get_http_session.assert_any_call(
+            headers={"Authorization": "some-key"})
+
+    @mock.patch("ckanext.validation.jobs.validate", return_value=VALID_REPORT)
+    @mock.patch.object(
+        uploader, "get_resource_uploader", return_value=mock.Mock()
+    )
+    @mock.patch("ckanext.validation.schemas.get_http_session")
+    @mock.patch("ckanext.validation.jobs.get_http_session")
+    def test_job_run_private_cloud_upload_schema_fetched_without_auth(
+        self, mock_get_http_session, mock_schema_http_session, mock_uploader,
+        mock_validate
+    ):
+
+        org = factories.Organization()
+        dataset = factories.Dataset(private=True, owner_org=org["id"])
+        schema = {"fields": [{"name": "id", "type": "integer"}]}
+        mock_schema_http_session.return_value.get.return_value = mock.Mock(
+            status_code=200, headers={}, json=mock.Mock(return_value=schema))
+        resource = {
+            "id": "test",
+            "url": "http://example.com/file.csv",
+            "url_type": "upload",
+            "format": "csv",
+            "schema": "http://example.com/schema_for_private_upload.json",
+            "package_id": dataset["id"],
+        }
+
+        with mock.patch(
+            "ckanext.validation.jobs._get_site_user_api_key",
+            return_value="some-key",
+        ):
+            run_validation_job(resource)
+
+        mock_schema_http_session.assert_called_once_with()
+        assert not mock_get_http_session.return_value.get.called
+
+    @mock.patch("ckanext.validation.jobs._get_digest", return_value="some-digest")
+    @mock.patch("ckanext.validation.jobs.validate", return_value=VALID_REPORT)
+    def test_job_run_reuses_report_if_unchanged(self, mock_validate, mock_digest):
+
+        resource = factories.Resource(url="http://example.com/file.csv", format="csv")
+
+        run_validation_job(resource)
+        run_validation_job(resource)
+
+        assert mock_validate.call_count == 1
+
+        validation = (
+            Session.query(Validation)
+            .filter(Validation.resource_id == resource["id"])
+            .one()
+        )
+
+        assert validation.status == "success"
+        assert validation.digest == "some-digest"
+        assert json.loads(validation.report) == VALID_REPORT
+
+    @mock.patch("ckanext.validation.jobs._get_digest")
+    @mock.patch("ckanext.validation.jobs.validate", return_value=VALID_REPORT)
+    def test_job_run_validates_if_changed(self, mock_validate, mock_digest):
+
+        resource = factories.Resource(url="http://example.com/file.csv", format="csv")
+
+        mock_digest.return_value = "some-digest"
+        run_validation_job(resource)
+        mock_digest.return_value = "other-digest"
+        run_validation_job(resource)
+
+        assert mock_validate.call_count == 2
+
+    @mock.patch("ckanext.validation.jobs.validate", return_value=VALID_REPORT)
+    def test_job_run_validates_if_limits_changed(
+        self, mock_validate, mock_remote_fingerprint, ckan_config, monkeypatch
+    ):
+
+        mock_remote_fingerprint.return_value = "some-etag"
+        resource = factories.Resource(url="http://example.com/file.csv", format="csv")
+
+        run_validation_job(resource)
+        run_validation_job(resource)
+        assert mock_validate.call_count == 1
+
+        monkeypatch.setitem(ckan_config, "ckanext.validation.limit_rows", "100")
+        run_validation_job(resource)
+        assert mock_validate.call_count == 2
+
+        monkeypatch.setitem(ckan_config, "ckanext.validation.sample_mode", "head")
+        run_validation_job(resource)
+        assert mock_validate.call_count == 3
+
+    @pytest.mark.ckan_config("ckanext.validation.reuse_unchanged_reports", False)
+    @mock.patch("ckanext.validation.jobs.validate", return_value=VALID_REPORT)
+    def test_job_run_reuse_disabled(self, mock_validate):
+
+        resource = factories.Resource(url="http://example.com/file.csv", format="csv")
+
+        run_validation_job(resource)
+        run_validation_job(resource)
+
+        assert mock_validate.call_count == 2
+
+    @pytest.mark.ckan_config("ckanext.validation.sample_mode", "head")
+    @pytest.mark.ckan_config("ckanext.validation.sample_rows", "50")
+    @mock.patch("ckanext.validation.jobs.validate")
+    def test_job_run_sampled_head(self, mock_validate):
+
+        report = dict(VALID_REPORT_LOCAL_FILE)
+        report["tasks"] = [
+            dict(report["tasks"][0], warnings=["reached row limit: 50"])]
+        mock_validate.return_value = report
+
+        resource = factories.Resource(url="http://example.com/file.csv", format="csv")
+
+        run_validation_job(resource)
+
+        assert mock_validate.call_args[1]["limit_rows"] == 50
+
+        validation = (
+            Session.query(Validation)
+            .filter(Validation.resource_id == resource["id"])
+            .one()
+        )
+
+        assert validation.status == "success"
+        assert json.loads(validation.report)["sample"] == {
+            "mode": "head", "rows": 50, "rate": None}
+
+        updated_resource = call_action("resource_show", id=resource["id"])
+        assert ckantoolkit.asbool(updated_resource["validation_sampled"])
+
+    @pytest.mark.ckan_config("ckanext.validation.sample_mode", "reservoir")
+    @pytest.mark.ckan_config("ckanext.validation.reuse_unchanged_reports", "false")
+    @mock.patch("ckanext.validation.jobs.get_http_session")
+    @mock.patch("ckanext.validation.jobs.validate")
+    def test_job_run_sample_download_error_stores_error(
+        self, mock_validate, mock_get_http_session
+    ):
+
+        mock_get_http_session.return_value.get.side_effect = (
+            requests.ConnectionError("Connection refused"))
+
+        resource = factories.Resource(url="http://example.com/file.csv", format="csv")
+
+        run_validation_job(resource)
+
+        assert not mock_validate.called
+
+        validation = (
+            Session.query(Validation)
+            .filter(Validation.resource_id == resource["id"])
+            .one()
+        )
+        assert validation.status == "error"
+        assert "Connection refused" in validation.error["message"][0]
+
+    @pytest.mark.ckan_config("ckanext.validation.parallel_workers", "4")
+    @mock.patch("ckanext.validation.jobs.get_http_session")
+    @mock.patch("ckanext.validation.jobs.validate")
+    def test_job_run_parallel_download_error_stores_error(
+        self, mock_validate, mock_get_http_session
+    ):
+
+        response = mock_get_http_session.return_value.get.return_value
+        response.raise_for_status.side_effect = requests.HTTPError(
+            "404 Client Error: Not Found")
+
+        resource = factories.Resource(url="http://example.com/file.csv", format="csv")
+
+        run_validation_job(resource)
+
+        assert not mock_validate.called
+
+        validation = (
+            Session.query(Validation)
+            .filter(Validation.resource_id == resource["id"])
+            .one()
+        )
+        assert validation.status == "error"
+        assert validation.finished
+        assert "404 Client Error" in validation.error["message"][0]
+
+    @pytest.mark.ckan_config("ckanext.validation.sample_mode", "head")
+    @pytest.mark.ckan_config("ckanext.validation.sample_rows", "100")
+    @mock.patch("ckanext.validation.jobs.validate", return_value=VALID_REPORT_LOCAL_FILE)
+    def test_job_run_sampled_head_all_rows_validated(self, mock_validate):
+
+        resource = factories.Resource(url="http://example.com/file.csv", format="csv")
+
+        run_validation_job(resource)
+
+        validation = (
+            Session.query(Validation)
+            .filter(Validation.resource_id == resource["id"])
+            .one()
+        )
+
+        assert "sample" not in json.loads(validation.report)
+
+    @pytest.mark.ckan_config("ckanext.validation.limit_rows", "1000")
+    @pytest.mark.ckan_config("ckanext.validation.limit_seconds", "30")
+    @mock.patch("ckanext.validation.jobs.validate")
+    def test_job_run_limits_from_config(self, mock_validate):
+
+        report = dict(VALID_REPORT_LOCAL_FILE)
+        report["tasks"] = [
+            dict(report["tasks"][0], warnings=["reached row limit: 1000"])]
+        mock_validate.return_value = report
+
+        resource = factories.Resource(url="http://example.com/file.csv", format="csv")
+
+        run_validation_job(resource)
+
+        assert mock_validate.call_args[1]["limit_rows"] == 1000
+        checks = mock_validate.call_args[1]["checks"]
+        assert [c.type for c in checks] == ["ckanext-validation-time-limit"]
+        assert checks[0].seconds == 30
+
+        validation = (
+            Session.query(Validation)
+            .filter(Validation.resource_id == resource["id"])
+            .one()
+        )
+
+        assert json.loads(validation.report)["truncated"] == {"rows": 1000}
+        assert "sample" not in json.loads(validation.report)
+
+    @pytest.mark.ckan_config("ckanext.validation.limit_rows", "1000")
+    @mock.patch("ckanext.validation.jobs.validate", return_value=VALID_REPORT_LOCAL_FILE)
+    def test_job_run_resource_limits_take_precedence(self, mock_validate):
+
+        resource = factories.Resource(
+            url="http://example.com/file.csv",
+            format="csv",
+            validation_options={"limit_rows": 10, "limit_errors": 5},
+        )
+
+        run_validation_job(resource)
+
+        assert mock_validate.call_args[1]["limit_rows"] == 10
+        assert mock_validate.call_args[1]["limit_errors"] == 5
+
+        validation = (
+            Session.query(Validation)
+            .filter(Validation.resource_id == resource["id"])
+            .one()
+        )
+
+        assert "truncated" not in json.loads(validation.report)
+
     @pytest.mark.usefixtures("mock_uploads")
     def test_job_local_paths_are_hidden(self):
 
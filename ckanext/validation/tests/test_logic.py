@@ -11,7 +11,10 @@ from ckan.tests import factories
 
 import ckantoolkit as t
 
-from ckanext.validation.model import Validation
+from ckanext.validation.model import Validation, store_validation_errors
+from ckanext.validation.logic import (
+    _search_datasets, _exceeds_sync_limits, can_validate_resources)
+from ckanext.validation.utils import get_resource_signature
 from ckanext.validation.tests.helpers import (
     VALID_CSV,
     INVALID_CSV,
@@ -85,6 +88,22 @@ class TestResourceValidationRun(object):
 
         assert len(jobs_after) == len(jobs) + 1
 
+    @mock.patch("ckanext.validation.logic.enqueue_job")
+    def test_resource_validation_enqueues_id_and_revision(self, mock_enqueue_job):
+
+        resource = factories.Resource(format="CSV", url="https://some.url")
+        mock_enqueue_job.reset_mock()
+
+        call_action("resource_validation_run", resource_id=resource["id"])
+
+        validation = (
+            Session.query(Validation)
+            .filter(Validation.resource_id == resource["id"])
+            .one()
+        )
+        assert mock_enqueue_job.call_args[0][1] == [
+            resource["id"], validation.created.isoformat()]
+
     @mock.patch("ckanext.validation.logic.enqueue_job")
     def test_resource_validation_creates_validation_object(self, mock_enqueue_job):
 
@@ -142,7 +161,8 @@ class TestResourceValidationRun(object):
         assert validation.status == "created"
         assert validation.created is not timestamp
         assert validation.finished is None
-        assert validation.report is None
+        # Kept so it can be reused if the resource has not changed
+        assert validation.report == {"some": "report"}
         assert validation.error is None
 
     @mock.patch("ckanext.validation.logic.enqueue_job")
@@ -155,7 +175,7 @@ class TestResourceValidationRun(object):
         dataset = factories.Dataset(resources=[resource1])
 
         assert mock_enqueue_job.call_count == 1
-        assert mock_enqueue_job.call_args[0][1][0]["id"] == dataset["resources"][0]["id"]
+        assert mock_enqueue_job.call_args[0][1][0] == dataset["resources"][0]["id"]
 
         mock_enqueue_job.reset_mock()
 
@@ -168,7 +188,7 @@ class TestResourceValidationRun(object):
         )
 
         assert mock_enqueue_job.call_count == 1
-        assert mock_enqueue_job.call_args[0][1][0]["id"] == resource2["id"]
+        assert mock_enqueue_job.call_args[0][1][0] == resource2["id"]
 
     @mock.patch("ckanext.validation.logic.enqueue_job")
     def test_resource_validation_only_called_on_resource_updated(
@@ -196,7 +216,7 @@ class TestResourceValidationRun(object):
         )
 
         assert mock_enqueue_job.call_count == 1
-        assert mock_enqueue_job.call_args[0][1][0]["id"] == resource_1_id
+        assert mock_enqueue_job.call_args[0][1][0] == resource_1_id
 
 
 
@@ -260,6 +280,232 @@ class TestResourceValidationShow(object):
         assert validation_show["created"] == validation.created.isoformat()
         assert validation_show["finished"] == validation.finished.isoformat()
 
+    @pytest.mark.ckan_config("ckanext.validation.run_on_create_async", False)
+    def test_resource_validation_show_without_report(self):
+
+        resource = {"format": "CSV", "url": "https://some.url"}
+
+        dataset = factories.Dataset(resources=[resource])
+
+        validation = Validation(
+            resource_id=dataset["resources"][0]["id"],
+            status="failure",
+            report={
+                "valid": False,
+                "stats": {"errors": 2, "seconds": 0.5},
+                "tasks": [{"stats": {"rows": 10}}],
+            },
+        )
+        Session.add(validation)
+        Session.commit()
+
+        validation_show = call_action(
+            "resource_validation_show",
+            resource_id=dataset["resources"][0]["id"],
+            include_report=False,
+        )
+
+        assert "report" not in validation_show
+        assert validation_show["valid"] is False
+        assert validation_show["error_count"] == 2
+        assert validation_show["row_count"] == 10
+        assert validation_show["duration"] == 0.5
+
+
+def _paged_report():
+    return {
+        "valid": False,
+        "stats": {"errors": 5, "seconds": 1.5},
+        "warnings": ["Some warning"],
+        "tasks": [
+            {
+                "name": "table1",
+                "place": "table1.csv",
+                "valid": False,
+                "stats": {"errors": 3, "rows": 10},
+                "errors": [
+                    {"type": "type-error", "fieldName": "date", "rowNumber": 2},
+                    {"type": "type-error", "fieldName": "amount", "rowNumber": 3},
+                    {"type": "blank-row", "rowNumber": 4},
+                ],
+            },
+            {
+                "name": "table2",
+                "place": "table2.csv",
+                "valid": False,
+                "stats": {"errors": 2, "rows": 5},
+                "errors": [
+                    {"type": "type-error", "fieldName": "date", "rowNumber": 5},
+                    {"type": "missing-cell", "fieldName": "date", "rowNumber": 6},
+                ],
+            },
+        ],
+    }
+
+
+@pytest.mark.usefixtures("clean_db", "validation_setup", "with_plugins")
+class TestResourceValidationReport(object):
+    def _validation(self):
+        resource = factories.Resource(format="csv")
+        timestamp = datetime.datetime.utcnow()
+        validation = Validation(
+            resource_id=resource["id"],
+            created=timestamp,
+            finished=timestamp,
+            status="failure",
+            report=json.dumps(_paged_report()),
+        )
+        Session.add(validation)
+        Session.commit()
+        return resource
+
+    def test_report_param_missing(self):
+
+        pytest.raises(t.ValidationError, call_action, "resource_validation_report")
+
+    def test_report_not_exists(self):
+
+        resource = factories.Resource(format="csv")
+
+        pytest.raises(
+            t.ObjectNotFound,
+            call_action,
+            "resource_validation_report",
+            resource_id=resource["id"],
+        )
+
+    def test_report_summary(self):
+
+        resource = self._validation()
+
+        result = call_action(
+            "resource_validation_report", resource_id=resource["id"])
+
+        assert result["count"] == 5
+        summary = result["summary"]
+        assert summary["status"] == "failure"
+        assert summary["error_count"] == 5
+        assert "report" not in summary
+        assert summary["stats"] == {"errors": 5, "seconds": 1.5}
+        assert summary["warnings"] == ["Some warning"]
+        assert summary["tasks"][0]["error_codes"] == {
+            "type-error": 2, "blank-row": 1}
+        assert summary["tasks"][0]["fields"] == ["amount", "date"]
+        assert summary["tasks"][1]["place"] == "table2.csv"
+
+    def test_report_paging(self):
+
+        resource = self._validation()
+
+        result = call_action(
+            "resource_validation_report",
+            resource_id=resource["id"],
+            offset=2,
+            limit=2,
+            include_summary=False,
+        )
+
+        assert result["count"] == 5
+        assert "summary" not in result
+        assert [e["rowNumber"] for e in result["errors"]] == [4, 5]
+        assert [e["task"] for e in result["errors"]] == [0, 1]
+
+    def test_report_filters(self):
+
+        resource = self._validation()
+
+        result = call_action(
+            "resource_validation_report",
+            resource_id=resource["id"],
+            code="type-error",
+            field="date",
+        )
+        assert [e["rowNumber"] for e in result["errors"]] == [2, 5]
+
+        result = call_action(
+            "resource_validation_report",
+            resource_id=resource["id"],
+            task=1,
+        )
+        assert result["count"] == 2
+        assert [e["rowNumber"] for e in result["errors"]] == [5, 6]
+
+    def test_report_limit_capped(self):
+
+        resource = self._validation()
+
+        result = call_action(
+            "resource_validation_report",
+            resource_id=resource["id"],
+            limit=100000,
+        )
+
+        assert result["limit"] == 1000
+
+    def test_report_decoded_once(self):
+
+        resource = self._validation()
+
+        with mock.patch.object(
+                Validation, "report", new_callable=mock.PropertyMock,
+                return_value=json.dumps(_paged_report())) as mock_report:
+            for offset in (0, 2, 4):
+                result = call_action(
+                    "resource_validation_report",
+                    resource_id=resource["id"],
+                    offset=offset,
+                    limit=2,
+                )
+                assert result["summary"]["tasks"][1]["place"] == "table2.csv"
+
+        assert mock_report.call_count == 1
+
+    def test_report_not_cached_after_new_validation(self):
+
+        resource = self._validation()
+
+        call_action("resource_validation_report", resource_id=resource["id"])
+
+        report = _paged_report()
+        report["tasks"] = report["tasks"][:1]
+        validation = Session.query(Validation).filter_by(
+            resource_id=resource["id"]).one()
+        validation.report = json.dumps(report)
+        validation.finished = datetime.datetime.utcnow()
+        Session.commit()
+
+        result = call_action(
+            "resource_validation_report", resource_id=resource["id"])
+
+        assert result["count"] == 3
+        assert len(result["summary"]["tasks"]) == 1
+
+    @pytest.mark.ckan_config("ckanext.validation.report_cache_size", 0)
+    def test_report_cache_disabled(self):
+
+        resource = self._validation()
+
+        with mock.patch.object(
+                Validation, "report", new_callable=mock.PropertyMock,
+                return_value=json.dumps(_paged_report())) as mock_report:
+            for i in range(2):
+                call_action(
+                    "resource_validation_report", resource_id=resource["id"])
+
+        assert mock_report.call_count == 2
+
+    def test_report_invalid_offset(self):
+
+        resource = self._validation()
+
+        pytest.raises(
+            t.ValidationError,
+            call_action,
+            "resource_validation_report",
+            resource_id=resource["id"],
+            offset="a",
+        )
+
 
 @pytest.mark.usefixtures("clean_db", "validation_setup", "with_plugins")
 class TestResourceValidationDelete(object):
@@ -312,6 +558,475 @@ class TestResourceValidationDelete(object):
         assert count_after == 0
 
 
+@pytest.mark.usefixtures("clean_db", "validation_setup", "with_plugins")
+class TestResourceValidationRunBatch(object):
+    @mock.patch("ckanext.validation.logic.enqueue_jobs")
+    @mock.patch("ckanext.validation.logic.enqueue_job")
+    def test_run_batch_enqueues_supported_resources(
+        self, mock_enqueue_job, mock_enqueue_jobs
+    ):
+
+        dataset = factories.Dataset(
+            resources=[
+                {"format": "CSV", "url": "https://some.url"},
+                {"format": "PDF", "url": "https://some.url"},
+            ]
+        )
+
+        result = call_action(
+            "resource_validation_run_batch", dataset_ids=[dataset["id"]]
+        )
+
+        assert "1 resources sent to the validation queue" in result["output"]
+        assert "resources/s" in result["output"]
+
+        args_list = mock_enqueue_jobs.call_args[0][1]
+        assert [args[0] for args in args_list] == [
+            dataset["resources"][0]["id"]]
+
+        validation = (
+            Session.query(Validation)
+            .filter(Validation.resource_id == dataset["resources"][0]["id"])
+            .one()
+        )
+        assert validation.status == "created"
+
+    @mock.patch("ckanext.validation.logic.enqueue_jobs")
+    @mock.patch("ckanext.validation.logic.enqueue_job")
+    def test_run_batch_resets_existing_validations(
+        self, mock_enqueue_job, mock_enqueue_jobs
+    ):
+
+        dataset = factories.Dataset(
+            resources=[{"format": "CSV", "url": "https://some.url"}]
+        )
+        resource_id = dataset["resources"][0]["id"]
+        Session.add(Validation(
+            resource_id=resource_id, status="failure", digest="some-digest"))
+        Session.commit()
+
+        call_action("resource_validation_run_batch", dataset_ids=[dataset["id"]])
+
+        Session.remove()
+        validation = (
+            Session.query(Validation)
+            .filter(Validation.resource_id == resource_id)
+            .one()
+        )
+        assert validation.status == "created"
+        assert validation.digest == "some-digest"
+
+    @mock.patch("ckanext.validation.logic.enqueue_jobs")
+    @mock.patch("ckanext.validation.logic.enqueue_job")
+    def test_run_batch_only_stale(self, mock_enqueue_job, mock_enqueue_jobs):
+
+        dataset = factories.Dataset(
+            resources=[
+                {"format": "CSV", "url": "https://some.url/never"},
+                {"format": "CSV", "url": "https://some.url/unchanged"},
+                {"format": "CSV", "url": "https://some.url/modified"},
+                {"format": "CSV", "url": "https://some.url/error"},
+            ]
+        )
+        resources = [
+            call_action("resource_show", id=r["id"])
+            for r in dataset["resources"]]
+        resource_ids = [r["id"] for r in resources]
+        signatures = [get_resource_signature(r) for r in resources]
+        # The URL of the third resource was edited since its validation
+        signatures[2] = get_resource_signature(
+            dict(resources[2], url="https://some.url/previous"))
+        finished = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+        for resource_id, status, signature in zip(
+                resource_ids[1:], ["success", "failure", "error"],
+                signatures[1:]):
+            Session.add(Validation(
+                resource_id=resource_id, status=status, finished=finished,
+                created=finished, signature=signature))
+        Session.commit()
+
+        result = call_action(
+            "resource_validation_run_batch",
+            dataset_ids=[dataset["id"]], only_stale=True)
+
+        assert "3 resources sent to the validation queue" in result["output"]
+        args_list = mock_enqueue_jobs.call_args[0][1]
+        assert sorted(args[0] for args in args_list) == sorted(
+            [resource_ids[0], resource_ids[2], resource_ids[3]])
+
+    @mock.patch("ckanext.validation.logic.enqueue_jobs")
+    @mock.patch("ckanext.validation.logic.enqueue_job")
+    def test_run_batch_only_stale_without_signature(
+        self, mock_enqueue_job, mock_enqueue_jobs
+    ):
+
+        dataset = factories.Dataset(
+            resources=[
+                {"format": "CSV", "url": "https://some.url/unchanged"},
+                {"format": "CSV", "url": "https://some.url/modified"},
+            ]
+        )
+        resource_ids = [r["id"] for r in dataset["resources"]]
+        now = datetime.datetime.utcnow()
+        for resource_id, finished in zip(resource_ids, [
+                now + datetime.timedelta(hours=1),
+                now - datetime.timedelta(hours=1)]):
+            Session.add(Validation(
+                resource_id=resource_id, status="success", finished=finished,
+                created=finished))
+        Session.commit()
+
+        call_action(
+            "resource_validation_run_batch",
+            dataset_ids=[dataset["id"]], only_stale=True)
+
+        args_list = mock_enqueue_jobs.call_args[0][1]
+        assert [args[0] for args in args_list] == [resource_ids[1]]
+
+    @mock.patch("ckanext.validation.logic.enqueue_jobs")
+    @mock.patch("ckanext.validation.logic.enqueue_job")
+    def test_run_batch_older_than(self, mock_enqueue_job, mock_enqueue_jobs):
+
+        now = datetime.datetime.utcnow()
+        dataset = factories.Dataset(
+            resources=[
+                {"format": "CSV", "url": "https://some.url/recent"},
+                {"format": "CSV", "url": "https://some.url/old"},
+            ]
+        )
+        resource_ids = [r["id"] for r in dataset["resources"]]
+        for resource_id, days in zip(resource_ids, [1, 10]):
+            finished = now - datetime.timedelta(days=days)
+            Session.add(Validation(
+                resource_id=resource_id, status="success", finished=finished,
+                created=finished))
+        Session.commit()
+
+        call_action(
+            "resource_validation_run_batch",
+            dataset_ids=[dataset["id"]], older_than=7)
+
+        args_list = mock_enqueue_jobs.call_args[0][1]
+        assert [args[0] for args in args_list] == [resource_ids[1]]
+
+    @mock.patch("ckanext.validation.logic.enqueue_jobs")
+    @mock.patch("ckanext.validation.logic.enqueue_job")
+    def test_run_batch_only_stale_nothing_to_validate(
+        self, mock_enqueue_job, mock_enqueue_jobs
+    ):
+
+        dataset = factories.Dataset(
+            resources=[{"format": "CSV", "url": "https://some.url"}]
+        )
+        Session.add(Validation(
+            resource_id=dataset["resources"][0]["id"], status="success",
+            finished=datetime.datetime.utcnow() + datetime.timedelta(hours=1)))
+        Session.commit()
+
+        result = call_action(
+            "resource_validation_run_batch",
+            dataset_ids=[dataset["id"]], only_stale=True)
+
+        assert "0 resources sent to the validation queue" in result["output"]
+        assert not mock_enqueue_jobs.called
+
+    def test_run_batch_older_than_invalid(self):
+
+        with pytest.raises(t.ValidationError):
+            call_action("resource_validation_run_batch", older_than="recently")
+
+    @mock.patch("ckanext.validation.logic.enqueue_job")
+    def test_search_datasets_after_id(self, mock_enqueue_job):
+
+        ids = sorted(factories.Dataset()["id"] for i in range(3))
+
+        query = _search_datasets(
+            search_params={"q": "*:*"}, after_id=ids[0])
+
+        assert [dataset["id"] for dataset in query["results"]] == ids[1:]
+
+
+@pytest.mark.usefixtures("clean_db", "validation_setup", "with_plugins")
+class TestResourceValidationQueues(object):
+    @mock.patch("ckanext.validation.logic.t.enqueue_job")
+    def test_run_uses_interactive_queue(self, mock_enqueue_job):
+
+        resource = factories.Resource(format="CSV", url="https://some.url")
+
+        call_action("resource_validation_run", resource_id=resource["id"])
+
+        assert mock_enqueue_job.call_args[1]["queue"] == "default"
+        assert mock_enqueue_job.call_args[1]["rq_kwargs"]["at_front"] is True
+        assert mock_enqueue_job.call_args[1]["kwargs"] == {"queued": True}
+
+    @pytest.mark.ckan_config(
+        "ckanext.validation.queue_name.upload", "validation_upload")
+    @mock.patch("ckanext.validation.logic.t.enqueue_job")
+    def test_resource_create_uses_upload_queue(self, mock_enqueue_job):
+
+        factories.Resource(format="CSV", url="https://some.url")
+
+        assert mock_enqueue_job.call_args[1]["queue"] == "validation_upload"
+        assert mock_enqueue_job.call_args[1]["rq_kwargs"]["at_front"] is False
+
+    def _mock_worker(self, mock_enqueue_job, mock_set_pending_jobs):
+        # Simulates a worker starting each job as soon as it is enqueued,
+        # checking that it finds its own id in the pending marker
+        markers = {}
+        claimed = []
+
+        def enqueue(fn, args, **kwargs):
+            job_id = kwargs["rq_kwargs"]["job_id"]
+            claimed.append(markers.get(args[0]) == job_id)
+            return mock.Mock(id=job_id)
+
+        mock_set_pending_jobs.side_effect = markers.update
+        mock_enqueue_job.side_effect = enqueue
+
+        return claimed
+
+    @mock.patch("ckanext.validation.logic.queues.set_pending_jobs")
+    @mock.patch("ckanext.validation.logic.t.enqueue_job")
+    def test_pending_marker_written_before_enqueuing(
+        self, mock_enqueue_job, mock_set_pending_jobs
+    ):
+
+        claimed = self._mock_worker(mock_enqueue_job, mock_set_pending_jobs)
+        resource = factories.Resource(format="CSV", url="https://some.url")
+
+        call_action("resource_validation_run", resource_id=resource["id"])
+
+        assert claimed
+        assert all(claimed)
+
+    @mock.patch("ckanext.validation.logic.queues.get_queue", return_value=None)
+    @mock.patch("ckanext.validation.logic.queues.set_pending_jobs")
+    @mock.patch("ckanext.validation.logic.t.enqueue_job")
+    def test_batch_pending_markers_written_before_enqueuing(
+        self, mock_enqueue_job, mock_set_pending_jobs, mock_get_queue
+    ):
+
+        dataset = factories.Dataset(resources=[
+            {"format": "CSV", "url": "https://some.url/1"},
+            {"format": "CSV", "url": "https://some.url/2"},
+        ])
+        claimed = self._mock_worker(mock_enqueue_job, mock_set_pending_jobs)
+
+        call_action(
+            "resource_validation_run_batch", dataset_ids=[dataset["id"]])
+
+        assert len(claimed) == 2
+        assert all(claimed)
+
+    @mock.patch("ckanext.validation.logic.queues.wait_for_batch_queue")
+    @mock.patch("ckanext.validation.logic.enqueue_jobs")
+    @mock.patch("ckanext.validation.logic.enqueue_job")
+    def test_run_batch_is_throttled(
+        self, mock_enqueue_job, mock_enqueue_jobs, mock_wait
+    ):
+
+        dataset = factories.Dataset(
+            resources=[{"format": "CSV", "url": "https://some.url"}]
+        )
+
+        call_action(
+            "resource_validation_run_batch",
+            context={"throttle_batch": True},
+            dataset_ids=[dataset["id"]])
+
+        assert mock_wait.call_count == 1
+        assert mock_enqueue_jobs.call_count == 1
+
+    @mock.patch("ckanext.validation.logic.queues.wait_for_batch_queue")
+    @mock.patch("ckanext.validation.logic.enqueue_jobs")
+    @mock.patch("ckanext.validation.logic.enqueue_job")
+    def test_run_batch_from_api_is_not_throttled(
+        self, mock_enqueue_job, mock_enqueue_jobs, mock_wait
+    ):
+
+        dataset = factories.Dataset(
+            resources=[{"format": "CSV", "url": "https://some.url"}]
+        )
+
+        call_action("resource_validation_run_batch", dataset_ids=[dataset["id"]])
+
+        assert not mock_wait.called
+        assert mock_enqueue_jobs.call_count == 1
+
+    @pytest.mark.ckan_config(
+        "ckanext.validation.queue_name.batch", "validation_batch")
+    @mock.patch("ckanext.validation.queues.get_queue")
+    def test_stats(self, mock_get_queue):
+
+        mock_get_queue.side_effect = lambda job_class: mock.Mock(
+            count={"interactive": 1, "upload": 2, "batch": 300}[job_class])
+
+        result = call_action("resource_validation_stats")
+
+        assert result["queues"] == {
+            "interactive": {"name": "default", "priority": "high", "count": 1},
+            "upload": {"name": "default", "priority": "normal", "count": 2},
+            "batch": {
+                "name": "validation_batch", "priority": "normal", "count": 300},
+        }
+        assert isinstance(result["update_markers"], int)
+
+
+class TestCanValidateResources(object):
+    def _plugin(self, many=None, single=True):
+        plugin = mock.Mock()
+        plugin.can_validate_many.return_value = many or {}
+        plugin.can_validate.return_value = single
+        return plugin
+
+    def test_batch_answers_with_fallback(self):
+
+        plugin = self._plugin(many={"r1": False, "r2": True}, single=False)
+        resources = [{"id": "r1"}, {"id": "r2"}, {"id": "r3"}]
+
+        with mock.patch(
+                "ckanext.validation.logic.plugins.PluginImplementations",
+                return_value=[plugin]):
+            decisions = can_validate_resources({}, resources)
+
+        assert decisions == [False, True, False]
+        assert plugin.can_validate_many.call_count == 1
+        assert plugin.can_validate_many.call_args[0][1] == resources
+        assert plugin.can_validate.call_count == 1
+        assert plugin.can_validate.call_args[0][1] == {"id": "r3"}
+
+    def test_decisions_memoized_in_context(self):
+
+        plugin = self._plugin()
+        context = {}
+
+        with mock.patch(
+                "ckanext.validation.logic.plugins.PluginImplementations",
+                return_value=[plugin]):
+            assert can_validate_resources(context, [{"id": "r1"}]) == [True]
+            assert can_validate_resources(
+                context, [{"id": "r1"}, {"id": "r2"}]) == [True, True]
+            # Resources without id are not memoized
+            assert can_validate_resources(context, [{"url": "x"}]) == [True]
+            assert can_validate_resources(context, [{"url": "x"}]) == [True]
+
+        assert [c[0][1] for c in plugin.can_validate_many.call_args_list] == [
+            [{"id": "r1"}], [{"id": "r2"}], [{"url": "x"}], [{"url": "x"}]]
+
+    def test_any_plugin_can_veto(self):
+
+        plugins = [self._plugin(many={"r1": False}), self._plugin()]
+
+        with mock.patch(
+                "ckanext.validation.logic.plugins.PluginImplementations",
+                return_value=plugins):
+            assert can_validate_resources({}, [{"id": "r1"}]) == [False]
+
+        # Resources already rejected are not checked individually
+        assert not plugins[1].can_validate.called
+
+
+def _report_with_errors(*errors):
+    return {
+        "valid": False,
+        "tasks": [
+            {
+                "errors": [
+                    {
+                        "type": code,
+                        "fieldName": field,
+                        "rowNumber": row,
+                        "cell": "x",
+                        "message": "Error in row {}".format(row),
+                    }
+                    for code, field, row in errors
+                ]
+            }
+        ],
+    }
+
+
+@pytest.mark.usefixtures("clean_db", "validation_setup", "with_plugins")
+class TestResourceValidationErrorSearch(object):
+    def _store(self, resource, *errors):
+        store_validation_errors(
+            resource["id"], resource["package_id"], _report_with_errors(*errors)
+        )
+        Session.commit()
+
+    def test_error_search_filters(self):
+
+        org1 = factories.Organization()
+        org2 = factories.Organization()
+        resource1 = factories.Resource(
+            package_id=factories.Dataset(owner_org=org1["id"])["id"])
+        resource2 = factories.Resource(
+            package_id=factories.Dataset(owner_org=org2["id"])["id"])
+
+        self._store(
+            resource1, ("type-error", "date", 2), ("blank-row", None, 5))
+        self._store(
+            resource2, ("type-error", "date", 3), ("type-error", "amount", 4))
+
+        result = call_action(
+            "resource_validation_error_search", code="type-error", field="date"
+        )
+        assert result["count"] == 2
+        assert sorted(e["resource_id"] for e in result["results"]) == sorted(
+            [resource1["id"], resource2["id"]])
+
+        result = call_action(
+            "resource_validation_error_search", organization=org2["name"]
+        )
+        assert result["count"] == 2
+        assert [e["row_number"] for e in result["results"]] == [3, 4]
+        assert result["results"][0]["owner_org"] == org2["id"]
+        assert result["results"][0]["message"] == "Error in row 3"
+
+    def test_error_search_paging(self):
+
+        resource = factories.Resource()
+        self._store(resource, *[("type-error", "date", i) for i in range(10)])
+
+        result = call_action(
+            "resource_validation_error_search", limit=3, offset=6
+        )
+
+        assert result["count"] == 10
+        assert [e["row_number"] for e in result["results"]] == [6, 7, 8]
+
+    def test_error_search_replaced_on_new_validation(self):
+
+        resource = factories.Resource()
+        self._store(resource, ("type-error", "date", 2))
+        self._store(resource, ("blank-row", None, 5))
+
+        result = call_action("resource_validation_error_search")
+
+        assert [e["code"] for e in result["results"]] == ["blank-row"]
+
+    @pytest.mark.ckan_config("ckanext.validation.errors_per_code", "2")
+    def test_error_search_capped_per_code(self):
+
+        resource = factories.Resource()
+        self._store(
+            resource,
+            *([("type-error", "date", i) for i in range(5)]
+              + [("blank-row", None, 10)])
+        )
+
+        result = call_action("resource_validation_error_search")
+
+        assert [e["code"] for e in result["results"]] == [
+            "type-error", "type-error", "blank-row"]
+
+    def test_error_search_organization_not_found(self):
+
+        with pytest.raises(t.ObjectNotFound):
+            call_action(
+                "resource_validation_error_search", organization="not-found")
+
+
 @pytest.mark.usefixtures("clean_db", "validation_setup", "with_plugins")
 class TestAuth(object):
     def test_run_anon(self):
@@ -381,6 +1096,32 @@ class TestAuth(object):
             is True
         )
 
+    def test_error_search_non_sysadmin(self):
+
+        user = factories.User()
+
+        context = {"user": user["name"], "model": model}
+
+        pytest.raises(
+            t.NotAuthorized,
+            call_auth,
+            "resource_validation_error_search",
+            context=context,
+        )
+
+    def test_stats_non_sysadmin(self):
+
+        user = factories.User()
+
+        context = {"user": user["name"], "model": model}
+
+        pytest.raises(
+            t.NotAuthorized,
+            call_auth,
+            "resource_validation_stats",
+            context=context,
+        )
+
     def test_delete_anon(self):
 
         resource = factories.Resource()
@@ -575,6 +1316,57 @@ class TestResourceValidationOnCreate(object):
         assert resource["validation_status"] == "success"
         assert "validation_timestamp" in resource
 
+    @pytest.mark.usefixtures("mock_uploads")
+    @mock.patch("ckan.lib.uploader.ResourceUpload.upload")
+    def test_invalid_upload_not_saved(self, mock_upload_file):
+
+        invalid_file = get_mock_file(INVALID_CSV)
+
+        mock_upload = MockFieldStorage(invalid_file, "invalid.csv")
+
+        dataset = factories.Dataset()
+
+        with pytest.raises(t.ValidationError) as e:
+            call_action(
+                "resource_create",
+                package_id=dataset["id"],
+                format="CSV",
+                upload=mock_upload,
+            )
+
+        assert "missing-cell" in str(e)
+        assert not mock_upload_file.called
+        assert model.Session.query(model.Resource).filter_by(
+            package_id=dataset["id"]).count() == 0
+
+    @pytest.mark.usefixtures("mock_uploads")
+    @mock.patch("ckanext.validation.logic._run_sync_validation")
+    def test_upload_validated_before_saving(self, mock_run_sync_validation):
+
+        valid_file = get_mock_file(VALID_CSV)
+
+        mock_upload = MockFieldStorage(valid_file, "valid.csv")
+
+        dataset = factories.Dataset()
+
+        resource = call_action(
+            "resource_create",
+            package_id=dataset["id"],
+            format="CSV",
+            upload=mock_upload,
+        )
+
+        assert not mock_run_sync_validation.called
+        assert resource["validation_status"] == "success"
+
+        validation = model.Session.query(Validation).filter_by(
+            resource_id=resource["id"]).one()
+        assert validation.status == "success"
+        assert json.loads(validation.report)["tasks"][0]["place"] == "valid.csv"
+        # Stored so the resource is not validated again on the next update
+        assert validation.signature == get_resource_signature(resource)
+        assert validation.digest
+
     @mock.patch("ckanext.validation.jobs.validate", return_value=VALID_REPORT)
     def test_validation_passes_with_url(self, mock_validate):
 
@@ -593,6 +1385,60 @@ class TestResourceValidationOnCreate(object):
         assert "validation_timestamp" in resource
 
 
+    @pytest.mark.ckan_config("ckanext.validation.sync_max_size", "10")
+    @pytest.mark.usefixtures("mock_uploads")
+    @mock.patch("ckanext.validation.logic.enqueue_job")
+    @mock.patch("ckanext.validation.jobs.validate")
+    def test_big_upload_validated_async(self, mock_validate, mock_enqueue_job):
+
+        invalid_file = get_mock_file(INVALID_CSV)
+
+        mock_upload = MockFieldStorage(invalid_file, "invalid.csv")
+
+        dataset = factories.Dataset()
+
+        resource = call_action(
+            "resource_create",
+            package_id=dataset["id"],
+            format="CSV",
+            upload=mock_upload,
+        )
+
+        assert resource["validation_status"] == "pending"
+        assert not mock_validate.called
+
+        args = mock_enqueue_job.call_args[0][1]
+        assert args[0] == resource["id"]
+        assert args[2]["new_resource"] is True
+
+    @pytest.mark.ckan_config("ckanext.validation.sync_max_size", "1000000")
+    @mock.patch("ckanext.validation.logic.enqueue_job")
+    @mock.patch("ckanext.validation.jobs.validate", return_value=VALID_REPORT)
+    def test_small_resource_validated_sync(self, mock_validate, mock_enqueue_job):
+
+        dataset = factories.Dataset()
+
+        resource = call_action(
+            "resource_create",
+            package_id=dataset["id"],
+            format="csv",
+            url="https://example.com/valid.csv",
+            size=100,
+        )
+
+        assert resource["validation_status"] == "success"
+        assert not mock_enqueue_job.called
+
+    @pytest.mark.ckan_config("ckanext.validation.sync_max_rows", "1")
+    def test_sync_limits_null_format(self, tmp_path):
+
+        path = tmp_path / "data"
+        path.write_text(u"a,b\n1,2\n3,4\n")
+
+        assert not _exceeds_sync_limits({"format": None}, None, str(path))
+        assert _exceeds_sync_limits({"format": "CSV"}, None, str(path))
+
+
 @pytest.mark.usefixtures("clean_db", "validation_setup", "with_plugins")
 @pytest.mark.ckan_config("ckanext.validation.run_on_update_sync", True)
 class TestResourceValidationOnUpdate(object):
@@ -0,0 +1,260 @@
+import json
+
+import pytest
+
+from ckan import model
+from ckan.tests import factories
+
+from ckanext.validation.model import (
+    Validation,
+    ValidationReport,
+    get_validation,
+    get_validation_signatures,
+    upsert_validation,
+    tables_up_to_date,
+    store_validation_errors,
+    get_validation_error_counts,
+    get_validation_error_samples,
+)
+
+
+Session = model.Session
+
+
+@pytest.mark.usefixtures("clean_db", "validation_setup", "with_plugins")
+class TestValidationModel(object):
+    def test_tables_up_to_date(self):
+
+        assert tables_up_to_date()
+
+    def test_get_validation_not_exists(self):
+
+        assert get_validation("not-exists") is None
+
+    def test_upsert_validation_creates_object(self):
+
+        resource = factories.Resource()
+
+        validation = upsert_validation(resource["id"], status="running")
+        Session.commit()
+
+        assert validation.id
+        assert validation.created
+        assert validation.status == "running"
+        assert get_validation(resource["id"]).id == validation.id
+
+    def test_upsert_validation_updates_existing_object(self):
+
+        resource = factories.Resource()
+
+        validation = Validation(
+            resource_id=resource["id"], status="success", digest="some-digest"
+        )
+        Session.add(validation)
+        Session.commit()
+
+        updated = upsert_validation(resource["id"], status="running")
+        Session.commit()
+
+        assert updated.id == validation.id
+        assert updated.status == "running"
+        assert updated.digest == "some-digest"
+        assert (
+            Session.query(Validation)
+            .filter(Validation.resource_id == resource["id"])
+            .count()
+            == 1
+        )
+
+    def test_get_validation_signatures_only_finished(self):
+
+        resources = [factories.Resource() for i in range(5)]
+        for resource, status in zip(
+                resources,
+                ["success", "failure", "created", "running", "error"]):
+            upsert_validation(
+                resource["id"], status=status, signature=status + "-sig")
+        Session.commit()
+
+        signatures = get_validation_signatures(
+            [resource["id"] for resource in resources])
+
+        assert signatures == {
+            resources[0]["id"]: "success-sig",
+            resources[1]["id"]: "failure-sig",
+        }
+
+    def test_resource_id_is_unique(self):
+
+        resource = factories.Resource()
+
+        Session.add(Validation(resource_id=resource["id"]))
+        Session.commit()
+
+        Session.add(Validation(resource_id=resource["id"]))
+        with pytest.raises(Exception):
+            Session.commit()
+        Session.rollback()
+
+
+REPORT = {
+    "valid": False,
+    "stats": {"errors": 1, "warnings": 0, "seconds": 0.1, "tasks": 1},
+    "tasks": [{"stats": {"rows": 100}, "errors": [{"type": "type-error"}]}],
+    "truncated": {"rows": 100},
+}
+
+
+@pytest.mark.usefixtures("clean_db", "validation_setup", "with_plugins")
+class TestValidationReportStorage(object):
+    def _get_stored(self, resource_id):
+        Session.remove()
+        return get_validation(resource_id)
+
+    def test_report_is_stored_compressed(self):
+
+        resource = factories.Resource()
+
+        validation = Validation(resource_id=resource["id"], report=REPORT)
+        Session.add(validation)
+        Session.commit()
+
+        report_data = Session.query(ValidationReport).get(validation.id)
+        assert report_data.compression == "gzip"
+        assert len(report_data.data) < len(json.dumps(REPORT))
+
+        assert self._get_stored(resource["id"]).report == REPORT
+
+    @pytest.mark.ckan_config("ckanext.validation.report_compression", "zstd")
+    def test_report_zstd_compression(self):
+
+        pytest.importorskip("zstandard")
+
+        resource = factories.Resource()
+
+        validation = Validation(resource_id=resource["id"], report=REPORT)
+        Session.add(validation)
+        Session.commit()
+
+        validation = self._get_stored(resource["id"])
+        assert validation.report_data.compression == "zstd"
+        assert validation.report == REPORT
+
+    def test_report_keeps_json_strings(self):
+
+        resource = factories.Resource()
+
+        validation = Validation(
+            resource_id=resource["id"], report=json.dumps(REPORT))
+        Session.add(validation)
+        Session.commit()
+
+        validation = self._get_stored(resource["id"])
+        assert json.loads(validation.report) == REPORT
+        assert validation.error_count == 1
+
+    def test_report_summary_columns(self):
+
+        resource = factories.Resource()
+
+        validation = Validation(resource_id=resource["id"], report=REPORT)
+        Session.add(validation)
+        Session.commit()
+
+        validation = self._get_stored(resource["id"])
+        assert validation.valid is False
+        assert validation.error_count == 1
+        assert validation.row_count == 100
+        assert validation.duration == 0.1
+        assert validation.truncated == {"rows": 100}
+        assert validation.sample is None
+        assert validation.error_codes == {"type-error": 1}
+
+    def test_report_replaced(self):
+
+        resource = factories.Resource()
+
+        validation = Validation(resource_id=resource["id"], report=REPORT)
+        Session.add(validation)
+        Session.commit()
+
+        validation.report = {"valid": True, "stats": {"errors": 0}}
+        Session.commit()
+
+        validation = self._get_stored(resource["id"])
+        assert validation.report == {"valid": True, "stats": {"errors": 0}}
+        assert validation.error_count == 0
+        assert Session.query(ValidationReport).count() == 1
+
+    def test_report_removed_with_validation(self):
+
+        resource = factories.Resource()
+
+        validation = Validation(resource_id=resource["id"], report=REPORT)
+        Session.add(validation)
+        Session.commit()
+
+        Session.delete(self._get_stored(resource["id"]))
+        Session.commit()
+
+        assert Session.query(ValidationReport).count() == 0
+
+
+@pytest.mark.usefixtures("clean_db", "validation_setup", "with_plugins")
+class TestValidationErrorQueries(object):
+    def _store(self, resource_id, errors, with_summary=True):
+        report = {
+            "valid": False,
+            "stats": {"errors": len(errors)},
+            "tasks": [{"errors": errors}],
+        }
+        validation = Validation(resource_id=resource_id, report=report)
+        if not with_summary:
+            validation.error_codes = None
+        Session.add(validation)
+        store_validation_errors(resource_id, None, report)
+        Session.commit()
+
+    @pytest.mark.ckan_config("ckanext.validation.errors_per_code", "5")
+    def test_error_counts_not_limited_by_stored_errors(self):
+
+        resource = factories.Resource()
+        self._store(
+            resource["id"],
+            [{"type": "type-error", "rowNumber": i} for i in range(20)]
+            + [{"type": "blank-row", "rowNumber": 30}])
+
+        counts = get_validation_error_counts([resource["id"]])
+
+        assert counts == {resource["id"]: {"type-error": 20, "blank-row": 1}}
+
+    @pytest.mark.ckan_config("ckanext.validation.errors_per_code", "5")
+    def test_error_counts_without_summary(self):
+
+        resource = factories.Resource()
+        self._store(
+            resource["id"],
+            [{"type": "type-error", "rowNumber": i} for i in range(20)],
+            with_summary=False)
+
+        counts = get_validation_error_counts([resource["id"]])
+
+        assert counts == {resource["id"]: {"type-error": 5}}
+
+    def test_error_samples_per_code(self):
+
+        resource1 = factories.Resource()
+        resource2 = factories.Resource()
+        self._store(
+            resource1["id"],
+            [{"type": "type-error", "rowNumber": i} for i in range(20, 0, -1)]
+            + [{"type": "blank-row", "rowNumber": 30}])
+        self._store(resource2["id"], [{"type": "type-error", "rowNumber": 2}])
+
+        samples = get_validation_error_samples(
+            [resource1["id"], resource2["id"]], per_code=3)
+
+        assert [(e.code, e.row_number) for e in samples[resource1["id"]]] == [
+            ("type-error", 1), ("type-error", 2), ("type-error", 3),
+            ("blank-row", 30)]
+        assert [e.row_number for e in samples[resource2["id"]]] == [2]
@@ -0,0 +1,131 @@
+import os
+import tempfile
+from unittest import mock
+
+import pytest
+import requests
+
+from ckanext.validation.parallel import (
+    get_parallel_workers,
+    download_source,
+    validate_in_chunks,
+    _get_chunks,
+)
+
+
+SCHEMA = {
+    "fields": [
+        {"name": "id", "type": "integer", "constraints": {"unique": True}},
+        {"name": "name", "type": "string"},
+        {"name": "value", "type": "integer"},
+    ],
+}
+
+
+def _write_csv(path, rows=1000, invalid_values=(), duplicated_ids=None):
+    duplicated_ids = duplicated_ids or {}
+    with open(path, "w") as f:
+        f.write("id,name,value\n")
+        for i in range(1, rows + 1):
+            value = "x" if i in invalid_values else str(i)
+            f.write('{},"name\n{}",{}\n'.format(duplicated_ids.get(i, i), i, value))
+
+
+class TestParallelOptions(object):
+    def test_parallel_workers_default(self):
+
+        assert get_parallel_workers() == 0
+
+    @pytest.mark.ckan_config("ckanext.validation.parallel_workers", "8")
+    def test_parallel_workers_from_config(self):
+
+        assert get_parallel_workers() == 8
+
+    @pytest.mark.ckan_config("ckanext.validation.parallel_workers", "8")
+    def test_parallel_workers_resource_override(self):
+
+        assert get_parallel_workers({"workers": 2}) == 2
+        assert get_parallel_workers(False) == 0
+
+
+class TestParallelValidation(object):
+    def test_chunks_are_aligned_to_records(self, tmp_path):
+
+        path = str(tmp_path / "data.csv")
+        _write_csv(path, rows=100)
+
+        header, chunks = _get_chunks(path, 4)
+
+        assert header == b"id,name,value\n"
+        assert len(chunks) == 4
+        assert chunks[0][0] == len(header)
+        assert chunks[-1][1] == len(open(path, "rb").read())
+
+        with open(path, "rb") as f:
+            for start, end, row_offset in chunks:
+                f.seek(start)
+                assert f.read(end - start).startswith(
+                    '{},"name\n'.format(row_offset + 1).encode())
+
+    def test_validate_in_chunks_valid(self, tmp_path):
+
+        path = str(tmp_path / "data.csv")
+        _write_csv(path)
+
+        report = validate_in_chunks(path, 4, schema=SCHEMA)
+
+        assert report["valid"] is True
+        assert report["tasks"][0]["stats"]["rows"] == 1000
+
+    def test_validate_in_chunks_global_row_numbers(self, tmp_path):
+
+        path = str(tmp_path / "data.csv")
+        _write_csv(path, invalid_values=(5, 900))
+
+        report = validate_in_chunks(path, 4, schema=SCHEMA)
+
+        errors = report["tasks"][0]["errors"]
+        assert report["valid"] is False
+        assert [(e["type"], e["rowNumber"]) for e in errors] == [
+            ("type-error", 6), ("type-error", 901)]
+        assert 'row "901"' in errors[1]["message"]
+        assert report["stats"]["errors"] == 2
+
+    def test_validate_in_chunks_unique_across_chunks(self, tmp_path):
+
+        path = str(tmp_path / "data.csv")
+        _write_csv(path, duplicated_ids={950: 3})
+
+        report = validate_in_chunks(path, 4, schema=SCHEMA)
+
+        errors = report["tasks"][0]["errors"]
+        assert len(errors) == 1
+        assert errors[0]["type"] == "unique-error"
+        assert errors[0]["rowNumber"] == 951
+        assert errors[0]["fieldName"] == "id"
+
+    def test_validate_in_chunks_error_limit(self, tmp_path):
+
+        path = str(tmp_path / "data.csv")
+        _write_csv(path, invalid_values=range(1, 1001))
+
+        report = validate_in_chunks(path, 4, schema=SCHEMA, limit_errors=10)
+
+        assert len(report["tasks"][0]["errors"]) == 10
+        assert "reached error limit: 10" in report["tasks"][0]["warnings"]
+
+
+class TestDownloadSource(object):
+    def test_download_error_leaves_no_file(self, monkeypatch, tmp_path):
+
+        monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+        response = mock.Mock()
+        response.raw.read.side_effect = requests.ConnectionError("Reset")
+        session = mock.Mock()
+        session.get.return_value = response
+
+        with pytest.raises(requests.ConnectionError):
+            download_source("http://example.com/file.csv", session)
+
+        assert os.listdir(str(tmp_path)) == []
+        assert response.close.called
@@ -1,11 +1,22 @@
+import json
+
 import pytest
 from unittest import mock
 
+from ckan import model
 from ckan.tests.helpers import call_action, reset_db
 from ckan.tests import factories
 
+import ckantoolkit as t
+
 from ckanext.validation.model import create_tables, tables_exist
 from ckanext.validation.jobs import run_validation_job
+from ckanext.validation.model import upsert_validation
+from ckanext.validation.utils import get_update_markers, get_resource_signature
+
+
+def _mock_jobs(fn, args_list, job_class=None, job_ids=None):
+    return [mock.Mock(id="job-{}".format(i)) for i in range(len(args_list))]
 
 
 @pytest.mark.usefixtures("clean_db", "validation_setup", "with_plugins")
@@ -50,7 +61,7 @@ class TestResourceControllerHooksUpdate(object):
         assert mock_enqueue.call_count == 1
 
         assert mock_enqueue.call_args[0][0] == run_validation_job
-        assert mock_enqueue.call_args[0][1][0]["id"] == dataset["resources"][0]["id"]
+        assert mock_enqueue.call_args[0][1][0] == dataset["resources"][0]["id"]
 
     @pytest.mark.ckan_config("ckanext.validation.run_on_create_async", False)
     @mock.patch("ckanext.validation.logic.enqueue_job")
@@ -67,7 +78,7 @@ class TestResourceControllerHooksUpdate(object):
         assert mock_enqueue.call_count == 1
 
         assert mock_enqueue.call_args[0][0] == run_validation_job
-        assert mock_enqueue.call_args[0][1][0]["id"] == dataset["resources"][0]["id"]
+        assert mock_enqueue.call_args[0][1][0] == dataset["resources"][0]["id"]
 
     @pytest.mark.ckan_config("ckanext.validation.run_on_create_async", False)
     @mock.patch("ckanext.validation.logic.enqueue_job")
@@ -90,7 +101,7 @@ class TestResourceControllerHooksUpdate(object):
         assert mock_enqueue.call_count == 1
 
         assert mock_enqueue.call_args[0][0] == run_validation_job
-        assert mock_enqueue.call_args[0][1][0]["id"] == dataset["resources"][0]["id"]
+        assert mock_enqueue.call_args[0][1][0] == dataset["resources"][0]["id"]
 
     @pytest.mark.ckan_config("ckanext.validation.run_on_create_async", False)
     @mock.patch("ckanext.validation.logic.enqueue_job")
@@ -105,7 +116,72 @@ class TestResourceControllerHooksUpdate(object):
         assert mock_enqueue.call_count == 1
 
         assert mock_enqueue.call_args[0][0] == run_validation_job
-        assert mock_enqueue.call_args[0][1][0]["id"] == resource["id"]
+        assert mock_enqueue.call_args[0][1][0] == resource["id"]
+
+    @pytest.mark.ckan_config("ckanext.validation.run_on_create_async", False)
+    @mock.patch("ckanext.validation.logic.enqueue_jobs", side_effect=_mock_jobs)
+    @mock.patch("ckanext.validation.logic.enqueue_job")
+    def test_update_markers_not_kept_after_update(
+            self, mock_enqueue, mock_enqueue_jobs):
+
+        get_update_markers().clear()
+
+        resource = {"format": "CSV", "url": "https://some.url"}
+
+        dataset = factories.Dataset(resources=[resource])
+
+        dataset["resources"][0]["url"] = "https://some.new.url"
+
+        context = {}
+        call_action("resource_update", context, **dataset["resources"][0])
+
+        assert mock_enqueue.call_count == 1
+        assert context["_validation_markers"] == set()
+        assert len(get_update_markers()) == 0
+
+        # A following dataset update is not skipped
+        call_action("package_update", {}, **call_action(
+            "package_show", id=dataset["id"]))
+
+        assert mock_enqueue_jobs.call_count == 1
+
+    @mock.patch("ckanext.validation.plugin._get_request_key",
+                return_value="request-1")
+    def test_update_markers_in_context_only(self, mock_request_key):
+        from ckanext.validation.plugin import ValidationPlugin
+
+        get_update_markers().clear()
+        plugin = ValidationPlugin()
+
+        context = {}
+        plugin._add_marker(context, ("resource", "r1"))
+
+        assert context["_validation_markers"] == {("resource", "r1")}
+        assert len(get_update_markers()) == 0
+        # Other contexts do not see it
+        assert not plugin._has_marker({}, ("resource", "r1"))
+        assert plugin._has_marker(context, ("resource", "r1"), remove=True)
+        assert not plugin._has_marker(context, ("resource", "r1"))
+
+    @mock.patch("ckanext.validation.plugin._get_request_key")
+    def test_update_markers_fallback_keyed_by_request(self, mock_request_key):
+        from ckanext.validation.plugin import ValidationPlugin
+
+        get_update_markers().clear()
+        plugin = ValidationPlugin()
+
+        mock_request_key.return_value = "request-1"
+        plugin._add_marker(None, ("package", "p1"))
+
+        assert len(get_update_markers()) == 1
+
+        # Another request does not see it
+        mock_request_key.return_value = "request-2"
+        assert not plugin._has_marker({}, ("package", "p1"), remove=True)
+
+        mock_request_key.return_value = "request-1"
+        assert plugin._has_marker(None, ("package", "p1"), remove=True)
+        assert len(get_update_markers()) == 0
 
     @pytest.mark.ckan_config("ckanext.validation.run_on_create_async", False)
     @pytest.mark.ckan_config("ckanext.validation.run_on_update_async", False)
@@ -140,7 +216,7 @@ class TestResourceControllerHooksCreate(object):
         assert mock_enqueue.call_count == 1
 
         assert mock_enqueue.call_args[0][0] == run_validation_job
-        assert mock_enqueue.call_args[0][1][0]["id"] == resource["id"]
+        assert mock_enqueue.call_args[0][1][0] == resource["id"]
 
     @mock.patch("ckanext.validation.logic.enqueue_job")
     @pytest.mark.ckan_config("ckanext.validation.run_on_update_async", False)
@@ -151,7 +227,7 @@ class TestResourceControllerHooksCreate(object):
         assert mock_enqueue.call_count == 1
 
         assert mock_enqueue.call_args[0][0] == run_validation_job
-        assert mock_enqueue.call_args[0][1][0]["id"] == resource["id"]
+        assert mock_enqueue.call_args[0][1][0] == resource["id"]
 
     @pytest.mark.ckan_config("ckanext.validation.run_on_create_async", False)
     @pytest.mark.ckan_config("ckanext.validation.run_on_update_async", False)
@@ -174,7 +250,7 @@ class TestResourceControllerHooksCreate(object):
 @pytest.mark.usefixtures("clean_db", "validation_setup", "with_plugins")
 class TestPackageControllerHooksCreate(object):
 
-    @mock.patch("ckanext.validation.logic.enqueue_job")
+    @mock.patch("ckanext.validation.logic.enqueue_jobs", side_effect=_mock_jobs)
     def test_validation_does_not_run_on_other_formats(self, mock_enqueue):
 
         factories.Dataset(resources=[{"format": "PDF"}])
@@ -182,14 +258,14 @@ class TestPackageControllerHooksCreate(object):
         mock_enqueue.assert_not_called()
 
     @pytest.mark.ckan_config("ckanext.validation.run_on_create_async", False)
-    @mock.patch("ckanext.validation.logic.enqueue_job")
+    @mock.patch("ckanext.validation.logic.enqueue_jobs", side_effect=_mock_jobs)
     def test_validation_does_not_run_when_config_false(self, mock_enqueue):
 
         factories.Dataset(resources=[{"format": "CSV", "url": "http://some.data"}])
 
         mock_enqueue.assert_not_called()
 
-    @mock.patch("ckanext.validation.logic.enqueue_job")
+    @mock.patch("ckanext.validation.logic.enqueue_jobs", side_effect=_mock_jobs)
     def test_validation_run_with_upload(self, mock_enqueue):
 
         resource = {"id": "test-resource-id", "format": "CSV", "url_type": "upload"}
@@ -198,9 +274,9 @@ class TestPackageControllerHooksCreate(object):
         assert mock_enqueue.call_count == 1
 
         assert mock_enqueue.call_args[0][0] == run_validation_job
-        assert mock_enqueue.call_args[0][1][0]["id"] == resource["id"]
+        assert [args[0] for args in mock_enqueue.call_args[0][1]] == [resource["id"]]
 
-    @mock.patch("ckanext.validation.logic.enqueue_job")
+    @mock.patch("ckanext.validation.logic.enqueue_jobs", side_effect=_mock_jobs)
     def test_validation_run_with_url(self, mock_enqueue):
 
         resource = {
@@ -213,9 +289,9 @@ class TestPackageControllerHooksCreate(object):
         assert mock_enqueue.call_count == 1
 
         assert mock_enqueue.call_args[0][0] == run_validation_job
-        assert mock_enqueue.call_args[0][1][0]["id"] == resource["id"]
+        assert [args[0] for args in mock_enqueue.call_args[0][1]] == [resource["id"]]
 
-    @mock.patch("ckanext.validation.logic.enqueue_job")
+    @mock.patch("ckanext.validation.logic.enqueue_jobs", side_effect=_mock_jobs)
     def test_validation_run_only_supported_formats(self, mock_enqueue):
 
         resource1 = {
@@ -234,14 +310,14 @@ class TestPackageControllerHooksCreate(object):
         assert mock_enqueue.call_count == 1
 
         assert mock_enqueue.call_args[0][0] == run_validation_job
-        assert mock_enqueue.call_args[0][1][0]["id"] == resource1["id"]
+        assert [args[0] for args in mock_enqueue.call_args[0][1]] == [resource1["id"]]
 
 
 @pytest.mark.usefixtures("clean_db", "validation_setup", "with_plugins")
 class TestPackageControllerHooksUpdate(object):
 
     @pytest.mark.ckan_config("ckanext.validation.run_on_create_async", False)
-    @mock.patch("ckanext.validation.logic.enqueue_job")
+    @mock.patch("ckanext.validation.logic.enqueue_jobs", side_effect=_mock_jobs)
     def test_validation_runs_with_url(self, mock_enqueue):
 
         resource = {
@@ -260,10 +336,10 @@ class TestPackageControllerHooksUpdate(object):
         assert mock_enqueue.call_count == 1
 
         assert mock_enqueue.call_args[0][0] == run_validation_job
-        assert mock_enqueue.call_args[0][1][0]["id"] == resource["id"]
+        assert [args[0] for args in mock_enqueue.call_args[0][1]] == [resource["id"]]
 
     @pytest.mark.ckan_config("ckanext.validation.run_on_create_async", False)
-    @mock.patch("ckanext.validation.logic.enqueue_job")
+    @mock.patch("ckanext.validation.logic.enqueue_jobs", side_effect=_mock_jobs)
     def test_validation_runs_with_upload(self, mock_enqueue):
 
         resource = {"id": "test-resource-id", "format": "CSV", "url_type": "upload"}
@@ -278,10 +354,10 @@ class TestPackageControllerHooksUpdate(object):
         assert mock_enqueue.call_count == 1
 
         assert mock_enqueue.call_args[0][0] == run_validation_job
-        assert mock_enqueue.call_args[0][1][0]["id"] == resource["id"]
+        assert [args[0] for args in mock_enqueue.call_args[0][1]] == [resource["id"]]
 
     @pytest.mark.ckan_config("ckanext.validation.run_on_create_async", False)
-    @mock.patch("ckanext.validation.logic.enqueue_job")
+    @mock.patch("ckanext.validation.logic.enqueue_jobs", side_effect=_mock_jobs)
     def test_validation_does_not_run_on_other_formats(self, mock_enqueue):
 
         resource = {"id": "test-resource-id", "format": "PDF", "url": "http://some.doc"}
@@ -296,7 +372,7 @@ class TestPackageControllerHooksUpdate(object):
         mock_enqueue.assert_not_called()
 
     @pytest.mark.ckan_config("ckanext.validation.run_on_create_async", False)
-    @mock.patch("ckanext.validation.logic.enqueue_job")
+    @mock.patch("ckanext.validation.logic.enqueue_jobs", side_effect=_mock_jobs)
     def test_validation_run_only_supported_formats(self, mock_enqueue):
 
         resource1 = {
@@ -321,11 +397,11 @@ class TestPackageControllerHooksUpdate(object):
         assert mock_enqueue.call_count == 1
 
         assert mock_enqueue.call_args[0][0] == run_validation_job
-        assert mock_enqueue.call_args[0][1][0]["id"] == resource1["id"]
+        assert [args[0] for args in mock_enqueue.call_args[0][1]] == [resource1["id"]]
 
     @pytest.mark.ckan_config("ckanext.validation.run_on_create_async", False)
     @pytest.mark.ckan_config("ckanext.validation.run_on_update_async", False)
-    @mock.patch("ckanext.validation.logic.enqueue_job")
+    @mock.patch("ckanext.validation.logic.enqueue_jobs", side_effect=_mock_jobs)
     def test_validation_does_not_run_when_config_false(self, mock_enqueue):
 
         resource = {
@@ -338,3 +414,153 @@ class TestPackageControllerHooksUpdate(object):
         call_action("package_update", {}, **dataset)
 
         mock_enqueue.assert_not_called()
+
+    @pytest.mark.ckan_config("ckanext.validation.run_on_create_async", False)
+    @mock.patch("ckanext.validation.logic.enqueue_jobs", side_effect=_mock_jobs)
+    def test_validation_only_runs_on_changed_resources(self, mock_enqueue):
+
+        dataset = factories.Dataset(resources=[
+            {"format": "CSV", "url": "http://some.data"},
+            {"format": "CSV", "url": "http://some.other.data"},
+        ])
+
+        for resource in dataset["resources"]:
+            upsert_validation(
+                resource["id"], status="success",
+                signature=get_resource_signature(resource))
+        model.Session.commit()
+
+        dataset["resources"][1]["url"] = "http://some.new.data"
+
+        call_action("package_update", {}, **dataset)
+
+        assert mock_enqueue.call_count == 1
+        assert [args[0] for args in mock_enqueue.call_args[0][1]] == [
+            dataset["resources"][1]["id"]]
+
+    @pytest.mark.ckan_config("ckanext.validation.run_on_create_async", False)
+    @mock.patch("ckanext.validation.logic.enqueue_jobs", side_effect=_mock_jobs)
+    def test_validation_runs_on_unchanged_resources_not_validated(
+            self, mock_enqueue):
+
+        dataset = factories.Dataset(resources=[
+            {"format": "CSV", "url": "http://some.data"},
+            {"format": "CSV", "url": "http://some.other.data"},
+        ])
+
+        # The first validation errored, the second one never finished
+        for resource, status in zip(dataset["resources"], ["error", "running"]):
+            upsert_validation(
+                resource["id"], status=status,
+                signature=get_resource_signature(resource))
+        model.Session.commit()
+
+        call_action("package_update", {}, **dataset)
+
+        assert mock_enqueue.call_count == 1
+        assert [args[0] for args in mock_enqueue.call_args[0][1]] == [
+            resource["id"] for resource in dataset["resources"]]
+
+    @pytest.mark.ckan_config("ckanext.validation.run_on_create_async", False)
+    @mock.patch("ckanext.validation.logic.enqueue_jobs", side_effect=_mock_jobs)
+    def test_validation_does_not_run_on_unchanged_resources(self, mock_enqueue):
+
+        dataset = factories.Dataset(resources=[
+            {"format": "CSV", "url": "http://some.data"},
+        ])
+        resource = dataset["resources"][0]
+        upsert_validation(
+            resource["id"], status="success",
+            signature=get_resource_signature(resource))
+        model.Session.commit()
+
+        dataset["notes"] = "Some notes"
+
+        call_action("package_update", {}, **dataset)
+
+        mock_enqueue.assert_not_called()
+
+
+@pytest.mark.usefixtures("clean_db", "validation_setup", "with_plugins")
+class TestBeforeUpdatePackageId(object):
+    def _get_package_id(self, context, current_resource, updated_resource):
+        from ckanext.validation.plugin import ValidationPlugin
+        return ValidationPlugin._get_package_id(
+            None, context, current_resource, updated_resource)
+
+    @mock.patch("ckanext.validation.plugin.model.Session.query")
+    def test_package_id_from_resource_dicts(self, mock_query):
+
+        assert self._get_package_id(
+            {}, {"package_id": "p1"}, {"id": "r1"}) == "p1"
+        assert self._get_package_id(
+            {}, {"package_id": "p1"}, {"id": "r1", "package_id": "p2"}) == "p2"
+        assert self._get_package_id(
+            {"package": mock.Mock(id="p3")}, {}, {"id": "r1"}) == "p3"
+
+        assert not mock_query.called
+
+    def test_package_id_from_database(self):
+
+        dataset = factories.Dataset(resources=[{"url": "https://some.url"}])
+
+        assert self._get_package_id(
+            {}, {}, {"id": dataset["resources"][0]["id"]}) == dataset["id"]
+
+    @mock.patch("ckanext.validation.logic.enqueue_job")
+    def test_resource_update_does_not_call_resource_show(self, mock_enqueue):
+
+        dataset = factories.Dataset(resources=[{"url": "https://some.url"}])
+        resource = dataset["resources"][0]
+        del resource["package_id"]
+
+        with mock.patch(
+                "ckanext.validation.plugin.t.get_action",
+                wraps=t.get_action) as mock_get_action:
+            call_action("resource_update", {}, **resource)
+
+        assert "resource_show" not in [
+            c[0][0] for c in mock_get_action.call_args_list]
+
+
+class TestBeforeIndex(object):
+    def _before_index(self, index_dict):
+        from ckanext.validation.plugin import ValidationPlugin
+        return ValidationPlugin.before_index(None, index_dict)
+
+    def test_before_index_from_validated_data_dict(self):
+
+        index_dict = self._before_index({
+            "validated_data_dict": json.dumps({
+                "resources": [
+                    {"id": "r1", "validation_status": "success"},
+                    {"id": "r2"},
+                    {"id": "r3", "validation_status": "failure"},
+                ]
+            })
+        })
+
+        assert index_dict["vocab_validation_status"] == ["success", "failure"]
+
+    @mock.patch("ckanext.validation.plugin.json.loads")
+    def test_before_index_no_statuses_not_parsed(self, mock_loads):
+
+        index_dict = self._before_index({
+            "validated_data_dict": json.dumps({"resources": [{"id": "r1"}]})
+        })
+
+        assert "vocab_validation_status" not in index_dict
+        assert not mock_loads.called
+
+    @mock.patch("ckanext.validation.plugin.json.loads")
+    def test_before_index_from_resource_extras(self, mock_loads):
+
+        index_dict = self._before_index({
+            "res_extras_validation_status": ["success", ""],
+            "validated_data_dict": json.dumps({
+                "resources": [{"id": "r1", "validation_status": "success"}]
+            }),
+        })
+
+        assert index_dict["vocab_validation_status"] == ["success"]
+        assert not mock_loads.called
@@ -0,0 +1,126 @@
+from unittest import mock
+
+import pytest
+
+from ckanext.validation import queues
+
+
+class TestQueues(object):
+    def test_default_queues(self):
+
+        for job_class in queues.JOB_CLASSES:
+            assert queues.get_queue_name(job_class) == "default"
+
+        assert queues.get_rq_kwargs(queues.INTERACTIVE) == {"at_front": True}
+        assert queues.get_rq_kwargs(queues.UPLOAD) == {"at_front": False}
+        assert queues.get_rq_kwargs(queues.BATCH) == {"at_front": False}
+
+    @pytest.mark.ckan_config(
+        "ckanext.validation.queue_name.batch", "validation_batch")
+    @pytest.mark.ckan_config("ckanext.validation.queue_priority.upload", "high")
+    def test_configured_queues(self):
+
+        assert queues.get_queue_name(queues.BATCH) == "validation_batch"
+        assert queues.get_queue_priority(queues.UPLOAD) == "high"
+
+    @pytest.mark.ckan_config(
+        "ckanext.validation.queue_priority.batch", "urgent")
+    def test_unknown_priority(self):
+
+        assert queues.get_queue_priority(queues.BATCH) == "normal"
+
+
+class TestBatchThrottling(object):
+    @pytest.mark.ckan_config("ckanext.validation.batch_max_queued", "10")
+    @mock.patch("ckanext.validation.queues.time.sleep")
+    @mock.patch("ckanext.validation.queues.get_queue_depth")
+    def test_waits_until_queue_drains(self, mock_depth, mock_sleep):
+
+        mock_depth.side_effect = [15, 10, 9]
+
+        assert queues.wait_for_batch_queue() == 10
+        assert mock_sleep.call_count == 2
+        mock_depth.assert_called_with(queues.BATCH)
+
+    @pytest.mark.ckan_config("ckanext.validation.batch_max_queued", "10")
+    @pytest.mark.ckan_config("ckanext.validation.batch_max_wait", "20")
+    @mock.patch("ckanext.validation.queues.time.sleep")
+    @mock.patch("ckanext.validation.queues.get_queue_depth")
+    def test_gives_up_after_max_wait(self, mock_depth, mock_sleep):
+
+        mock_depth.return_value = 15
+
+        assert queues.wait_for_batch_queue() == 20
+        assert mock_sleep.call_count == 4
+
+    @pytest.mark.ckan_config("ckanext.validation.batch_max_queued", "0")
+    @mock.patch("ckanext.validation.queues.get_queue_depth")
+    def test_throttling_disabled(self, mock_depth):
+
+        assert queues.wait_for_batch_queue() == 0
+        assert not mock_depth.called
+
+    @mock.patch("ckanext.validation.queues.get_queue_depth")
+    def test_queue_not_available(self, mock_depth):
+
+        mock_depth.return_value = None
+
+        assert queues.wait_for_batch_queue() == 0
+
+
+@pytest.fixture
+def mock_redis():
+    redis = mock.MagicMock()
+    with mock.patch(
+        "ckanext.validation.queues.get_redis_connection", return_value=redis
+    ):
+        yield redis
+
+
+class TestPendingJobs(object):
+    @mock.patch("ckanext.validation.queues._cancel_queued_job")
+    def test_set_pending_jobs_cancels_previous(self, mock_cancel, mock_redis):
+
+        mock_redis.pipeline.return_value.execute.return_value = [
+            b"old-job-1", True, None, True, b"old-job-3", True]
+        mock_cancel.side_effect = [True, False]
+
+        cancelled = queues.set_pending_jobs(
+            {"res-1": "job-1", "res-2": "job-2", "res-3": "job-3"})
+
+        assert cancelled == 1
+        assert [c[0][1] for c in mock_cancel.call_args_list] == [
+            "old-job-1", "old-job-3"]
+        mock_redis.incrby.assert_called_with(
+            queues._get_suppressed_key(), 1)
+
+    def test_set_pending_jobs_redis_error(self, mock_redis):
+
+        mock_redis.pipeline.return_value.execute.side_effect = (
+            queues.RedisError())
+
+        assert queues.set_pending_jobs({"res-1": "job-1"}) == 0
+
+    def test_claim_pending_job(self, mock_redis):
+
+        mock_redis.eval.return_value = 1
+        assert queues.claim_pending_job("res-1", "job-1") is True
+
+        # No pending marker, eg it expired
+        mock_redis.eval.return_value = 0
+        assert queues.claim_pending_job("res-1", "job-1") is True
+
+        assert not mock_redis.incr.called
+
+    def test_claim_superseded_job(self, mock_redis):
+
+        mock_redis.eval.return_value = -1
+
+        assert queues.claim_pending_job("res-1", "job-1") is False
+        mock_redis.incr.assert_called_with(queues._get_suppressed_key())
+
+    def test_suppressed_count(self, mock_redis):
+
+        mock_redis.get.return_value = b"3"
+
+        assert queues.get_suppressed_count() == 3
@@ -0,0 +1,167 @@
+import io
+import os
+
+import pytest
+
+from ckanext.validation.sampling import (
+    get_sample_options,
+    sample_source,
+    map_sample_rows,
+    _iter_records,
+    _reservoir_sample,
+    _block_sample,
+)
+
+
+class TestSampleOptions(object):
+    def test_sample_options_default_full(self):
+
+        assert get_sample_options() is None
+
+    @pytest.mark.ckan_config("ckanext.validation.sample_mode", "head")
+    def test_sample_options_from_config(self):
+
+        sample = get_sample_options()
+
+        assert sample["mode"] == "head"
+        assert sample["rows"] == 10000
+
+    @pytest.mark.ckan_config("ckanext.validation.sample_mode", "head")
+    def test_sample_options_resource_overrides_config(self):
+
+        sample = get_sample_options({"mode": "reservoir", "rows": 5})
+
+        assert sample["mode"] == "reservoir"
+        assert sample["rows"] == 5
+
+    @pytest.mark.ckan_config("ckanext.validation.sample_mode", "head")
+    def test_sample_options_resource_full(self):
+
+        assert get_sample_options("full") is None
+
+    def test_sample_options_unknown_mode(self):
+
+        assert get_sample_options({"mode": "some"}) is None
+
+
+class TestSampling(object):
+    def test_iter_records_multiline_values(self):
+
+        stream = io.BytesIO(b'a,b\n1,"some\ntext"\n2,"with ""quotes"""\n')
+
+        records = list(_iter_records(stream))
+
+        assert records == [
+            b"a,b\n",
+            b'1,"some\ntext"\n',
+            b'2,"with ""quotes"""\n',
+        ]
+
+    def test_reservoir_sample(self):
+
+        records = [str(i).encode() for i in range(1000)]
+
+        rows = _reservoir_sample(enumerate(records), 10)
+
+        assert len(rows) == 10
+        assert rows == sorted(rows)
+        assert all(records[index] == record for index, record in rows)
+
+    def test_reservoir_sample_is_stable(self):
+
+        records = [str(i).encode() for i in range(1000)]
+
+        assert (_reservoir_sample(enumerate(records), 10) ==
+                _reservoir_sample(enumerate(records), 10))
+
+    def test_block_sample(self):
+
+        records = [str(i).encode() for i in range(100)]
+
+        rows = list(_block_sample(enumerate(records), 5, 10))
+
+        assert [record for index, record in rows] == (
+            records[0:10] + records[50:60])
+        assert [index for index, record in rows] == (
+            list(range(0, 10)) + list(range(50, 60)))
+
+    def test_sample_source_keeps_header(self, tmp_path):
+
+        source = tmp_path / "data.csv"
+        source.write_text("a,b\n" + "".join("{},x\n".format(i) for i in range(100)))
+
+        path, info, row_map = sample_source(
+            str(source), {"mode": "block", "every": 10, "block_size": 5})
+
+        with open(path) as f:
+            lines = f.read().splitlines()
+        os.remove(path)
+
+        assert lines[0] == "a,b"
+        assert lines[1:] == ["{},x".format(i) for i in range(100) if i % 50 < 5]
+        assert info == {
+            "mode": "block", "rows": 10, "total_rows": 100, "rate": 0.1}
+
+    def test_sample_source_header_rows_from_dialect(self, tmp_path):
+
+        source = tmp_path / "data.csv"
+        source.write_text("title\na,b\n" + "".join("{},x\n".format(i) for i in range(10)))
+
+        path, info, row_map = sample_source(
+            str(source), {"mode": "reservoir", "rows": 2},
+            dialect={"headerRows": [2]})
+
+        with open(path) as f:
+            lines = f.read().splitlines()
+        os.remove(path)
+
+        assert lines[0:2] == ["title", "a,b"]
+        assert len(lines) == 4
+        assert info["rate"] == 0.2
+
+        # Rows 3 and 4 of the sample are the sampled data rows
+        for row_number in (3, 4):
+            value = int(lines[row_number - 1].split(",")[0])
+            assert row_map(row_number) == value + 3
+        assert row_map(2) == 2
+
+    def test_sample_source_block_row_numbers(self, tmp_path):
+
+        source = tmp_path / "data.csv"
+        source.write_text("a,b\n" + "".join("{},x\n".format(i) for i in range(1000)))
+
+        path, info, row_map = sample_source(
+            str(source), {"mode": "block", "every": 10, "block_size": 50})
+
+        with open(path) as f:
+            lines = f.read().splitlines()
+        os.remove(path)
+
+        # Row 52 of the sample is the first row of the second sampled block,
+        # ie the data row 500, at row 502 of the source (after the header)
+        assert lines[51] == "500,x"
+        assert row_map(52) == 502
+        assert row_map(2) == 2
+        assert info["rows"] == 100
+
+    def test_sample_source_missing_file_is_removed(self, tmp_path):
+
+        with pytest.raises(IOError):
+            sample_source(
+                str(tmp_path / "missing.csv"), {"mode": "reservoir", "rows": 2})
+
+        assert os.listdir(str(tmp_path)) == []
+
+    def test_map_sample_rows(self):
+
+        report = {"tasks": [{"errors": [
+            {"rowNumber": 52, "message": 'Row at position "52" has a missing cell'},
+            {"message": "Some table error"},
+        ]}]}
+
+        report = map_sample_rows(report, lambda row_number: row_number + 450)
+
+        errors = report["tasks"][0]["errors"]
+        assert errors[0]["rowNumber"] == 502
+        assert errors[0]["message"] == 'Row at position "502" has a missing cell'
+        assert errors[1] == {"message": "Some table error"}
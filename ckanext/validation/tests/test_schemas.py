@@ -0,0 +1,137 @@
+import json
+from unittest import mock
+
+import pytest
+import requests
+
+from ckanext.validation import schemas
+from ckanext.validation.schemas import (
+    SchemaCache,
+    get_schema,
+    get_schema_descriptor,
+)
+
+
+SCHEMA = {
+    "fields": [
+        {"name": "id", "type": "integer"},
+        {"name": "description", "type": "string"},
+    ]
+}
+
+
+def _mock_response(status_code=200, descriptor=None, headers=None):
+    response = mock.Mock(status_code=status_code, headers=headers or {})
+    response.json.return_value = descriptor
+    if status_code >= 400:
+        response.raise_for_status.side_effect = requests.HTTPError()
+    return response
+
+
+@pytest.fixture
+def schema_cache():
+    schemas._cache = None
+    yield
+    schemas._cache = None
+
+
+class TestSchemaCache(object):
+    def test_cache_lru(self):
+
+        cache = SchemaCache(size=2)
+        cache.set("a", value=1)
+        cache.set("b", value=2)
+        cache.get("a")
+        cache.set("c", value=3)
+
+        assert cache.get("a")[0]["value"] == 1
+        assert cache.get("b") == (None, False)
+        assert len(cache) == 2
+
+    def test_cache_ttl(self):
+
+        cache = SchemaCache(ttl=0)
+        cache.set("a", value=1)
+
+        entry, fresh = cache.get("a")
+
+        assert entry["value"] == 1
+        assert fresh is False
+
+
+@pytest.mark.usefixtures("schema_cache")
+class TestSchemaDescriptor(object):
+    def test_inline_schema(self):
+
+        assert get_schema_descriptor(json.dumps(SCHEMA)) == SCHEMA
+        assert get_schema_descriptor(SCHEMA) == SCHEMA
+
+    def test_remote_schema_is_cached(self):
+
+        session = mock.Mock()
+        session.get.return_value = _mock_response(descriptor=SCHEMA)
+
+        for i in range(3):
+            descriptor = get_schema_descriptor(
+                "https://example.com/schema.json", http_session=session)
+
+        assert descriptor == SCHEMA
+        assert session.get.call_count == 1
+
+    @pytest.mark.ckan_config("ckanext.validation.schema_cache_ttl", "0")
+    def test_remote_schema_conditional_request(self):
+
+        session = mock.Mock()
+        session.get.return_value = _mock_response(
+            descriptor=SCHEMA, headers={"ETag": '"abc"'})
+        get_schema_descriptor("https://example.com/schema.json", http_session=session)
+
+        session.get.return_value = _mock_response(status_code=304)
+        descriptor = get_schema_descriptor(
+            "https://example.com/schema.json", http_session=session)
+
+        assert descriptor == SCHEMA
+        assert session.get.call_args[1]["headers"] == {"If-None-Match": '"abc"'}
+
+    @pytest.mark.ckan_config("ckanext.validation.schema_cache_ttl", "0")
+    def test_remote_schema_changed(self):
+
+        session = mock.Mock()
+        session.get.return_value = _mock_response(descriptor=SCHEMA)
+        get_schema_descriptor("https://example.com/schema.json", http_session=session)
+
+        new_schema = {"fields": [{"name": "id", "type": "string"}]}
+        session.get.return_value = _mock_response(descriptor=new_schema)
+        descriptor = get_schema_descriptor(
+            "https://example.com/schema.json", http_session=session)
+
+        assert descriptor == new_schema
+
+    @pytest.mark.ckan_config("ckanext.validation.schema_cache_ttl", "0")
+    def test_remote_schema_error_uses_cached_version(self):
+
+        session = mock.Mock()
+        session.get.return_value = _mock_response(descriptor=SCHEMA)
+        get_schema_descriptor("https://example.com/schema.json", http_session=session)
+
+        session.get.return_value = _mock_response(status_code=500)
+        descriptor = get_schema_descriptor(
+            "https://example.com/schema.json", http_session=session)
+
+        assert descriptor == SCHEMA
+
+    def test_remote_schema_error(self):
+
+        session = mock.Mock()
+        session.get.return_value = _mock_response(status_code=404)
+
+        with pytest.raises(requests.HTTPError):
+            get_schema_descriptor(
+                "https://example.com/schema.json", http_session=session)
+
+    def test_parsed_schema_is_cached(self):
+
+        schema = get_schema(SCHEMA)
+
+        assert schema.to_dict() == SCHEMA
+        assert get_schema(json.loads(json.dumps(SCHEMA))) is schema
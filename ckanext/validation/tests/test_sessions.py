@@ -0,0 +1,68 @@
+from unittest import mock
+
+import pytest
+
+from ckanext.validation.sessions import (
+    get_http_session,
+    reset_http_session,
+    ValidationSession,
+)
+
+
+@pytest.fixture
+def new_session():
+    reset_http_session()
+    yield
+    reset_http_session()
+
+
+@pytest.mark.usefixtures("new_session")
+class TestHTTPSession(object):
+    def test_sessions_share_connection_pool(self):
+
+        session1 = get_http_session()
+        session2 = get_http_session(headers={"Authorization": "some-key"})
+
+        assert session1.session is session2.session
+        assert session1.headers == {}
+
+    @pytest.mark.ckan_config("ckanext.validation.http_retries", "5")
+    @pytest.mark.ckan_config("ckanext.validation.http_pool_maxsize", "20")
+    def test_session_adapter_options(self):
+
+        adapter = get_http_session().session.get_adapter("https://example.com")
+
+        assert adapter.max_retries.total == 5
+        assert 503 in adapter.max_retries.status_forcelist
+        assert adapter._pool_maxsize == 20
+
+    @pytest.mark.ckan_config("ckan.download_proxy", "http://proxy:3128")
+    @pytest.mark.ckan_config("ckanext.validation.http_read_timeout", "120")
+    def test_request_options_added_per_request(self):
+
+        shared = mock.Mock()
+
+        with mock.patch(
+                "ckanext.validation.sessions._get_shared_session",
+                return_value=shared):
+            session = get_http_session(headers={"Authorization": "some-key"})
+            session.get("http://example.com/file.csv", headers={"Range": "bytes=0-10"})
+
+        method, url = shared.request.call_args[0]
+        kwargs = shared.request.call_args[1]
+        assert (method, url) == ("GET", "http://example.com/file.csv")
+        assert kwargs["headers"] == {
+            "Authorization": "some-key", "Range": "bytes=0-10"}
+        assert kwargs["proxies"] == {
+            "http": "http://proxy:3128", "https": "http://proxy:3128"}
+        assert kwargs["timeout"] == (10.0, 120.0)
+        assert shared.headers.update.called is False
+
+    def test_request_timeout_can_be_overridden(self):
+
+        shared = mock.Mock()
+        session = ValidationSession(shared, timeout=(1, 2))
+
+        session.get("http://example.com/file.csv", timeout=30)
+
+        assert shared.request.call_args[1]["timeout"] == 30
@@ -10,7 +10,12 @@ from ckanext.validation.utils import (
     get_create_mode_from_config,
     get_update_mode_from_config,
     get_local_upload_path,
+    get_validation_limits,
     delete_local_uploaded_file,
+    get_sync_limits,
+    ExpiringSet,
+    get_resource_signature,
+    count_lines,
 )
 
 
@@ -68,6 +73,116 @@ class TestConfig(object):
         assert get_create_mode_from_config() is None
 
 
+class TestValidationLimits(object):
+    def test_limits_default(self):
+
+        assert get_validation_limits("csv") == {}
+
+    @pytest.mark.ckan_config("ckanext.validation.limit_errors", "100")
+    @pytest.mark.ckan_config("ckanext.validation.limit_seconds", "30")
+    def test_limits_from_config(self):
+
+        assert get_validation_limits("csv") == {
+            "limit_errors": 100, "limit_seconds": 30}
+
+    @pytest.mark.ckan_config("ckanext.validation.limit_rows", "1000")
+    @pytest.mark.ckan_config("ckanext.validation.limit_rows.xlsx", "10")
+    def test_limits_per_format(self):
+
+        assert get_validation_limits("csv") == {"limit_rows": 1000}
+        assert get_validation_limits("XLSX") == {"limit_rows": 10}
+
+class TestSyncLimits(object):
+    def test_sync_limits_default(self):
+
+        assert get_sync_limits() == (0, 0)
+
+    @pytest.mark.ckan_config("ckanext.validation.sync_max_size", "1000")
+    @pytest.mark.ckan_config("ckanext.validation.sync_max_rows", "50")
+    def test_sync_limits_from_config(self):
+
+        assert get_sync_limits() == (1000, 50)
+
+    def test_count_lines(self, tmp_path):
+
+        path = tmp_path / "data.csv"
+        path.write_bytes(b"a,b\n" * 10)
+
+        assert count_lines(str(path)) == 10
+        assert count_lines(str(path), limit=20) == 10
+
+
+class TestResourceSignature(object):
+    def test_signature_normalized(self):
+
+        resource = {
+            "url": "http://some.site/dataset/x/resource/y/download/data.csv",
+            "url_type": "upload",
+            "format": "CSV",
+            "schema": {"fields": [{"name": "a"}]},
+            "size": 100,
+        }
+        saved_resource = {
+            "url": "data.csv",
+            "url_type": "upload",
+            "format": "csv",
+            "schema": '{"fields": [{"name": "a"}]}',
+            "size": "100",
+            "hash": "",
+        }
+
+        assert get_resource_signature(resource) == get_resource_signature(
+            saved_resource)
+
+    def test_signature_changes(self):
+
+        resource = {"url": "http://some.data", "format": "CSV"}
+
+        for field, value in [
+            ("url", "http://some.other.data"),
+            ("format", "XLSX"),
+            ("schema", '{"fields": []}'),
+            ("last_modified", "2024-01-01T00:00:00"),
+        ]:
+            assert get_resource_signature(
+                dict(resource, **{field: value})
+            ) != get_resource_signature(resource)
+
+
+class TestExpiringSet(object):
+    def test_add_and_discard(self):
+
+        markers = ExpiringSet(size=10, ttl=60)
+        markers.add("a")
+
+        assert "a" in markers
+        assert len(markers) == 1
+        assert markers.discard("a")
+        assert "a" not in markers
+        assert not markers.discard("a")
+
+    def test_bounded_size(self):
+
+        markers = ExpiringSet(size=2, ttl=60)
+        for key in ["a", "b", "c"]:
+            markers.add(key)
+
+        assert len(markers) == 2
+        assert "a" not in markers
+        assert "c" in markers
+
+    def test_keys_expire(self):
+
+        markers = ExpiringSet(size=10, ttl=60)
+        with mock.patch("ckanext.validation.utils.time.time", return_value=1000):
+            markers.add("a")
+
+        with mock.patch("ckanext.validation.utils.time.time", return_value=1061):
+            assert "a" not in markers
+            assert not markers.discard("a")
+            assert len(markers) == 0
+
+
 class TestFiles(object):
     @mock_uploads_fake_fs
     def test_local_path(self, mock_open):
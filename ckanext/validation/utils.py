@@ -1,12 +1,25 @@
+import collections
+import hashlib
+import json
 import os
 import logging
+import threading
+import time
 
 from ckan.lib.uploader import ResourceUpload
-from ckantoolkit import config, asbool
+from ckantoolkit import config, asbool, asint
 
 
 log = logging.getLogger(__name__)
 
+# Resource fields whose changes require validating the resource again
+SIGNATURE_FIELDS = [
+    u'url', u'url_type', u'format', u'schema', u'validation_options',
+    u'hash', u'size', u'last_modified']
+
+DEFAULT_UPDATE_MARKERS_SIZE = 1000
+DEFAULT_UPDATE_MARKERS_TTL = 60
+
 
 def get_update_mode_from_config():
     if asbool(
@@ -30,6 +43,30 @@ def get_create_mode_from_config():
         return None
 
 
+def get_validation_limits(_format=None):
+    u'''
+    Returns the limits that will be applied when validating a resource
+
+    `ckanext.validation.limit_errors`, `ckanext.validation.limit_rows` and
+    `ckanext.validation.limit_seconds` set the site wide defaults, which can
+    be overridden for a particular format by appending it to the option
+    name, eg `ckanext.validation.limit_rows.xlsx`.
+
+    Only the limits that have been set are returned.
+    '''
+    limits = {}
+    for key in (u'limit_errors', u'limit_rows', u'limit_seconds'):
+        value = config.get(u'ckanext.validation.{}'.format(key))
+        if _format:
+            value = config.get(
+                u'ckanext.validation.{}.{}'.format(key, _format.lower()),
+                value)
+        if value:
+            limits[key] = asint(value)
+
+    return limits
+
+
 def get_local_upload_path(resource_id):
     u'''
     Returns the local path to an uploaded file give an id
@@ -71,3 +108,150 @@ def delete_local_uploaded_file(resource_id):
 
     except OSError as e:
         log.warning(u'Error deleting uploaded file: %s', e)
+
+
+def remove_temp_file(path):
+    u'''
+    Remove a temporary file created during the validation, logging any errors
+    '''
+    try:
+        os.remove(path)
+    except OSError as e:
+        log.warning(u'Error deleting temporary file: %s', e)
+
+
+def get_resource_signature(resource):
+    u'''
+    Returns a hash of the resource fields that affect its validation (URL,
+    format, schema, validation options and the hash, size and modification
+    time of the file)
+
+    Values are normalized, as the same resource can be represented slightly
+    differently depending on where the dict comes from (eg the full URL of
+    uploads in `resource_show` and just the file name when saving).
+    '''
+    values = {}
+    for field in SIGNATURE_FIELDS:
+        value = resource.get(field)
+        if value in (None, u''):
+            value = None
+        elif field == u'url' and resource.get(u'url_type') == u'upload':
+            value = value.rsplit(u'/', 1)[-1]
+        elif field == u'format':
+            value = value.lower()
+        elif field == u'size':
+            value = str(value)
+        elif field in (u'schema', u'validation_options') and isinstance(
+                value, str):
+            try:
+                value = json.loads(value)
+            except ValueError:
+                pass
+        elif hasattr(value, u'isoformat'):
+            value = value.isoformat()
+        values[field] = value
+
+    return hashlib.sha256(json.dumps(
+        values, sort_keys=True, default=str).encode(u'utf8')).hexdigest()
+
+
+def get_sync_limits():
+    u'''
+    Returns a tuple with the maximum size (in bytes) and number of rows of
+    the files validated synchronously (0 means no limit)
+    '''
+    return (
+        asint(config.get(u'ckanext.validation.sync_max_size', 0)),
+        asint(config.get(u'ckanext.validation.sync_max_rows', 0)),
+    )
+
+
+def count_lines(path, limit=None):
+    u'''
+    Returns the number of lines in a file, stopping once `limit` is exceeded
+    '''
+    count = 0
+    with open(path, u'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            count += chunk.count(b'\n')
+            if limit and count > limit:
+                break
+
+    return count
+
+
+class ExpiringSet(object):
+    u'''
+    Thread safe set whose keys expire after `ttl` seconds, holding at most
+    `size` keys (the oldest ones are dropped first when full)
+    '''
+
+    def __init__(self, size=DEFAULT_UPDATE_MARKERS_SIZE,
+                 ttl=DEFAULT_UPDATE_MARKERS_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._keys = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, key):
+        with self._lock:
+            self._keys.pop(key, None)
+            self._keys[key] = time.time() + self.ttl
+            self._prune()
+            while len(self._keys) > self.size:
+                self._keys.popitem(last=False)
+
+    def discard(self, key):
+        u'''
+        Removes the key, returning True if it was present and not expired
+        '''
+        with self._lock:
+            expires = self._keys.pop(key, None)
+            return expires is not None and time.time() < expires
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+
+    def __contains__(self, key):
+        with self._lock:
+            expires = self._keys.get(key)
+            return expires is not None and time.time() < expires
+
+    def __len__(self):
+        with self._lock:
+            self._prune()
+            return len(self._keys)
+
+    def _prune(self):
+        # Keys are kept in insertion order, so expired ones are at the start
+        now = time.time()
+        while self._keys:
+            key, expires = next(iter(self._keys.items()))
+            if expires > now:
+                break
+            del self._keys[key]
+
+
+_update_markers = None
+
+
+def get_update_markers():
+    u'''
+    Returns the process wide set of markers used by the plugin hooks to pass
+    decisions from `before_update` to `after_update` when they can not be
+    stored in the action context
+    '''
+    global _update_markers
+
+    if _update_markers is None:
+        _update_markers = ExpiringSet(
+            size=asint(config.get(
+                u'ckanext.validation.update_markers_size',
+                DEFAULT_UPDATE_MARKERS_SIZE)),
+            ttl=asint(config.get(
+                u'ckanext.validation.update_markers_ttl',
+                DEFAULT_UPDATE_MARKERS_TTL)),
+        )
+
+    return _update_markers
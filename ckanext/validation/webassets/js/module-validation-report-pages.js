@@ -0,0 +1,261 @@
+"use strict";
+
+/* Renders a validation report loading its errors in pages from the
+ * `resource_validation_report` action, as the user scrolls down, so big
+ * reports don't need to be loaded all at once.
+ *
+ * Options
+ *   resourceId - id of the resource
+ *   pageSize - number of errors requested each time (default 100)
+ */
+ckan.module('validation-report-pages', function (jQuery) {
+  return {
+    options: {
+      resourceId: null,
+      pageSize: 100
+    },
+
+    initialize: function () {
+      jQuery.proxyAll(this, /_on/);
+
+      this.summary = null;
+      this.filters = {};
+      this.offset = 0;
+      this.count = null;
+      this.loading = false;
+      this.failed = false;
+      this.request = 0;
+
+      this.summaryEl = jQuery('<div class="validation-report-summary"></div>');
+      this.filtersEl = jQuery('<form class="validation-report-filters form-inline"></form>');
+      this.tableEl = jQuery(
+        '<table class="table table-striped table-condensed validation-report-errors">' +
+        '<thead><tr></tr></thead><tbody></tbody></table>');
+      this.statusEl = jQuery('<p class="validation-report-status"></p>');
+      this.moreEl = jQuery('<button type="button" class="btn btn-default"></button>')
+        .text(this._('Load more errors'))
+        .hide();
+
+      this.el.append(
+        this.summaryEl, this.filtersEl, this.tableEl, this.statusEl, this.moreEl);
+
+      this.filtersEl.on('change', 'select', this._onFilter);
+      this.filtersEl.on('submit', function (event) { event.preventDefault(); });
+      this.moreEl.on('click', this._onLoadMore);
+
+      if ('IntersectionObserver' in window) {
+        this.observer = new IntersectionObserver(this._onScroll);
+        this.observer.observe(this.moreEl[0]);
+      }
+
+      this._load(true);
+    },
+
+    /* Requests the next page of errors, and the summary if `withSummary` */
+    _load: function (withSummary) {
+      var params = jQuery.extend({
+        resource_id: this.options.resourceId,
+        offset: this.offset,
+        limit: this.options.pageSize,
+        include_summary: withSummary ? 'true' : 'false'
+      }, this.filters);
+      var request = ++this.request;
+      var module = this;
+
+      this.loading = true;
+      this.statusEl.text(this._('Loading...'));
+
+      this.sandbox.client.call(
+        'GET', 'resource_validation_report', '?' + jQuery.param(params),
+        function (data) {
+          // Responses to requests made before changing the filters are ignored
+          if (request === module.request) {
+            module._onLoaded(data.result);
+          }
+        },
+        function () {
+          if (request === module.request) {
+            module._onError();
+          }
+        });
+    },
+
+    _onLoaded: function (result) {
+      this.loading = false;
+      this.failed = false;
+
+      if (result.summary) {
+        this.summary = result.summary;
+        this._renderSummary();
+        this._renderFilters();
+        this._renderHeader();
+      }
+
+      this.count = result.count;
+      this.offset += result.errors.length;
+      this._renderErrors(result.errors);
+      this._renderStatus();
+    },
+
+    _onError: function () {
+      this.loading = false;
+      this.failed = true;
+      this.statusEl.text(this._('Error loading the validation report'));
+      this.moreEl.show();
+    },
+
+    _onLoadMore: function () {
+      if (!this.loading && this._hasMore()) {
+        this._load(this.summary === null);
+      }
+    },
+
+    _onScroll: function (entries) {
+      // After an error the button needs to be clicked to try again
+      if (entries[0].isIntersecting && !this.failed) {
+        this._onLoadMore();
+      }
+    },
+
+    _onFilter: function () {
+      var filters = {};
+      this.filtersEl.find('select').each(function () {
+        if (this.value !== '') {
+          filters[this.name] = this.value;
+        }
+      });
+      this.filters = filters;
+
+      this.offset = 0;
+      this.count = null;
+      this.tableEl.find('tbody').empty();
+      this._renderHeader();
+      this._load(false);
+    },
+
+    _hasMore: function () {
+      return this.count === null || this.offset < this.count;
+    },
+
+    _renderSummary: function () {
+      var summary = this.summary;
+      var items = [];
+
+      if (summary.valid !== null) {
+        items.push(summary.valid ? this._('The data is valid') : this._('The data is not valid'));
+      }
+      if (summary.error_count !== null) {
+        items.push(this._('Errors') + ': ' + summary.error_count);
+      }
+      if (summary.row_count !== null) {
+        items.push(this._('Rows') + ': ' + summary.row_count);
+      }
+
+      this.summaryEl.empty().append(
+        jQuery('<ul class="list-inline"></ul>').append(jQuery.map(items, function (item) {
+          return jQuery('<li></li>').text(item);
+        })));
+
+      var messages = jQuery.map(summary.report_errors.concat(summary.warnings), function (message) {
+        return jQuery('<div class="alert alert-warning"></div>').text(
+          typeof message === 'string' ? message : message.message);
+      });
+      this.summaryEl.append(messages);
+    },
+
+    _renderFilters: function () {
+      var tasks = this.summary.tasks;
+      var codes = {};
+      var fields = {};
+
+      jQuery.each(tasks, function (i, task) {
+        jQuery.each(task.error_codes, function (code, count) {
+          codes[code] = (codes[code] || 0) + count;
+        });
+        jQuery.each(task.fields, function (i, field) {
+          fields[field] = true;
+        });
+      });
+
+      this.filtersEl.empty();
+      if (tasks.length > 1) {
+        this.filtersEl.append(this._select('task', this._('All tables'),
+          jQuery.map(tasks, function (task) {
+            return {value: task.index, label: task.name || task.place};
+          })));
+      }
+      this.filtersEl.append(this._select('code', this._('All error types'),
+        jQuery.map(Object.keys(codes).sort(), function (code) {
+          return {value: code, label: code + ' (' + codes[code] + ')'};
+        })));
+      this.filtersEl.append(this._select('field', this._('All fields'),
+        jQuery.map(Object.keys(fields).sort(), function (field) {
+          return {value: field, label: field};
+        })));
+    },
+
+    _select: function (name, emptyLabel, options) {
+      var select = jQuery('<select class="form-control input-sm"></select>')
+        .attr('name', name)
+        .append(jQuery('<option value=""></option>').text(emptyLabel));
+
+      jQuery.each(options, function (i, option) {
+        select.append(jQuery('<option></option>').attr('value', option.value).text(option.label));
+      });
+
+      return select;
+    },
+
+    _showTaskColumn: function () {
+      return this.summary.tasks.length > 1 && this.filters.task === undefined;
+    },
+
+    _renderHeader: function () {
+      var columns = [this._('Row'), this._('Field'), this._('Error'), this._('Message')];
+      if (this._showTaskColumn()) {
+        columns.unshift(this._('Table'));
+      }
+
+      this.tableEl.find('thead tr').empty().append(jQuery.map(columns, function (column) {
+        return jQuery('<th></th>').text(column);
+      }));
+    },
+
+    _renderErrors: function (errors) {
+      var showTask = this._showTaskColumn();
+      var tasks = this.summary.tasks;
+
+      var rows = jQuery.map(errors, function (error) {
+        var cells = [
+          error.rowNumber || '',
+          error.fieldName || '',
+          error.title || error.type || error.code || '',
+          error.message || ''
+        ];
+        if (showTask) {
+          var task = tasks[error.task] || {};
+          cells.unshift(task.name || task.place || error.task);
+        }
+        return jQuery('<tr></tr>').append(jQuery.map(cells, function (cell) {
+          return jQuery('<td></td>').text(cell);
+        }));
+      });
+
+      this.tableEl.find('tbody').append(rows);
+    },
+
+    _renderStatus: function () {
+      if (this.count === 0) {
+        this.statusEl.text(this._('No errors found'));
+        this.tableEl.hide();
+      } else {
+        this.statusEl.text(this._('Showing {shown} of {count} errors')
+          .replace('{shown}', this.offset)
+          .replace('{count}', this.count));
+        this.tableEl.show();
+      }
+
+      this.moreEl.toggle(this._hasMore());
+    }
+  };
+});